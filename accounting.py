@@ -0,0 +1,190 @@
+import argparse
+import contextvars
+import json
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import metrics
+from state_backend import shared_state
+
+# ---------------------- Token & cost accounting ----------------------
+# Every upstream attempt records its prompt/completion tokens (from the response's
+# `usage` when the provider sends it, estimated otherwise), latency and estimated cost
+# against the served model, the current day and the requesting session. Totals live in
+# the shared state backend so they add up across replicas.
+# Budgets (USD, 0 = unlimited) narrow the fallback chain to free models once exceeded:
+#   DAILY_BUDGET_USD    for the whole deployment, per UTC day
+#   SESSION_BUDGET_USD  for one browser session
+# An upstream 402 (out of credits) does the same for CREDITS_COOLDOWN_SECONDS.
+
+DAILY_BUDGET_USD = float(os.environ.get("DAILY_BUDGET_USD", 0))
+SESSION_BUDGET_USD = float(os.environ.get("SESSION_BUDGET_USD", 0))
+CREDITS_COOLDOWN_SECONDS = 600
+# Per-session totals are dropped this long after the session's last upstream call.
+SESSION_USAGE_TTL_SECONDS = 24 * 3600
+
+# USD per million (prompt, completion) tokens. ":free" variants cost nothing; anything
+# missing here is charged at DEFAULT_PRICE so unknown models never look free.
+MODEL_PRICES = {
+    "mistral/mistral-7b-instruct": (0.028, 0.054),
+    "mistralai/mixtral-8x7b-instruct": (0.24, 0.24),
+    "gryphe/mythomax-l2-13b": (0.065, 0.065),
+    "openchat/openchat-7b": (0.07, 0.07),
+    "nousresearch/nous-capybara-7b": (0.18, 0.18),
+    "meta-llama/llama-2-70b-chat": (0.64, 0.80),
+}
+DEFAULT_PRICE = (1.0, 1.0)
+MODEL_PRICES.update({model: tuple(price) for model, price in json.loads(os.environ.get("MODEL_PRICES_JSON", "{}")).items()})
+
+_session = contextvars.ContextVar("accounting_session", default="")
+
+
+def is_cjk(ch: str) -> bool:
+    """Kana, CJK ideographs, Hangul and CJK compatibility ideographs (about one token per character)."""
+    return "぀" <= ch <= "ヿ" or "㐀" <= ch <= "鿿" or "가" <= ch <= "힯" or "豈" <= ch <= "﫿"
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap single-pass token estimate: ~1 token per CJK character, ~4 characters per token otherwise."""
+    cjk = 0
+    other = 0
+    for ch in text:
+        if is_cjk(ch):
+            cjk += 1
+        else:
+            other += 1
+    return cjk + (other + 3) // 4
+
+
+def is_free_model(model: str) -> bool:
+    return model.endswith(":free")
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    if is_free_model(model):
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES.get(model, DEFAULT_PRICE)
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+# ---------------------- Session attribution ----------------------
+@contextmanager
+def session(session_id: str):
+    """Attribute upstream usage inside the block (and in work copied from its context) to `session_id`."""
+    reset = _session.set(session_id or "")
+    try:
+        yield
+    finally:
+        _session.reset(reset)
+
+
+def current_session() -> str:
+    return _session.get()
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+# ---------------------- Recording ----------------------
+def record_usage(model: str, prompt_tokens: int, completion_tokens: int, seconds: float, estimated: bool = False, session_id: str = None) -> float:
+    """Add one attempt to the per-model/day and per-session totals; returns its estimated cost."""
+    session_id = current_session() if session_id is None else session_id
+    cost = estimate_cost(model, prompt_tokens, completion_tokens)
+    values = {"requests": 1, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "seconds": seconds, "cost": cost}
+    if estimated:
+        values["estimated"] = 1
+    metrics.incr("usage.prompt_tokens", prompt_tokens)
+    metrics.incr("usage.completion_tokens", completion_tokens)
+    metrics.incr("usage.cost", cost)
+    try:
+        backend = shared_state()
+        day = _today()
+        for name, value in values.items():
+            backend.hincr(f"usage:day:{day}", f"{model}|{name}", value)
+            if session_id:
+                backend.hincr(f"usage:session:{session_id}", f"{model}|{name}", value, ttl=SESSION_USAGE_TTL_SECONDS)
+    except Exception as e:
+        logging.warning(f"Could not record usage for {model}: {e}")
+    return cost
+
+
+def record_out_of_credits() -> None:
+    """An upstream 402: stop choosing paid models for a while, on every replica."""
+    metrics.incr("upstream.out_of_credits")
+    try:
+        shared_state().set("usage:out_of_credits", _today(), ttl=CREDITS_COOLDOWN_SECONDS)
+    except Exception as e:
+        logging.warning(f"Could not record the out-of-credits state: {e}")
+
+
+# ---------------------- Queries ----------------------
+def _report(fields: dict) -> dict:
+    models = {}
+    for field, value in fields.items():
+        model, _, name = field.rpartition("|")
+        models.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "cost": 0.0, "estimated": 0})[name] = value
+    totals = {name: sum(stats[name] for stats in models.values()) for name in ("requests", "prompt_tokens", "completion_tokens", "seconds", "cost", "estimated")}
+    for stats in list(models.values()) + [totals]:
+        stats["avg_seconds"] = stats["seconds"] / stats["requests"] if stats["requests"] else 0.0
+    return {"models": models, "total": totals}
+
+
+def usage_report(day: str = None, session_id: str = None) -> dict:
+    """{"models": {model: stats}, "total": stats} for one session, or for one UTC day (default today)."""
+    key = f"usage:session:{session_id}" if session_id else f"usage:day:{day or _today()}"
+    try:
+        return _report(shared_state().hgetall(key))
+    except Exception as e:
+        logging.warning(f"Could not read usage {key}: {e}")
+        return _report({})
+
+
+def spend(day: str = None, session_id: str = None) -> float:
+    return usage_report(day, session_id)["total"]["cost"]
+
+
+# ---------------------- Budget enforcement ----------------------
+def budget_exceeded(session_id: str = None) -> str:
+    """Why paid models are off limits right now ("" if they are not)."""
+    session_id = current_session() if session_id is None else session_id
+    try:
+        if shared_state().get("usage:out_of_credits"):
+            return "upstream credits exhausted"
+    except Exception:
+        pass
+    if DAILY_BUDGET_USD and spend() >= DAILY_BUDGET_USD:
+        return f"daily budget of ${DAILY_BUDGET_USD:.2f} reached"
+    if SESSION_BUDGET_USD and session_id and spend(session_id=session_id) >= SESSION_BUDGET_USD:
+        return f"session budget of ${SESSION_BUDGET_USD:.2f} reached"
+    return ""
+
+
+def affordable_models(models, session_id: str = None):
+    """`models` unchanged while within budget, otherwise only the free ones (order kept)."""
+    reason = budget_exceeded(session_id)
+    if not reason:
+        return list(models)
+    metrics.incr("usage.budget_downgrades")
+    logging.info(f"Using free models only: {reason}")
+    return [model for model in models if is_free_model(model)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show token usage and estimated cost per model.")
+    parser.add_argument("--day", help="UTC day as YYYY-MM-DD (default: today)")
+    parser.add_argument("--session", help="report one session instead of a day")
+    parser.add_argument("--json", action="store_true", help="print the raw report as JSON")
+    args = parser.parse_args()
+
+    report = usage_report(args.day, args.session)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        raise SystemExit(0)
+    print(f"{'model':<48} {'reqs':>6} {'prompt':>9} {'compl':>9} {'avg s':>7} {'cost $':>10}")
+    for model, stats in sorted(report["models"].items(), key=lambda item: -item[1]["cost"]):
+        print(f"{model:<48} {stats['requests']:>6.0f} {stats['prompt_tokens']:>9.0f} {stats['completion_tokens']:>9.0f} {stats['avg_seconds']:>7.2f} {stats['cost']:>10.5f}")
+    total = report["total"]
+    print(f"{'TOTAL':<48} {total['requests']:>6.0f} {total['prompt_tokens']:>9.0f} {total['completion_tokens']:>9.0f} {total['avg_seconds']:>7.2f} {total['cost']:>10.5f}")
@@ -1,14 +1,36 @@
 import streamlit as st
-import requests
 import time
 import pandas as pd
 import json
 from datetime import datetime
 from pytz import timezone
 import random
+import secrets
 import os
 import csv
 import logging
+import html
+from concurrent.futures import TimeoutError as FutureTimeout
+from functools import partial
+
+from options import tone_options, language_options, viral_samples
+from rewriter import rewrite_message, rewrite_all_tones, translate_all, SIMILAR_INPUTS
+from catalog import load_catalog, start_background_refresh
+from key_pool import KeyPool
+from health import HEALTH_PROBES_PER_HOUR, HealthMonitor
+from feedback_search import FeedbackIndex
+from session_monitor import SESSION_IDLE_SECONDS, SessionMonitor
+from text_codec import decode_text, encode_text
+from pii import scrub, scrub_row
+from history_export import EXPORT_FORMATS, spool_export
+from prefetch import Prefetcher, likely_next_choices
+from cancellation import CancelToken, Deadline, DEFAULT_BUDGET_SECONDS
+from backends import LocalBackend
+from rule_rewriter import rule_rewrite
+from scheduler import RewriteJob, QueueFull, Scheduler, INTERACTIVE
+from state_backend import configure_shared_state, shared_state
+from chunking import MAX_INPUT_CHARS, LONG_DOCUMENT_TOKENS, estimate_tokens, rewrite_long_document, frame_long_document
+import profiling
 
 # Define the UTC timezone variable once and use it throughout the app.
 UTC_TZ = timezone('UTC')
@@ -82,15 +104,220 @@ def append_row_to_sheet(row, sheet_name="reframe_app_feedback"):
         logging.error(f"Failed to append row: {str(e)}")
         return False, str(e)
 
-# ---------------------- Deterministic fallback ----------------------
-def deterministic_rewrite(text: str, tone: str, language: str) -> str:
-    out = text.strip()
-    if len(out) > 0:
-        out = out[0].upper() + out[1:]
-    replacements = {"cant": "can't", "dont": "don't", "wont": "won't"}
-    for k, v in replacements.items():
-        out = out.replace(k, v)
-    return f"[{tone.title()} Enhancement] {out}"
+# ---------------------- Shared state (multi-replica) ----------------------
+@st.cache_resource
+def get_shared_state():
+    """Open the STATE_BACKEND once per process; replicas pointing at the same one share cache, limits and feedback."""
+    return configure_shared_state(st.secrets.get("STATE_BACKEND", "") or os.environ.get("STATE_BACKEND", "memory"))
+
+get_shared_state()
+
+FEEDBACK_CSV_PATH = st.secrets.get("FEEDBACK_CSV_PATH", "") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "feedback_local.csv")
+FEEDBACK_COLUMNS = ["timestamp", "rating", "like", "improvements", "suggestions", "original", "rewritten", "user_email", "public_link"]
+
+def save_feedback_locally(row):
+    """Fallback feedback store: the shared backend when there is one, plus the CSV (best-effort)."""
+    backend = shared_state()
+    if backend.shared:
+        try:
+            backend.append("feedback", encode_text(json.dumps(row)))
+        except Exception as e:
+            logging.error(f"Failed to store feedback in shared state: {e}")
+    try:
+        file_exists = os.path.isfile(FEEDBACK_CSV_PATH)
+        with open(FEEDBACK_CSV_PATH, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if not file_exists:
+                writer.writerow(FEEDBACK_COLUMNS)
+            writer.writerow(row)
+    except Exception as e:
+        logging.error(f"Failed to write {FEEDBACK_CSV_PATH}: {e}")
+
+def load_local_feedback():
+    """Rows from the shared feedback store, or from the CSV on a single replica."""
+    backend = shared_state()
+    if backend.shared:
+        try:
+            return [json.loads(decode_text(item)) for item in backend.items("feedback")]
+        except Exception as e:
+            logging.error(f"Failed to read feedback from shared state: {e}")
+    if not os.path.isfile(FEEDBACK_CSV_PATH):
+        return []
+    with open(FEEDBACK_CSV_PATH, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader, None)  # header
+        return list(reader)
+
+# Defined up here because the feedback form clears the row cache after a submission.
+@st.cache_resource
+def get_feedback_index():
+    return FeedbackIndex()
+
+@st.cache_resource(ttl=60, show_spinner=False)
+def load_feedback_rows():
+    """(rows, note): Google Sheets first, the local store if that fails or is empty."""
+    note = ""
+    rows = []
+    try:
+        client = gs_client_from_secrets()
+        if client:
+            sh = client.open("reframe_app_feedback")
+            worksheet = sh.sheet1
+            sheet_data = worksheet.get_all_values()
+            if len(sheet_data) > 1:
+                rows = sheet_data[1:]  # skip header
+    except Exception as e:
+        note = "🔍 Unable to open google feedback sheet — falling back to CSV."
+        rows = []
+
+    # Fallback to the local store — only if Google Sheets failed OR no rows
+    if not rows:
+        try:
+            rows = load_local_feedback()
+        except Exception as e:
+            note = f"🔍 CSV read failed: {e}"
+            rows = []
+    return rows, note
+
+# ---------------------- Local (zero-network) fallback ----------------------
+LOCAL_FALLBACK_ENABLED = str(st.secrets.get("LOCAL_FALLBACK", "true")).lower() not in ("false", "0", "no")
+
+@st.cache_resource
+def get_local_backend():
+    """Warm local worker used when every model in the fallback chain fails."""
+    if not LOCAL_FALLBACK_ENABLED:
+        return None
+    model_path = st.secrets.get("LOCAL_MODEL_PATH", "") or os.environ.get("LOCAL_MODEL_PATH", "")
+    return LocalBackend(model_path=model_path)
+
+# ---------------------- OpenRouter key pool ----------------------
+# OPENROUTER_API_KEYS (a list) spreads calls over several keys; see key_pool.py.
+@st.cache_resource
+def get_key_pool():
+    """Every configured OpenRouter key in one process-wide pool, or None when there is none."""
+    pool = KeyPool.from_config(st.secrets.get("OPENROUTER_API_KEYS", None) or st.secrets.get("OPENROUTER_API_KEY", None))
+    return pool if len(pool) else None
+
+# ---------------------- Connection warm-up & model probes ----------------------
+# Started once per process: warms pooled upstream connections and probes fallback models
+# within HEALTH_PROBES_PER_HOUR, so dead models are tried last (see health.py).
+@st.cache_resource
+def get_health_monitor():
+    probes_per_hour = float(st.secrets.get("HEALTH_PROBES_PER_HOUR", HEALTH_PROBES_PER_HOUR))
+    return HealthMonitor(get_key_pool(), probes_per_hour=probes_per_hour).start()
+
+get_health_monitor()
+
+# ---------------------- Precomputed rewrite catalog ----------------------
+@st.cache_resource
+def get_rewrite_catalog():
+    """Open the shipped catalog once per process and refresh it in the background if prompts changed."""
+    catalog = load_catalog()
+    api_key = get_key_pool()
+    if catalog is not None and api_key and catalog.is_stale():
+        start_background_refresh(catalog.path, api_key)
+    return catalog
+
+# ---------------------- Speculative prefetch (opt-in) ----------------------
+PREFETCH_ENABLED = bool(st.secrets.get("ENABLE_PREFETCH", False)) or os.environ.get("REFRAME_PREFETCH") == "1"
+
+@st.cache_resource
+def get_prefetcher():
+    return Prefetcher(rate_per_minute=float(st.secrets.get("PREFETCH_RATE_PER_MIN", 20)), scheduler=get_scheduler())
+
+# ---------------------- Request deadlines & cancellation ----------------------
+REWRITE_DEADLINE_SECONDS = float(st.secrets.get("REWRITE_DEADLINE_SECONDS", DEFAULT_BUDGET_SECONDS))
+
+@st.cache_resource
+def get_scheduler():
+    """Process-wide rewrite scheduler: priority classes plus per-session fair queueing (see scheduler.py)."""
+    return Scheduler(workers=int(st.secrets.get("REWRITE_WORKERS", 16)))
+
+def cancel_session_rewrites(reason):
+    token = st.session_state.get("rewrite_token")
+    if token is not None:
+        token.cancel(reason)
+
+def new_rewrite_deadline():
+    """Cancel whatever this session still has in flight and start a fresh budget."""
+    cancel_session_rewrites("superseded by a new request")
+    token = CancelToken()
+    st.session_state.rewrite_token = token
+    return Deadline(REWRITE_DEADLINE_SECONDS, token)
+
+def wait_for_rewrite(job, deadline, status):
+    """Block until `job` finishes, updating `status` so Streamlit can interrupt us on rerun.
+
+    While the job is queued, `status` shows its place in line and the estimated wait.
+    If the script is stopped or rerun while waiting, the request's token is cancelled and the
+    worker abandons its in-flight HTTP call instead of finishing work nobody will see.
+    """
+    started = time.monotonic()
+    try:
+        while True:
+            try:
+                return job.future.result(timeout=0.5)
+            except FutureTimeout:
+                ahead = get_scheduler().position(job)
+                if ahead is not None:
+                    status.caption(f"🚦 You're #{ahead + 1} in line — about {get_scheduler().estimated_wait(job):.0f}s to go")
+                else:
+                    status.caption(f"⏱️ {time.monotonic() - started:.0f}s — still looking for the best reframe...")
+    finally:
+        if not job.future.done():
+            deadline.token.cancel("session rerun")
+        status.empty()
+
+def rewrite_long_input(user_input, tone, language, format_as_email, api_key):
+    """Long-document mode: rewrite section by section, streaming the stitched text as it grows."""
+    progress = st.progress(0.0, text="📄 Rewriting section 1...")
+    # Each finished section is appended once, so the page grows with the document instead of re-sending it
+    holder = st.empty()
+    stitched = holder.container()
+    sections = []
+    stream = rewrite_long_document(user_input, tone, language, api_key, deadline=new_rewrite_deadline(), heartbeat=0.5, scheduler=get_scheduler(), session_id=st.session_state.app_session_id)
+    try:
+        for index, total, section in stream:
+            if section is None:
+                progress.progress(len(sections) / total, text=f"📄 Rewriting section {len(sections) + 1} of {total}...")
+                continue
+            sections.append(section)
+            progress.progress(len(sections) / total, text=f"📄 {len(sections)} of {total} sections rewritten")
+            stitched.markdown(f"""<div class="pro-tip-box">{html.escape(section)}</div>""", unsafe_allow_html=True)
+    finally:
+        stream.close()
+    progress.empty()
+    holder.empty()
+    return frame_long_document("\n\n".join(sections), tone, language, format_as_email) if sections else None
+
+def translate_into_languages(rewritten, user_input, tone, primary_language, languages, format_as_email, api_key):
+    """Multi-language mode: show the finished reframe, then stream its translations in as each one lands."""
+    holder = st.empty()
+    with holder.container():
+        st.markdown(f"""<div class="result-box"><h4>{language_options[primary_language]}</h4><p style="white-space: pre-wrap;">{html.escape(rewritten)}</p></div>""", unsafe_allow_html=True)
+        placeholders = {language: st.empty() for language in languages}
+        status = st.empty()
+    for language, placeholder in placeholders.items():
+        placeholder.info(f"{language_options[language]} — translating...")
+    translations = {}
+    started = time.monotonic()
+    stream = translate_all(rewritten, user_input, tone, languages, format_as_email, api_key, catalog=get_rewrite_catalog(), deadline=new_rewrite_deadline(), heartbeat=0.5, fallback=get_local_backend(), scheduler=get_scheduler(), session_id=st.session_state.app_session_id)
+    try:
+        for language, translated in stream:
+            if language is None:
+                # Heartbeat: updating an element lets Streamlit stop us if the user reruns
+                status.caption(f"⏱️ {time.monotonic() - started:.0f}s — {len(translations)}/{len(languages)} languages ready")
+            elif translated:
+                translations[language] = translated
+                placeholders[language].markdown(f"""<div class="result-box"><h4>{language_options[language]}</h4><p style="white-space: pre-wrap;">{html.escape(translated)}</p></div>""", unsafe_allow_html=True)
+            else:
+                placeholders[language].warning(f"{language_options[language]} — unavailable right now.")
+    except QueueFull:
+        st.warning("🚦 REFRAME is very busy right now, so some translations were skipped. Please try again in a few seconds!")
+    finally:
+        stream.close()
+    holder.empty()
+    return translations
 
 # ---------------------- PROPER Session State Reset ----------------------
 # PROPER Session State Initialization
@@ -105,17 +332,45 @@ if "app_session_id" not in st.session_state:
     st.session_state["selected_tone"] = "managerial"
     st.session_state["selected_language"] = "English"
     st.session_state["format_as_email"] = False
-    st.session_state["app_session_id"] = str(int(time.time() * 1000))
-    st.session_state["continue_btn_clicked"] = False
-    
-# The reset function is fine to be called from buttons, but should not be called globally.
+    # Random, not a timestamp: it names the session's spill file and keys its usage totals
+    st.session_state["app_session_id"] = secrets.token_urlsafe(16)
+    st.session_state["tone_variants"] = {}
+    st.session_state["translations"] = {}
+
+# ---------------------- Session footprint & idle offload ----------------------
+# Sessions idle for SESSION_IDLE_SECONDS have their history and comparisons moved to disk;
+# resume() brings them back before anything below reads them (see session_monitor.py).
+@st.cache_resource
+def get_session_monitor():
+    return SessionMonitor(idle_seconds=float(st.secrets.get("SESSION_IDLE_SECONDS", SESSION_IDLE_SECONDS))).start()
+
+session_monitor = get_session_monitor()
+session_monitor.resume(st.session_state.app_session_id)
+
+# ---------------------- Rerun profiling (opt-in) ----------------------
+# Times this script run section by section (rerun.mark below); slow runs also keep a
+# sampled stack profile. Off unless PROFILE_RERUNS is set; see profiling.py.
+PROFILE_RERUNS = str(st.secrets.get("PROFILE_RERUNS", "")).lower() in ("1", "true", "yes") or profiling.PROFILE_RERUNS
+rerun = profiling.start_rerun(st.session_state, st.session_state.app_session_id, PROFILE_RERUNS)
+# Reruns and server time until the next completed transform (see profiling.py).
+profiling.count_run(st.session_state)
+
+# ---------------------- Button callbacks ----------------------
+# Buttons change state through on_click callbacks, which Streamlit runs before the script:
+# the run a click triggers already shows the change, with no st.rerun() (a second full
+# run) to catch up with it.
 def reset_app_state():
     """Complete reset to initial state"""
+    cancel_session_rewrites("session reset")
     st.session_state.clear()
-    # The app will re-initialize with the defaults above on the next rerun
-    st.rerun()
+    # The script run that follows re-initializes with the defaults above
+
+def set_state(**values):
+    for key, value in values.items():
+        st.session_state[key] = value
 
 # ---------------------- App Config ----------------------
+rerun.mark("hero")
 st.set_page_config(
     page_title="🎯 REFRAME - Elevate Your Message", 
     page_icon="🪄", 
@@ -663,100 +918,22 @@ if st.session_state.get("feedback_submitted"):
     st.session_state.feedback_submitted = False
 
 # ---------------------- Tone & Language Options ----------------------
-tone_options = {
-    "managerial": "🧭 Managerial - Balanced Leadership",
-    "empathetic": "💖 Empathetic - Caring & Supportive", 
-    "formal": "🧾 Formal - Corporate Professional",
-    "friendly": "😊 Friendly - Warm & Approachable",
-    "assertive": "💼 Assertive - Direct & Confident"
-}
-
-language_options = {
-    "English": "🇺🇸 English",
-    "Spanish": "🇪🇸 Español", 
-    "French": "🇫🇷 Français",
-    "German": "🇩🇪 Deutsch",
-    "Italian": "🇮🇹 Italiano",
-    "Portuguese": "🇵🇹 Português",
-    "Japanese": "🇯🇵 日本語",
-    "Korean": "🇰🇷 한국어",
-    "Chinese": "🇨🇳 中文"
-}
-
-# ---------------------- VIRAL SAMPLE TEXTS ----------------------
-viral_samples = [
-    "You never listen in meetings and always interrupt others. It's really annoying.",
-    "Your code is always buggy and creates more work for everyone else.",
-    "You're constantly late to everything and it shows you don't respect our time.",
-    "Your presentations are boring and put everyone to sleep.",
-    "You take credit for other people's work and it's not fair.",
-    "You're always on your phone during important discussions.",
-    "Your emails are confusing and no one understands what you want.",
-    "You never help your teammates and only care about yourself.",
-    "Why did you refactor working code that wasn’t even assigned to you?",
-    "The project is way behind schedule because you didn't deliver your part on time.",
-    "I disagree with your proposal, it's just not going to work.",
-    "You're not a good fit for this team, your personality clashes with everyone.",
-    "This report is useless. The data is all wrong and the conclusions don't make sense.",
-    "You need to be more proactive. I shouldn't have to follow up with you all the time.",
-    "I'm not happy with your performance. You've been making a lot of simple mistakes lately.",
-    "We trust you to manage your time — but you must be online from 9–5.",
-    "We need to let you go. This role is no longer a good fit for the company's direction.",
-    "You are not meeting the performance expectations of your role. There's been no improvement since our last talk.",
-    "Your behavior in meetings is unprofessional and is making your colleagues uncomfortable.",
-    "You've been out of compliance with company policy regarding expense reports for three months.",
-    "The last employee survey showed a high level of dissatisfaction with your department's leadership.",
-    "You missed the sprint deadline again. This is impacting the entire team's velocity.",
-    "Your user stories are consistently incomplete at the end of the sprint.",
-    "You're not actively participating in our daily stand-ups and that's not what Scrum is about.",
-    "Your task estimates are consistently inaccurate, making sprint planning impossible.",
-    "You are not updating your tasks on the board, which makes it hard for the team to see what's a blocker.",
-    "You're not responding to emails, only DMs and texts. That's not how we do professional communication here.",
-    "Per my last email: I told you twice already.",
-    "We value feedback — but don’t question leadership decisions.",
-    "You committed directly to main again. We have a branch policy for a reason.",
-    "Thanks for working weekends! We’ll 'keep it in mind during reviews'.",
-    "You said the work was 'cringe' and not a good use of your time. This is part of the job.",
-    "The way you handled that disagreement on LinkedIn violated our social media policy.",
-    "You completely ignored the formal process for requesting time off and just messaged me directly.",
-    "You're constantly missing team meetings or leaving early without warning. It's unprofessional.",
-    "You haven't completed the mandatory compliance training, which is putting the team at risk.",
-    "You've been taking days off without formally applying for leave through the HR system.",
-    "You were out on long-term leave for a week and I had no idea until a colleague told me.",
-    "Your promotion to Senior Developer is effective next Monday. Congrats.",
-    "We expect you to be available after hours during 'critical releases'.",
-    "I'm giving you a promotion. It comes with more responsibilities so get ready.",
-    "We decided to promote you. You'll have a new title and salary.",
-    "It's your fifth anniversary. Keep up the good work.",
-    "Congrats on ten years. Your team couldn't have done it without you.",
-    "Your salary increase request cannot be approved at this time. We need to stick to the budget.",
-    "Your performance is below expectations. I need you to show more initiative and ownership.",
-    "We're making changes and your position is being eliminated. We have to let you go.",
-    "The feedback we've received indicates that you are not a team player.",
-    "I’m resigning — not because of the pay, but because I’m doing 3 people’s jobs.",
-    "Your current work is not meeting the quality standards we expect from a senior role.",
-    "I'm resigning because I was promised growth but got stuck doing the same thing for a year.",
-    "It's time for me to leave — I can't keep covering for your poor management.",
-    "I'm stepping down because the team culture feels toxic and no one holds themselves accountable.",
-    "I'm out — I gave my best, but my efforts were never recognized.",
-    "I'm leaving because I found a place that values work-life balance — something we clearly don’t have here."
-]
+# tone_options, language_options and viral_samples live in options.py so the
+# offline catalog build can import them without starting Streamlit.
 
 # ---------------------- Step 1: EXCITING Input Section ----------------------
+rerun.mark("input")
 st.markdown('<div class="step-pill">🎯 STEP 1: Drop Your Raw, Honest Feedback Here</div>', unsafe_allow_html=True)
   
 # Viral action buttons
 col1, col2, col3 = st.columns([1, 1, 1])
 with col1:
     if st.button("💡 Instant Inspiration!", use_container_width=True, help="Get a random example to kickstart your reframe", key="sample_btn"):
-        #reset_app_state()
+        # The text area below has not been drawn yet in this run, so it shows the sample right away
         st.session_state.user_input = random.choice(viral_samples)
-        st.rerun()
         
 with col2:
-    if st.button("🚀 Fresh Start", use_container_width=True, help="Clear everything and start over", key="clear_btn"):
-        reset_app_state()
-        st.rerun()
+    st.button("🚀 Fresh Start", use_container_width=True, help="Clear everything and start over", key="clear_btn", on_click=reset_app_state)
         
 with col3:
     if st.button("💡 Pro Tips", use_container_width=True, help="Get expert communication advice", key="tip_btn"):
@@ -787,37 +964,31 @@ if st.session_state.get("show_tip", False) and st.session_state.get("current_tip
         </div>
         """, unsafe_allow_html=True)
     with tip_col2:
-        if st.button("✕", key="dismiss_tip", help="Hide tip"):
-            st.session_state.show_tip = False
-            st.session_state.current_tip = ""
-            st.rerun()
-
-# Main input with viral examples
-user_input = st.text_area(
-    label="Your Feedback",
-    key="user_input", 
-    height=140,
-    placeholder="🔥 Paste your brutally honest feedback here...\n\nExamples:\n• 'You never respond to emails. It's unprofessional.'\n• 'Your presentation was confusing and boring.'\n• 'You always interrupt people in meetings.'\n\n💪 Be real - we'll make it professional!",
-    help="Don't hold back - the rawer, the better the transformation!"
-)
-
-# ---------------------- Add a mobile-friendly "Continue" button ----------------------
-if st.session_state.user_input and st.session_state.user_input.strip() and not st.session_state.continue_btn_clicked:
-    col1, col2, col3 = st.columns([1, 2, 1])
-    with col2:
-        if st.button("✅ Continue to Options", use_container_width=True, key="continue_btn_main", help="Click to proceed to the next step"):
-            st.session_state.continue_btn_clicked = True
-            st.rerun()
-
-# ---------------------- ONLY SHOW CONTROLS IF INPUT EXISTS ----------------------
-if st.session_state.user_input and st.session_state.user_input.strip() and st.session_state.continue_btn_clicked:
+        st.button("✕", key="dismiss_tip", help="Hide tip", on_click=set_state, kwargs={"show_tip": False, "current_tip": ""})
+
+# ---------------------- One form for the input and the style choices ----------------------
+# Typing, picking a tone or a language and ticking Email Mode don't rerun the script:
+# the form sends them all with the Reframe click, so a transform takes one run instead
+# of one per widget change (plus a "Continue" step on mobile).
+with st.form("reframe_form", border=False):
+    # Main input with viral examples
+    user_input = st.text_area(
+        label="Your Feedback",
+        key="user_input",
+        height=140,
+        max_chars=MAX_INPUT_CHARS,
+        placeholder="🔥 Paste your brutally honest feedback here...\n\nExamples:\n• 'You never respond to emails. It's unprofessional.'\n• 'Your presentation was confusing and boring.'\n• 'You always interrupt people in meetings.'\n\n💪 Be real - we'll make it professional!",
+        help="Don't hold back - the rawer, the better the transformation!"
+    )
+
+    rerun.mark("controls")
     st.markdown('<div class="step-pill">⚙️ STEP 2: Choose Your Communication Style</div>', unsafe_allow_html=True)
-    
+
     # Clean layout without problematic containers
     col1, col2 = st.columns([2, 1])
     with col1:
         selected_tone_key = st.selectbox(
-            "🎭 Pick Your Power Tone", 
+            "🎭 Pick Your Power Tone",
             options=list(tone_options.keys()),
             format_func=lambda x: tone_options[x],
             index=list(tone_options.keys()).index(st.session_state.get("selected_tone", "managerial")),
@@ -825,9 +996,9 @@ if st.session_state.user_input and st.session_state.user_input.strip() and st.se
             key="tone_selector"
         )
         st.session_state.selected_tone = selected_tone_key
-        
+
         selected_language_key = st.selectbox(
-            "🌍 Choose Your Language", 
+            "🌍 Choose Your Language",
             options=list(language_options.keys()),
             format_func=lambda x: language_options[x],
             index=list(language_options.keys()).index(st.session_state.get("selected_language", "English")),
@@ -835,190 +1006,249 @@ if st.session_state.user_input and st.session_state.user_input.strip() and st.se
             key="language_selector"
         )
         st.session_state.selected_language = selected_language_key
-        
+
+        extra_languages = st.multiselect(
+            "🌐 Also In (multi-language mode)",
+            options=list(language_options.keys()),
+            format_func=lambda x: language_options[x],
+            help="Get the same reframe translated into more languages, written once and translated in parallel",
+            key="extra_languages"
+        )
+
     with col2:
         format_as_email = st.checkbox(
-            "📧 Email Mode", 
+            "📧 Email Mode",
             value=st.session_state.get("format_as_email", False),
             help="Complete email with greeting & closing",
             key="email_checkbox"
         )
         st.session_state.format_as_email = format_as_email
-        
-        # Magic Recipe aligned properly
+
+        # Magic Recipe aligned properly (as of the last Reframe click)
         st.markdown("**🔮 Magic Recipe:**")
         preview_parts = [tone_options[selected_tone_key].split(" - ")[0]]
         if format_as_email:
             preview_parts.append("Email")
         if selected_language_key != "English":
             preview_parts.append(language_options[selected_language_key].split(" ")[1])
-        
+
         st.markdown(f"""
         <div style="background: #d4edda; border: 1px solid #c3e6cb; color: #155724; padding: 0.6rem; border-radius: 8px; margin-top: 0.3rem; text-align: center; font-weight: 600; font-size: 0.9rem;">
             {" + ".join(preview_parts)}
         </div>
         """, unsafe_allow_html=True)
-    
+
     # ---------------------- VIRAL TRANSFORM BUTTON ----------------------
+    rerun.mark("transform")
     st.markdown('<div class="step-pill">🚀 STEP 3: Watch The Magic Happen</div>', unsafe_allow_html=True)
-    
+
     # Add a clear instructional message
     st.markdown("<p style='text-align: center; font-size: 1.2rem; font-weight: 600; color: #555;'>Ready to transform your message? Click the button below!</p>", unsafe_allow_html=True)
-    
+
     # Centered mega button
     col1, col2, col3 = st.columns([0.5, 3, 0.5])
     with col2:
-        if st.button(
-            "✨  Reframe your message  ✨", 
+        transform_clicked = st.form_submit_button(
+            "✨  Reframe your message  ✨",
             use_container_width=True,
             help="🎭 Click for instant professional transformation!",
             key="transform_btn"
-        ):
-            # Reset other panels
-            st.session_state.rewritten_text = ""
-            st.session_state.show_feedback_form = False
-            st.session_state.show_history = False
-            st.session_state.show_tip = False
-            
-            # Exciting loading messages
-            loading_messages = [
-                "🎭 Analyzing your communication style...",
-                "🧠 Processing your feedback...", 
-                "✨ Sprinkling professional magic...",
-                "🎯 Crafting the perfect tone...",
-                "🌟 Adding emotional intelligence...",
-                "🚀 Final touches being applied..."
-            ]
-            
-            api_key = st.secrets.get("OPENROUTER_API_KEY", None)
-            
-            if not api_key:
-                st.error("⚠️ The service is currently undergoing maintenance and is unavailable. We apologize for the inconvenience! Please check back in a few minutes.")
+        )
+        # In the form too, so it compares the text and language on screen, not the last submitted ones
+        compare_clicked = st.form_submit_button(
+            "🎭 Compare All Tones",
+            use_container_width=True,
+            help="See your message in every tone side by side",
+            key="compare_tones_btn"
+        )
+
+input_tokens = estimate_tokens(user_input) if user_input else 0
+if input_tokens > LONG_DOCUMENT_TOKENS:
+    st.caption(f"📄 Long document (≈ {input_tokens:,} tokens) — it will be rewritten section by section.")
+
+# Edits only arrive with a submit: if it brings new text, the queued prefetches for the
+# old text are pointless, and are cancelled before the new request competes with them
+submitted = transform_clicked or compare_clicked
+if PREFETCH_ENABLED and submitted and st.session_state.get("prefetched_input") and st.session_state.prefetched_input != user_input:
+    get_prefetcher().cancel(st.session_state.app_session_id)
+    st.session_state.prefetched_input = ""
+
+# Set by "Rewrite from scratch": run the transform again without near-duplicate reuse
+fresh_rewrite = st.session_state.pop("fresh_rewrite", False)
+has_input = bool(user_input and user_input.strip())
+if submitted and not has_input:
+    st.warning("✍️ Drop in the feedback you want to reframe first!")
+elif has_input and (transform_clicked or fresh_rewrite):
+    # Reset other panels
+    st.session_state.rewritten_text = ""
+    st.session_state.similar_reuse = 0
+    st.session_state.translations = {}
+    st.session_state.tone_variants = {}
+    st.session_state.show_feedback_form = False
+    st.session_state.show_history = False
+    st.session_state.show_tip = False
+    
+    # Exciting loading messages
+    loading_messages = [
+        "🎭 Analyzing your communication style...",
+        "🧠 Processing your feedback...", 
+        "✨ Sprinkling professional magic...",
+        "🎯 Crafting the perfect tone...",
+        "🌟 Adding emotional intelligence...",
+        "🚀 Final touches being applied..."
+    ]
+    
+    api_key = get_key_pool()
+    
+    if not api_key:
+        st.error("⚠️ The service is currently undergoing maintenance and is unavailable. We apologize for the inconvenience! Please check back in a few minutes.")
+        st.session_state.rewritten_text = ""
+    else:
+        rewritten = None
+                                   
+        with st.spinner(random.choice(loading_messages)):
+            try:                   
+                # Show a reassuring message to the user during the fallback process
+                st.info("💡 Your message is being rephrased. We're experimenting with several models to find the ideal reframing for you, if it takes a moment!")
+
+                if input_tokens > LONG_DOCUMENT_TOKENS:
+                    rewritten = rewrite_long_input(user_input, selected_tone_key, selected_language_key, format_as_email, api_key)
+                else:
+                    # Instant rule-based preview while the models work
+                    preview = st.empty()
+                    preview.markdown(f"""<div class="pro-tip-box"><strong>⚡ Quick preview</strong> <em>(refining with AI...)</em><br>{html.escape(rule_rewrite(user_input, selected_tone_key, selected_language_key))}</div>""", unsafe_allow_html=True)
+
+                    deadline = new_rewrite_deadline()
+                    job = RewriteJob(
+                        rewrite_message,
+                        (user_input, selected_tone_key, selected_language_key, format_as_email, api_key, get_rewrite_catalog(), deadline, get_local_backend()),
+                        {"reuse_similar": not fresh_rewrite},
+                        session_id=st.session_state.app_session_id,
+                        priority=INTERACTIVE,
+                        deadline=deadline,
+                    )
+                    get_scheduler().submit(job)
+                    rewritten = wait_for_rewrite(job, deadline, st.empty())
+                    preview.empty()
+
+                    # Served from a near-identical earlier message? (Its own input is indexed only after a model answers it.)
+                    # The index holds scrubbed inputs and rewrites (see pii.py)
+                    scrubbed_input = scrub(user_input)
+                    similar = SIMILAR_INPUTS.lookup(scrubbed_input.text, selected_tone_key, selected_language_key, format_as_email) if rewritten and not fresh_rewrite else None
+                    if similar is not None and similar.similarity < 1 and scrubbed_input.restore(similar.rewrite) == rewritten:
+                        st.session_state.similar_reuse = round(similar.similarity * 100)
+
+                if rewritten and user_input:
+                    st.session_state.rewritten_text = rewritten
+                    profiling.transform_done(st.session_state)
+                    # Modified timestamp format
+                    formatted_timestamp = datetime.now(UTC_TZ).strftime("%Y-%m-%d %H:%M:%S")
+                    st.session_state.rewrites.insert(0, {"timestamp": formatted_timestamp, "tone": selected_tone_key, "language": selected_language_key, "email": format_as_email, "original": user_input, "rewritten": rewritten})
+
+                    # Warm the cache for the most likely next click (Try New Tone / Email Mode)
+                    if PREFETCH_ENABLED:
+                        choices = likely_next_choices(selected_tone_key, selected_language_key, format_as_email, tone_options)
+                        get_prefetcher().schedule(st.session_state.app_session_id, user_input, choices, api_key, catalog=get_rewrite_catalog())
+                        st.session_state.prefetched_input = user_input
+
+                    # Multi-language mode: translate the finished reframe instead of rewriting it per language
+                    target_languages = [language for language in extra_languages if language != selected_language_key]
+                    if target_languages and input_tokens > LONG_DOCUMENT_TOKENS:
+                        st.caption("🌐 Multi-language mode works on single messages; long documents are rewritten in one language.")
+                    elif target_languages:
+                        translations = translate_into_languages(rewritten, user_input, selected_tone_key, selected_language_key, target_languages, format_as_email, api_key)
+                        st.session_state.translations = translations
+                        for language in target_languages:
+                            if language in translations:
+                                st.session_state.rewrites.insert(0, {"timestamp": formatted_timestamp, "tone": selected_tone_key, "language": language, "email": format_as_email, "original": user_input, "rewritten": translations[language]})
+                else:
+                    # If the loop finishes and no model succeeded, set the rewritten text to empty and show a clear error.
+                    st.error("⚠️ We were unable to reframe your message at the moment. Please try again 🙂")
+                    st.session_state.rewritten_text = ""
+
+            except QueueFull:
+                st.warning("🚦 REFRAME is very busy right now and your request couldn't be queued. Please try again in a few seconds!")
                 st.session_state.rewritten_text = ""
+
+            except Exception as e:
+                # A final catch-all for any other unexpected errors
+                st.error(f"⚠️ An unexpected error occurred: {str(e)}. Please try again!")
+                st.session_state.rewritten_text = ""
+
+# ---------------------- Compare Tones ----------------------
+rerun.mark("compare")
+if has_input:
+    if compare_clicked:
+        st.session_state.tone_variants = {}
+        st.session_state.show_feedback_form = False
+        st.session_state.show_history = False
+        api_key = get_key_pool()
+
+        if not api_key:
+            st.error("⚠️ The service is currently undergoing maintenance and is unavailable. We apologize for the inconvenience! Please check back in a few minutes.")
+        else:
+            st.markdown('<div class="step-pill">🎭 Your Message in Every Tone</div>', unsafe_allow_html=True)
+            # One placeholder per tone, filled in as each variant finishes
+            placeholders = {tone: st.empty() for tone in tone_options}
+            for tone, placeholder in placeholders.items():
+                placeholder.info(f"{tone_options[tone]} — crafting...")
+
+            variants = {}
+            status = st.empty()
+            started = time.monotonic()
+            variants_stream = rewrite_all_tones(user_input, tone_options, selected_language_key, format_as_email, api_key, catalog=get_rewrite_catalog(), deadline=new_rewrite_deadline(), heartbeat=0.5, fallback=get_local_backend(), scheduler=get_scheduler(), session_id=st.session_state.app_session_id)
+            try:
+                for tone, rewritten in variants_stream:
+                    if tone is None:
+                        # Heartbeat: updating an element lets Streamlit stop us if the user reruns
+                        status.caption(f"⏱️ {time.monotonic() - started:.0f}s — {len(variants)}/{len(tone_options)} tones ready")
+                    elif rewritten:
+                        variants[tone] = rewritten
+                        placeholders[tone].markdown(f"""<div class="result-box"><h4>{tone_options[tone]}</h4><p style="white-space: pre-wrap;">{html.escape(rewritten)}</p></div>""", unsafe_allow_html=True)
+                    else:
+                        placeholders[tone].warning(f"{tone_options[tone]} — unavailable right now.")
+            except QueueFull:
+                st.warning("🚦 REFRAME is very busy right now and your comparison couldn't be queued. Please try again in a few seconds!")
+            finally:
+                # Cancels any tone still in flight if we were interrupted
+                variants_stream.close()
+                status.empty()
+
+            if variants:
+                formatted_timestamp = datetime.now(UTC_TZ).strftime("%Y-%m-%d %H:%M:%S")
+                for tone in tone_options:
+                    if tone in variants:
+                        st.session_state.rewrites.insert(0, {"timestamp": formatted_timestamp, "tone": tone, "language": selected_language_key, "email": format_as_email, "original": user_input, "rewritten": variants[tone]})
             else:
-                rewritten = None
-                                           
-                with st.spinner(random.choice(loading_messages)):
-                    try:                   
-                        # This part of the code remains the same for defining system prompts
-                        if format_as_email:
-                            system_prompt = (
-                                f"You are a seasoned workplace communication expert. Your task is to transform a user's raw feedback into a professional and well-structured email. "
-                                f"The email is written by the user to a professional peer, manager, report, or team member. "
-                                f"Use a {selected_tone_key} tone: warm, constructive, and solution-oriented. "
-                                f"Write everything exclusively in perfect {selected_language_key}, using native greetings, expressions, and cultural norms without any English words."
-                                f"The email must have a clear subject line, a respectful greeting, a body that provides specific and actionable feedback, and a professional closing."
-                                f"The body of the email must be more than a simple sentence. It should provide a clear, positive context, explain the 'why' behind the feedback, and offer a forward-looking solution. "
-                                f"Never write from the perspective of the sender apologizing for their own mistake unless they are explicitly stating they made one. "
-                                f"Do not use any introductory conversational text like 'Here is the email:' before the email content. Start your response directly with the email's subject line."
-                                f"The goal is to help the recipient grow, kindly, clearly, and respectfully."
-                            )
-                        else:
-                            system_prompt = (
-                                f"You are a seasoned and empathetic communication coach for professionals. "
-                                f"Your task is to transform the user's raw feedback into a highly professional and constructive statement. "
-                                f"The feedback is from the user to a professional peer, manager, report, or team member, not a self-critique. Never, under any circumstances, generate an apology from the user's perspective unless they are explicitly stating they made one."
-                                f"Use a {selected_tone_key} tone and write exclusively in perfect {selected_language_key}. For non-English, use natural, culturally appropriate expressions without any English words."
-                                f"Respond in **exactly this format**:\n\n"
-                                f"The Reframe:\n"
-                                f"<Insert your full reframe here. Start with a positive or neutral observation, explain the impact, and suggest a collaborative path forward. Be specific and solution-focused.>\n\n"
-                                f"Bonus Tip:\n"
-                                f"<Insert a short, practical suggestion for how to deliver this feedback effectively — e.g., suggest a private 1:1, a specific opening line, or ideal timing. Keep it to **1–2 clear sentences**. Do not add fluff, disclaimers, or generic advice.>\n\n"
-                                f"Rules:\n\n"
-                                f"- Start with 'The Reframe:' on its own line.\n"
-                                f"- Put the reframe content on the next line — do not combine.\n"
-                                f"- After a blank line, write 'Bonus Tip:' on its own line.\n"
-                                f"- Write the tip content **below** 'Bonus Tip:', not on the same line.\n"
-                                f"- The tip must be 1–2 sentences. No more.\n"
-                                f"- Do not use markdown, quotes, asterisks, or formatting.\n"
-                                f"- Do not add greetings, closings, or explanations.\n\n"
-                                f"Example Output:\n"
-                                f"The Reframe:\n"
-                                f"I've noticed that sometimes in meetings, multiple people start speaking at once, which can make it hard to follow the discussion. To help us collaborate more effectively, it would be great if we could practice pausing briefly before responding. This small change can make a big difference in ensuring everyone feels heard.\n\n"
-                                f"Bonus Tip:\n"
-                                f"Bring this up in a private 1:1 and start with, 'I’ve been thinking about how we can make our meetings even better — would you be open to some feedback?'"
-                            )
-
-                        headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-                        data = {"messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_input}]}
-                        model_fallbacks = [                           
-                            "mistral/mistral-7b-instruct",
-                            "mistralai/mixtral-8x7b-instruct",
-                            "gryphe/mythomax-l2-13b",
-                            "openchat/openchat-7b"
-                            "qwen/qwen3-4b:free",
-                            "google/gemma-3n-e2b-it:free",
-                            "nousresearch/nous-capybara-7b",                            
-                            "mistralai/mistral-small-3.2-24b-instruct:free",                                                      
-                            "mistralai/devstral-small-2505:free",
-                            "z-ai/glm-4.5-air:free",                            
-                            "google/gemma-3n-e4b-it:free",
-                            "openrouter/gpt-oss-20b:free",
-                            "deepseek/deepseek-chat-v3-0324:free",
-                            "deepseek/deepseek-r1:free",
-                            "microsoft/mai-ds-r1:free",
-                            "tngtech/deepseek-r1t-chimera:free",
-                            "qwen/qwen3-coder:free",                           
-                            "qwen/qwen3-8b:free",
-                            "qwen/qwen3-14b:free",
-                            "qwen/qwen3-30b-a3b:free",
-                            "qwen/qwen3-235b-a22b:free",
-                            "moonshotai/kimi-k2:free",
-                            "sarvamai/sarvam-m:free",
-                            "meta-llama/llama-2-70b-chat"                                                       
-                        ]
-                                                  
-                        # Show a reassuring message to the user during the fallback process
-                        st.info("💡 Your message is being rephrased. We're experimenting with several models to find the ideal reframing for you, if it takes a moment!")
-                        
-                        for model in model_fallbacks:
-                            try:
-                                data["model"] = model
-                                resp = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data, timeout=30)
-                                
-                                # Check for insufficient credits
-                                if resp.status_code == 402:
-                                    logging.error("😐 The service is currently experiencing high demand and is unable to process your request. Please try again in a few moments!")
-                                # Check for general authentication errors
-                                elif resp.status_code == 401:
-                                    logging.error("⚠️ We're having trouble connecting to the service. Please try again in a few moments!")
-                                elif resp.status_code == 200:
-                                    #logging.info(f"Successfully called model: {model}")
-                                    j = resp.json()
-                                    rewritten = j.get("choices", [])[0].get("message", {}).get("content", "").strip()
-                                    if rewritten:
-                                        break # Break the loop if a successful response is received
-                                else:
-                                    logging.warning(f"API call to {model} failed with status code: {resp.status_code}")
-                                    time.sleep(0.5) # Wait before trying the next model
-                                    
-                            except requests.exceptions.RequestException:
-                                # Log the specific network error for debugging purposes
-                                logging.error(f"⚠️ It looks like we're having trouble connecting to the internet. Please check your connection and try again 🙂")
-                                time.sleep(0.5) # Wait before trying the next model
-                                pass # Continue to the next model in the fallback list
-                        
-                        if rewritten and user_input:
-                            st.session_state.rewritten_text = rewritten
-                            # Modified timestamp format
-                            formatted_timestamp = datetime.now(UTC_TZ).strftime("%Y-%m-%d %H:%M:%S")
-                            st.session_state.rewrites.insert(0, {"timestamp": formatted_timestamp, "original": user_input, "rewritten": rewritten})
-                        else:
-                            # If the loop finishes and no model succeeded, set the rewritten text to empty and show a clear error.
-                            st.error("⚠️ We were unable to reframe your message at the moment. Please try again 🙂")
-                            st.session_state.rewritten_text = ""
-
-                    except Exception as e:
-                        # A final catch-all for any other unexpected errors
-                        st.error(f"⚠️ An unexpected error occurred: {str(e)}. Please try again!")
-                        st.session_state.rewritten_text = ""
+                st.error("⚠️ We were unable to reframe your message at the moment. Please try again 🙂")
+            st.session_state.tone_variants = variants
+
+    elif st.session_state.get("tone_variants"):
+        st.markdown('<div class="step-pill">🎭 Your Message in Every Tone</div>', unsafe_allow_html=True)
+        for tone in tone_options:
+            if tone in st.session_state.tone_variants:
+                st.markdown(f"""<div class="result-box"><h4>{tone_options[tone]}</h4><p style="white-space: pre-wrap;">{html.escape(st.session_state.tone_variants[tone])}</p></div>""", unsafe_allow_html=True)
+        st.button("🧹 Hide Comparison", use_container_width=True, key="hide_compare_btn", on_click=set_state, kwargs={"tone_variants": {}})
 
 # ---------------------- CLEAN Results Section (NO ANIMATIONS) ----------------------
+rerun.mark("results")
 if st.session_state.rewritten_text and st.session_state.rewritten_text.strip():
     st.markdown('<div class="step-pill">🎉 Your Reframed Message is Ready!</div>', unsafe_allow_html=True)
     
     # Simple, clean result display without animations
-    st.markdown(f"""<div class="result-box"><h3>🎯 Your Words, Reimagined.</h3><p style="white-space: pre-wrap;">{st.session_state.rewritten_text}</p></div>""", unsafe_allow_html=True)
+    st.markdown(f"""<div class="result-box"><h3>🎯 Your Words, Reimagined.</h3><p style="white-space: pre-wrap;">{html.escape(st.session_state.rewritten_text)}</p></div>""", unsafe_allow_html=True)
+
+    for language, translated in st.session_state.get("translations", {}).items():
+        st.markdown(f"""<div class="result-box"><h4>{language_options[language]}</h4><p style="white-space: pre-wrap;">{html.escape(translated)}</p></div>""", unsafe_allow_html=True)
+
+    if st.session_state.get("similar_reuse"):
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.caption(f"♻️ Reused the rewrite of a near-identical message ({st.session_state.similar_reuse}% similar).")
+        with col2:
+            # The callback runs before the script, so the transform above picks it up in this same run
+            st.button("🔄 Rewrite from scratch", use_container_width=True, help="Ask the models for a fresh rewrite of your exact text", key="fresh_rewrite_btn",
+                      on_click=set_state, kwargs={"fresh_rewrite": True, "similar_reuse": 0})
     
     # Viral sharing section
     st.markdown(f"""
@@ -1054,13 +1284,9 @@ if st.session_state.rewritten_text and st.session_state.rewritten_text.strip():
             key="download_btn"
         )
     with col2:
-        if st.button("🎭 Try New Tone", use_container_width=True, help="Same message, different vibe", key="retry_btn"):
-            st.session_state.rewritten_text = ""
-            st.rerun()
+        st.button("🎭 Try New Tone", use_container_width=True, help="Same message, different vibe", key="retry_btn", on_click=set_state, kwargs={"rewritten_text": ""})
     with col3:
-        if st.button("🔥 Transform More", use_container_width=True, help="Start fresh with new feedback", key="new_btn"):
-            reset_app_state()
-            st.rerun()
+        st.button("🔥 Transform More", use_container_width=True, help="Start fresh with new feedback", key="new_btn", on_click=reset_app_state)
 
 # ---------------------- Call to Action for Empty State ----------------------
 else:
@@ -1074,6 +1300,7 @@ else:
     """, unsafe_allow_html=True)
 
 # ---------------------- Bottom Actions ----------------------
+rerun.mark("actions")
 st.markdown("---")
 st.markdown('<h3 style="text-align: center; color: #666; margin: 2rem 0;">🛠️ Explore More Features</h3>', unsafe_allow_html=True)
 
@@ -1082,95 +1309,77 @@ with col1:
     if st.button("⭐ Rate This Tool", use_container_width=True, help="Share your experience with REFRAME", key="feedback_toggle_btn"):
         st.session_state.show_feedback_form = not st.session_state.get("show_feedback_form", False)
         st.session_state.show_history = False
-        if not st.session_state.show_feedback_form:
-            st.rerun()
             
 with col2:
     if st.button("📊 My Transformations", use_container_width=True, help="View your communication evolution", key="history_toggle_btn"):
         st.session_state.show_history = not st.session_state.get("show_history", False)
         st.session_state.show_feedback_form = False
-        if not st.session_state.show_history:
-            st.rerun()
 
 # Enhanced Feedback Form
+rerun.mark("feedback")
+
+def submit_feedback():
+    """Store the form's answers and close it; as an on_click callback it runs before the script, so no rerun is needed."""
+    state = st.session_state
+    # Generate ID and public link
+    fb_id = str(int(time.time() * 1000))
+    public_base = st.secrets.get("PUBLIC_BASE_URL", "")
+    public_link = f"{public_base}?fb={fb_id}" if public_base else ""
+
+    # Prepare row for Google Sheets and CSV
+    # Modified timestamp format
+    timestamp = datetime.now(UTC_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    improvements_str = "; ".join(state.ff_improve) if state.ff_improve else ""
+    row = [
+        timestamp,
+        state.ff_rating,
+        state.ff_like,
+        improvements_str,
+        state.ff_suggestions,
+        state.ff_text,    # original input
+        "",               # rewritten (not used in feedback)
+        "",               # user_email
+        public_link
+    ]
+    # Names, emails and phone numbers never reach Sheets, the CSV or the shared archive
+    row = scrub_row(row)
+
+    # ✅ 1. Save to Google Sheets (primary)
+    ok, msg = append_row_to_sheet(row)
+
+    # ✅ 2. Always save to the local store as fallback
+    save_feedback_locally(row)
+    load_feedback_rows.clear()
+
+    # ✅ 3. Success
+    state.feedback_submitted = True
+    state.show_feedback_form = False
+
 if st.session_state.get("show_feedback_form", False):
     st.markdown("### 🌟 Help Make REFRAME Even Better!")
     st.markdown("*Your feedback helps thousands of professionals communicate better*")
 
     with st.form("feedback_form", clear_on_submit=True):
-        ff_text = st.text_area("💭 What's your experience with REFRAME?", height=100, placeholder="This tool saved me from so many awkward conversations...")
-        ff_rating = st.slider("⭐ Rate your experience", 1, 5, 4, help="1 = Needs work, 5 = Mind-blowing!")
-        ff_like = st.radio("🚀 Would you recommend REFRAME?", 
-                          ["👍 Absolutely! I'd recommend it", "🙂 Yes, with a few suggestions", 
-                           "😐 Neutral – it's okay", "👎 Not right now"], index=0)
-        ff_improve = st.multiselect("🎯 What should we enhance?", 
-                                   ["⚡ Speed", "🎯 Accuracy", "🌍 More Languages", 
-                                    "🎭 More Tones", "📱 Mobile Experience", "🎨 Interface Design", 
-                                    "📦 More Templates", "🔍 Context Awareness", "💡 Smarter Suggestions"])
-        ff_suggestions = st.text_area("💡 Any brilliant suggestions?", placeholder="What would make this tool irresistible?")
+        st.text_area("💭 What's your experience with REFRAME?", height=100, placeholder="This tool saved me from so many awkward conversations...", key="ff_text")
+        st.slider("⭐ Rate your experience", 1, 5, 4, help="1 = Needs work, 5 = Mind-blowing!", key="ff_rating")
+        st.radio("🚀 Would you recommend REFRAME?", 
+                 ["👍 Absolutely! I'd recommend it", "🙂 Yes, with a few suggestions", 
+                  "😐 Neutral – it's okay", "👎 Not right now"], index=0, key="ff_like")
+        st.multiselect("🎯 What should we enhance?", 
+                       ["⚡ Speed", "🎯 Accuracy", "🌍 More Languages", 
+                        "🎭 More Tones", "📱 Mobile Experience", "🎨 Interface Design", 
+                        "📦 More Templates", "🔍 Context Awareness", "💡 Smarter Suggestions"], key="ff_improve")
+        st.text_area("💡 Any brilliant suggestions?", placeholder="What would make this tool irresistible?", key="ff_suggestions")
         
         submit_col1, submit_col2, submit_col3 = st.columns([1, 0.2, 1])
         with submit_col1:
-            if st.form_submit_button("❌ Close", use_container_width=True):
-                st.session_state.show_feedback_form = False
-                st.rerun()
+            st.form_submit_button("❌ Close", use_container_width=True, on_click=set_state, kwargs={"show_feedback_form": False})
 
         with submit_col3:
-            submit_feedback = st.form_submit_button("🚀 Submit", use_container_width=True)
-        
-    if submit_feedback:
-        # Generate ID and public link
-        fb_id = str(int(time.time() * 1000))
-        public_base = st.secrets.get("PUBLIC_BASE_URL", "")
-        public_link = f"{public_base}?fb={fb_id}" if public_base else ""
-
-        # Prepare row for Google Sheets and CSV
-        # Modified timestamp format
-        timestamp = datetime.now(UTC_TZ).strftime("%Y-%m-%d %H:%M:%S")
-        improvements_str = "; ".join(ff_improve) if ff_improve else ""
-        row = [
-            timestamp,
-            ff_rating,
-            ff_like,
-            improvements_str,
-            ff_suggestions,
-            ff_text,          # original input
-            "",               # rewritten (not used in feedback)
-            "",               # user_email
-            public_link
-        ]
-
-        # ✅ 1. Save to Google Sheets (primary)
-        ok, msg = append_row_to_sheet(row)
-
-        # ✅ 2. Always save to local CSV as fallback
-        import os
-        import csv
-
-        csv_file = "feedback_local.csv"
-        file_exists = os.path.isfile(csv_file)
-
-        try:
-            with open(csv_file, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                # Write header if file is new
-                if not file_exists:
-                    writer.writerow([
-                        "timestamp", "rating", "like", "improvements", "suggestions",
-                        "original", "rewritten", "user_email", "public_link"
-                    ])
-                # Write the feedback row
-                writer.writerow(row)
-        except Exception as e:
-            # Log if needed, but don't break the flow
-            pass  # Silent fallback — CSV is best-effort
-
-        # ✅ 3. Success & Rerun
-        st.session_state.feedback_submitted = True
-        st.session_state.show_feedback_form = False
-        st.rerun()
+            st.form_submit_button("🚀 Submit", use_container_width=True, on_click=submit_feedback)
 
 # Enhanced History
+rerun.mark("history")
 if st.session_state.get("show_history", False):
     st.markdown("### 📊 Your Communication Evolution")
     st.markdown("*Track how you've transformed difficult conversations into professional dialogue*")
@@ -1185,23 +1394,38 @@ if st.session_state.get("show_history", False):
         """, unsafe_allow_html=True)
         
         # Display history
-        # Get last 10 rewrites (most recent first)
-        rewrites = st.session_state.rewrites[-10:] # Last 10
+        # Get last 10 rewrites (most recent first; new ones are inserted at the front)
+        rewrites = st.session_state.rewrites[:10]
         df = pd.DataFrame(rewrites)
         if 'timestamp' in df.columns:
             df['timestamp'] = pd.to_datetime(df['timestamp']).dt.strftime('%m/%d %H:%M')
         st.dataframe(df, use_container_width=True, hide_index=True)
         
+        # The export covers the whole history and is only built when the button is clicked
+        # (see history_export.py); the table above stays at ten rows.
+        export_formats = ["csv", "jsonl"]
+        if any(entry.get("email") for entry in st.session_state.rewrites):
+            export_formats.append("eml")
+        export_format = st.selectbox(
+            "Export format",
+            options=export_formats,
+            format_func=lambda x: {"csv": "CSV", "jsonl": "JSON Lines", "eml": "Emails (.eml, zipped)"}[x],
+            key="export_format"
+        )
+        export_mime, export_extension = EXPORT_FORMATS[export_format]
+
         col1, col2 = st.columns([1, 1])
         with col1:
-            csv = df.to_csv(index=False).encode('utf-8')
-            st.download_button("📊 Export My Data", data=csv, file_name=f"REFRAME_History_{datetime.now().strftime('%Y%m%d')}.csv", use_container_width=True, key="export_history_btn")
+            st.download_button(
+                "📊 Export My Data",
+                data=partial(spool_export, st.session_state.rewrites, export_format),
+                file_name=f"REFRAME_History_{datetime.now().strftime('%Y%m%d')}.{export_extension}",
+                mime=export_mime,
+                use_container_width=True,
+                key="export_history_btn"
+            )
         with col2:
-            if st.button("🗑️ Clear History", use_container_width=True, help="Start fresh", key="clear_history_btn"):
-                st.session_state.rewrites = []
-                st.success("History cleared!")
-                time.sleep(1)
-                st.rerun()
+            st.button("🗑️ Clear History", use_container_width=True, help="Start fresh", key="clear_history_btn", on_click=set_state, kwargs={"rewrites": []})
     else:
         st.markdown("""
         <div style="text-align: center; padding: 2rem; border-radius: 15px; border: 2px dashed #dee2e6;">
@@ -1211,41 +1435,40 @@ if st.session_state.get("show_history", False):
         """, unsafe_allow_html=True)
 
 # ---------------------- Public Feedback Viewer ----------------------
+# Rows are re-read from Sheets/CSV at most once a minute (and right after a submission),
+# and shared rather than copied per session; the process-wide index only takes in the
+# rows it has not seen (see feedback_search.py).
+FEEDBACK_RESULTS = 100
+
 def show_public_feedback():
-    rows = []
+    rows, note = load_feedback_rows()
+    if note:
+        st.write(note)
+    index = get_feedback_index()
+    index.sync(rows)
 
-    # Try Google Sheets first
-    try:
-        client = gs_client_from_secrets()
-        if client:
-            sh = client.open("reframe_app_feedback")
-            worksheet = sh.sheet1
-            sheet_data = worksheet.get_all_values()
-            if len(sheet_data) > 1:
-                rows = sheet_data[1:]  # skip header
-    except Exception as e:
-        st.write("🔍 Unable to open google feedback sheet — falling back to CSV.")
-        rows = []
+    # ✅ Check if we have any rows
+    if len(index):
+        st.markdown("### 🔍 What Others Are Saying")
 
-    # Fallback to local CSV — only if Google Sheets failed OR no rows
-    if not rows and os.path.isfile("feedback_local.csv"):
-        try:
-            with open("feedback_local.csv", newline='', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                header = next(reader, None)
-                file_rows = list(reader)
-                if file_rows:  # Only use if not empty
-                    rows = file_rows
-        except Exception as e:
-            st.write(f"🔍 CSV read failed: {e}")
-            rows = []
+        facets = index.facets()
+        search_col, rating_col = st.columns([2, 1])
+        with search_col:
+            query = st.text_input("🔎 Search feedback", placeholder="e.g. email, Japanese, speed", key="feedback_query")
+        with rating_col:
+            ratings = st.multiselect("⭐ Rating", options=list(facets["rating"]), format_func=lambda stars: f"{stars}⭐ ({facets['rating'][stars]})", key="feedback_ratings")
+        like_col, improve_col = st.columns(2)
+        with like_col:
+            likes = st.multiselect("🚀 Would recommend", options=list(facets["like"]), key="feedback_likes")
+        with improve_col:
+            improvements = st.multiselect("🎯 Asked to enhance", options=list(facets["improvements"]), key="feedback_improvements")
+
+        results = index.search(query, ratings=ratings, likes=likes, improvements=improvements, limit=FEEDBACK_RESULTS)
+        if not results:
+            st.info("No feedback matches that search yet — try fewer words or filters. 💌")
+            return
 
-    # ✅ Check if we have any rows
-    if rows:
-        df = pd.DataFrame(rows, columns=[
-            "timestamp", "rating", "like", "improvements", "suggestions",
-            "original", "rewritten", "user_email", "public_link"
-        ])
+        df = pd.DataFrame([row for row, _ in results], columns=FEEDBACK_COLUMNS)
 
         # Clean and convert
         df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
@@ -1256,10 +1479,9 @@ def show_public_feedback():
             st.info("No valid feedback found. Please share yours! 💌")
             return
 
-        # Sort: highest rating first, then newest
-        df = df.sort_values(by=['rating', 'timestamp'], ascending=[False, False]).reset_index(drop=True)
-
-        st.markdown("### 🔍 What Others Are Saying")
+        # Ranked by relevance when searching; otherwise highest rating first, then newest
+        df = df.reset_index(drop=True)
+        st.caption(f"Showing {len(df)} of {len(index)} reviews" + (" — best matches first" if query.strip() else ""))
 
         # Prepare display
         display_df = df[["timestamp", "original", "rating", "suggestions"]].copy()
@@ -1306,11 +1528,15 @@ def show_public_feedback():
         
 
 # Trigger Public Feedback Viewer
+rerun.mark("public_viewer")
 if st.button("💬 What Others Say", use_container_width=True, help="See real feedback from users like you"):
+    st.session_state.show_public_feedback = not st.session_state.get("show_public_feedback", False)
+if st.session_state.get("show_public_feedback", False):
     show_public_feedback()
 
 
 # ---------------------- FIXED FOOTER WITH PROPER HTML RENDERING ----------------------
+rerun.mark("footer")
 st.markdown("---")
 st.markdown("""
 <div class="creator-footer">
@@ -1324,4 +1550,22 @@ st.markdown("""
         </div>
     </div>
 </div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)
+# ---------------------- Rerun profile panel (profiling mode only) ----------------------
+last_run = rerun.finish()
+last_transform = profiling.close_run(st.session_state)
+if last_transform:
+    st.session_state.last_transform = last_transform
+session_bytes = session_monitor.checkpoint(st.session_state.app_session_id, st.session_state)
+if PROFILE_RERUNS and last_run:
+    with st.expander(f"⏱️ Rerun profile — this run {last_run['seconds'] * 1000:.0f} ms"):
+        st.caption(" · ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in last_run["sections"].items()))
+        slowest_sections = profiling.summary()["sections"]
+        if slowest_sections:
+            st.dataframe(pd.DataFrame(slowest_sections).set_index("section"), use_container_width=True)
+        if last_run["profile"]:
+            st.caption(f"Sampled profile written to {last_run['profile']}")
+        sessions = session_monitor.report()
+        if st.session_state.get("last_transform"):
+            st.caption(f"🔁 Last transform took {st.session_state.last_transform['reruns']} script runs, {st.session_state.last_transform['server_seconds'] * 1000:.0f} ms of server time")
+        st.caption(f"🧠 This session ~{session_bytes / 1024:.0f} KB · {sessions['sessions']} sessions ~{sessions['total_bytes'] / 1024:.0f} KB in total · {sessions['offloaded']} idle ones offloaded")
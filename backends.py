@@ -0,0 +1,209 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from response_parser import MalformedResponse, parse_response
+from rule_rewriter import rule_rewrite_formatted
+
+# ---------------------- Rewrite backends ----------------------
+# The model fallback chain (rewriter.call_model_fallbacks) is the normal path. A backend
+# is what rewriter.py tries when every model has failed: anything with a `name` and
+# rewrite(user_input, tone, language, format_as_email, system_prompt, deadline) returning
+# the rewrite in the app's output format, or None; it is passed as `fallback=`.
+# LocalBackend is the zero-network one: a warm worker process running a small llama.cpp
+# model when one is configured, or the rule-based engine otherwise.
+
+LOCAL_TIMEOUT_SECONDS = 10
+LOCAL_BATCH_SIZE = 16
+LOCAL_BATCH_WAIT_SECONDS = 0.005
+
+
+class RuleEngine:
+    name = "rules"
+
+    def rewrite(self, item: dict) -> str:
+        return rule_rewrite_formatted(item["user_input"], item["tone"], item["language"], item["format_as_email"])
+
+
+class LlamaEngine:
+    """Small quantized model through llama-cpp-python; falls back to rules on malformed output."""
+    name = "llama.cpp"
+
+    def __init__(self, model_path: str):
+        from llama_cpp import Llama
+
+        self.llm = Llama(model_path=model_path, n_ctx=2048, verbose=False)
+        self.rules = RuleEngine()
+
+    def rewrite(self, item: dict) -> str:
+        out = self.llm.create_chat_completion(
+            messages=[{"role": "system", "content": item["system_prompt"]}, {"role": "user", "content": item["user_input"]}],
+            max_tokens=400,
+            temperature=0.3,
+        )
+        content = (out["choices"][0]["message"].get("content") or "").strip()
+        try:
+            return parse_response(content, item["format_as_email"])["text"]
+        except MalformedResponse:
+            return self.rules.rewrite(item)
+
+
+def load_local_engine(model_path: str = ""):
+    if model_path:
+        try:
+            return LlamaEngine(model_path)
+        except Exception as e:
+            logging.warning(f"Local model unavailable ({e}); using the rule-based engine")
+    return RuleEngine()
+
+
+def serve_worker(model_path: str) -> None:
+    """Worker-process loop: one JSON list of requests per stdin line, one JSON list of results back.
+
+    The engine is loaded once at start-up and kept warm for the life of the process.
+    """
+    engine = load_local_engine(model_path)
+    for line in sys.stdin:
+        results = []
+        for item in json.loads(line):
+            try:
+                results.append(engine.rewrite(item))
+            except Exception as e:
+                logging.error(f"Local engine failed: {e}")
+                results.append(None)
+        sys.stdout.write(json.dumps(results) + "\n")
+        sys.stdout.flush()
+
+
+class LocalBackend:
+    """Batches requests to one warm worker process; answers within LOCAL_TIMEOUT_SECONDS, network-free.
+
+    The worker is a plain subprocess (`python backends.py --worker`) rather than a
+    multiprocessing pool, because spawning under Streamlit would re-execute app.py.
+    """
+    name = "local"
+
+    def __init__(self, model_path: str = "", batch_size: int = LOCAL_BATCH_SIZE, timeout: float = LOCAL_TIMEOUT_SECONDS):
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._inline = RuleEngine()
+        self._queue = queue.Queue()
+        self._proc = None
+        self._closed = False
+        # Start the worker now so the first real fallback does not pay for process start and model load.
+        self._start_worker()
+        threading.Thread(target=self._dispatch, name="local-backend", daemon=True).start()
+
+    def _start_worker(self):
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--model", self.model_path]
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding="utf-8", bufsize=1)
+
+    def _run_batch(self, items):
+        if self._proc is None or self._proc.poll() is not None:
+            self._start_worker()
+        proc = self._proc
+        # A wedged worker is killed (and restarted on the next batch) rather than blocking forever.
+        watchdog = threading.Timer(self.timeout * 2, proc.kill)
+        watchdog.start()
+        try:
+            proc.stdin.write(json.dumps(items) + "\n")
+            proc.stdin.flush()
+            line = proc.stdout.readline()
+        finally:
+            watchdog.cancel()
+        if not line:
+            raise RuntimeError("local worker exited")
+        return json.loads(line)
+
+    def _dispatch(self):
+        while not self._closed:
+            batch = [self._queue.get()]
+            # Collect whatever else arrives within a few milliseconds into the same batch.
+            deadline = time.monotonic() + LOCAL_BATCH_WAIT_SECONDS
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            items = [item for item, _ in batch]
+            try:
+                results = self._run_batch(items)
+            except Exception as e:
+                logging.error(f"Local backend worker failed: {e}")
+                results = [None] * len(items)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def submit(self, item: dict) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def rewrite(self, user_input, tone, language, format_as_email, system_prompt, deadline=None):
+        if deadline is not None and deadline.token.cancelled:
+            return None
+        item = {"user_input": user_input, "tone": tone, "language": language, "format_as_email": format_as_email, "system_prompt": system_prompt}
+        try:
+            result = self.submit(item).result(timeout=self.timeout)
+        except Exception:
+            result = None
+        # The worker is only an accelerator for the model path; rules keep the answer bounded.
+        return result or self._inline.rewrite(item)
+
+    def shutdown(self):
+        self._closed = True
+        if self._proc is not None:
+            self._proc.kill()
+
+
+# ---------------------- Offline benchmark ----------------------
+def benchmark(backend, requests_count: int = 500, concurrency: int = 8) -> dict:
+    """Drive `backend` with the viral samples and report latency percentiles and throughput."""
+    from concurrent.futures import ThreadPoolExecutor
+    from options import tone_options, language_options, viral_samples
+    from prompts import build_system_prompt
+
+    tones, languages = list(tone_options), list(language_options)
+    jobs = []
+    for i in range(requests_count):
+        tone, language, email = tones[i % len(tones)], languages[i % len(languages)], bool(i % 2)
+        jobs.append((viral_samples[i % len(viral_samples)], tone, language, email, build_system_prompt(tone, language, email)))
+
+    def run(job):
+        started = time.perf_counter()
+        backend.rewrite(*job)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(run, jobs))
+    elapsed = time.perf_counter() - started
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {"requests": requests_count, "throughput_rps": requests_count / elapsed, "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the local (zero-network) rewrite backend.")
+    parser.add_argument("--model", default=os.environ.get("LOCAL_MODEL_PATH", ""), help="GGUF model for llama.cpp; rules if empty")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.worker:
+        serve_worker(args.model)
+        raise SystemExit(0)
+
+    backend = LocalBackend(args.model)
+    backend.rewrite("warm up", "managerial", "English", False, "")
+    for key, value in benchmark(backend, args.requests, args.concurrency).items():
+        print(f"{key:>15}: {value:.2f}" if isinstance(value, float) else f"{key:>15}: {value}")
+    backend.shutdown()
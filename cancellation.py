@@ -0,0 +1,98 @@
+import threading
+import time
+
+# ---------------------- Deadlines & cancellation ----------------------
+# A CancelToken is owned by one Streamlit session and cancelled when that session
+# reruns into a new request or resets. A Deadline carries the overall time budget of
+# one rewrite plus the token, and is threaded through every attempt of the fallback
+# loop so no attempt outlives the request that started it.
+
+DEFAULT_BUDGET_SECONDS = 90
+MAX_ATTEMPT_SECONDS = 30
+MIN_ATTEMPT_SECONDS = 3
+# The remaining budget is shared as if only this many attempts were left, so early
+# (usually better) models get a generous slice while later ones still get a turn.
+ATTEMPT_SPREAD = 3
+
+
+class Cancelled(Exception):
+    """The work was abandoned because nobody is waiting for it any more."""
+
+
+class DeadlineExceeded(Cancelled):
+    """The request ran out of its overall time budget."""
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.reason = ""
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback):
+        """Run `callback` on cancellation (immediately if already cancelled). Returns an unregister function."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+
+                def unregister():
+                    with self._lock:
+                        if callback in self._callbacks:
+                            self._callbacks.remove(callback)
+                return unregister
+        callback()
+        return lambda: None
+
+    def wait(self, seconds: float) -> bool:
+        """Sleep up to `seconds`, waking early on cancellation. Returns True if cancelled."""
+        return self._event.wait(max(0.0, seconds))
+
+
+class Deadline:
+    def __init__(self, seconds: float = DEFAULT_BUDGET_SECONDS, token: CancelToken = None):
+        self.budget = seconds
+        self.token = token or CancelToken()
+        self._expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self._expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self) -> None:
+        """Raise if the request was cancelled or ran out of time."""
+        if self.token.cancelled:
+            raise Cancelled(self.token.reason)
+        if self.expired:
+            raise DeadlineExceeded(f"budget of {self.budget:.0f}s used up")
+
+    def attempt_timeout(self, attempts_left: int) -> float:
+        """Read timeout for the next attempt, carved out of the remaining budget."""
+        share = self.remaining() / max(1, min(attempts_left, ATTEMPT_SPREAD))
+        return min(MAX_ATTEMPT_SECONDS, self.remaining(), max(MIN_ATTEMPT_SECONDS, share))
+
+    def sleep(self, seconds: float) -> None:
+        """Back off between attempts without overrunning the deadline or ignoring cancellation."""
+        if seconds >= self.remaining():
+            return
+        self.token.wait(seconds)
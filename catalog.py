@@ -0,0 +1,209 @@
+import argparse
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from options import tone_options, language_options, viral_samples
+from prompts import build_system_prompt, prompt_fingerprint
+from rewriter import prompt_key, call_model_fallbacks
+
+# ---------------------- Precomputed rewrite catalog ----------------------
+# File layout (little endian):
+#   header  : magic "RFCT", u16 version, u32 entry count, 32-byte prompt fingerprint
+#   index   : `count` records of (16-byte key, u64 offset, u32 length), sorted by key
+#   payload : UTF-8 rewrites, addressed by the index
+# Keys are the first 16 bytes of rewriter.prompt_key(), so an edited prompt simply
+# stops matching instead of serving stale text.
+
+CATALOG_MAGIC = b"RFCT"
+CATALOG_VERSION = 1
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rewrite_catalog.bin")
+
+_HEADER = struct.Struct("<4sHI32s")
+_RECORD = struct.Struct("<16sQI")
+_RELOAD_CHECK_SECONDS = 30
+
+
+def catalog_combinations():
+    """Every (sample, tone, language, email) combination the sample button can produce."""
+    for sample in viral_samples:
+        for tone in tone_options:
+            for language in language_options:
+                for format_as_email in (False, True):
+                    yield sample, tone, language, format_as_email
+
+
+def write_catalog(path: str, entries: dict, fingerprint: str) -> None:
+    """Atomically write `entries` (prompt_key hex -> rewrite) to `path`."""
+    records = sorted((bytes.fromhex(key)[:16], text.encode("utf-8")) for key, text in entries.items())
+    payload_start = _HEADER.size + _RECORD.size * len(records)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(CATALOG_MAGIC, CATALOG_VERSION, len(records), bytes.fromhex(fingerprint)))
+        offset = payload_start
+        for key, blob in records:
+            f.write(_RECORD.pack(key, offset, len(blob)))
+            offset += len(blob)
+        for _, blob in records:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+
+class RewriteCatalog:
+    """Read-only, memory-mapped view of a catalog file. Lookups are a binary search over the index."""
+
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mm = None
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, fingerprint = _HEADER.unpack_from(mm, 0)
+        if magic != CATALOG_MAGIC or version != CATALOG_VERSION:
+            mm.close()
+            raise ValueError(f"Unsupported catalog file: {self.path}")
+        old = self._mm
+        self._mm, self.count, self.fingerprint = mm, count, fingerprint.hex()
+        self._mtime = os.stat(self.path).st_mtime
+        self._checked_at = time.monotonic()
+        if old is not None:
+            old.close()
+
+    def _maybe_reload(self):
+        # Pick up a catalog rewritten by the background refresh without restarting the app.
+        if time.monotonic() - self._checked_at < _RELOAD_CHECK_SECONDS:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            if os.stat(self.path).st_mtime != self._mtime:
+                self._open()
+        except (OSError, ValueError) as e:
+            logging.warning(f"Catalog reload failed: {e}")
+
+    def __len__(self):
+        return self.count
+
+    def is_stale(self) -> bool:
+        return self.fingerprint != prompt_fingerprint()
+
+    def get(self, key: str):
+        """Return the cached rewrite for a prompt_key() hex digest, or None."""
+        needle = bytes.fromhex(key)[:16]
+        with self._lock:
+            self._maybe_reload()
+            mm = self._mm
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                pos = _HEADER.size + mid * _RECORD.size
+                probe = mm[pos:pos + 16]
+                if probe < needle:
+                    lo = mid + 1
+                elif probe > needle:
+                    hi = mid
+                else:
+                    _, offset, length = _RECORD.unpack_from(mm, pos)
+                    return mm[offset:offset + length].decode("utf-8")
+        return None
+
+    def entries(self) -> dict:
+        """Load every entry as {16-byte key hex: text}; used when rebuilding incrementally."""
+        out = {}
+        with self._lock:
+            for i in range(self.count):
+                key, offset, length = _RECORD.unpack_from(self._mm, _HEADER.size + i * _RECORD.size)
+                out[key.hex()] = self._mm[offset:offset + length].decode("utf-8")
+        return out
+
+
+def load_catalog(path: str = CATALOG_PATH):
+    """Open the catalog if one has been built; a missing or unreadable file just disables it."""
+    if not os.path.isfile(path):
+        return None
+    try:
+        return RewriteCatalog(path)
+    except (OSError, ValueError, struct.error) as e:
+        logging.error(f"Could not open rewrite catalog {path}: {e}")
+        return None
+
+
+def build_catalog(path: str, api_key: str, workers: int = 4, rewrite_fn=call_model_fallbacks) -> int:
+    """Fill the catalog for every sample combination, reusing entries whose prompt is unchanged."""
+    existing = {}
+    old = load_catalog(path)
+    if old is not None:
+        existing = old.entries()
+
+    entries, todo = {}, []
+    for sample, tone, language, format_as_email in catalog_combinations():
+        system_prompt = build_system_prompt(tone, language, format_as_email)
+        key = prompt_key(system_prompt, sample)
+        if key[:32] in existing:
+            entries[key] = existing[key[:32]]
+        else:
+            todo.append((key, system_prompt, sample, language, format_as_email))
+
+    logging.info(f"Catalog build: {len(entries)} reused, {len(todo)} to generate")
+
+    def generate(job):
+        key, system_prompt, sample, language, format_as_email = job
+        return key, rewrite_fn(system_prompt, sample, api_key, format_as_email=format_as_email, language=language)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for key, text in pool.map(generate, todo):
+            if text:
+                entries[key] = text
+
+    write_catalog(path, entries, prompt_fingerprint())
+    return len(entries)
+
+
+_refresh_lock = threading.Lock()
+
+
+def start_background_refresh(path: str, api_key: str) -> bool:
+    """Regenerate a missing or stale catalog on a daemon thread. Returns True if a refresh was started."""
+    catalog = load_catalog(path)
+    if catalog is not None and not catalog.is_stale():
+        return False
+    if not _refresh_lock.acquire(blocking=False):
+        return False  # A refresh is already running in this process
+
+    def run():
+        try:
+            count = build_catalog(path, api_key, workers=2)
+            logging.info(f"Rewrite catalog refreshed with {count} entries")
+        except Exception as e:
+            logging.error(f"Rewrite catalog refresh failed: {e}")
+        finally:
+            _refresh_lock.release()
+
+    threading.Thread(target=run, name="catalog-refresh", daemon=True).start()
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build or inspect the precomputed rewrite catalog.")
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("--out", default=CATALOG_PATH)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        key = os.environ.get("OPENROUTER_API_KEY", "")
+        if not key:
+            raise SystemExit("Set OPENROUTER_API_KEY to build the catalog.")
+        print(f"Wrote {build_catalog(args.out, key, workers=args.workers)} entries to {args.out}")
+    else:
+        catalog = load_catalog(args.out)
+        if catalog is None:
+            raise SystemExit(f"No catalog at {args.out}")
+        print(f"{args.out}: {len(catalog)} entries, {'stale' if catalog.is_stale() else 'current'} prompts")
@@ -0,0 +1,193 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from accounting import is_cjk, estimate_tokens
+from cancellation import Deadline
+from pii import scrub
+from prompts import build_chunk_prompt
+from rewriter import REWRITE_CACHE, call_model_fallbacks, prompt_key
+from rule_rewriter import EMAIL_FRAME, rule_rewrite, rule_tip
+import metrics
+
+# ---------------------- Input measurement & long-document mode ----------------------
+# Inputs beyond LONG_DOCUMENT_TOKENS are split at paragraph, then sentence, then word
+# boundaries (a run with no spaces at all, such as CJK text, at a character count) into
+# chunks of at most CHUNK_TOKENS, rewritten concurrently (every call still goes through
+# the shared upstream rate limit) and stitched back in order. Only a small window of
+# chunks is in flight at once, so memory and per-call latency follow the chunk size
+# rather than the document size.
+
+MAX_INPUT_CHARS = 100_000
+LONG_DOCUMENT_TOKENS = 1_200
+CHUNK_TOKENS = 500
+CHUNK_WORKERS = 4
+
+SENTENCE_ENDS = ".!?。！？"
+
+
+def is_long_document(text: str) -> bool:
+    return estimate_tokens(text) > LONG_DOCUMENT_TOKENS
+
+
+def _split_sentences(paragraph: str):
+    start = 0
+    for i, ch in enumerate(paragraph):
+        if ch in SENTENCE_ENDS and (i + 1 == len(paragraph) or paragraph[i + 1].isspace() or is_cjk(ch)):
+            yield paragraph[start:i + 1].strip()
+            start = i + 1
+    tail = paragraph[start:].strip()
+    if tail:
+        yield tail
+
+
+def _split_chars(word: str, max_tokens: int):
+    """Hard split of a run without spaces (CJK text, a long URL) that alone is over budget."""
+    start = 0
+    cjk = other = 0
+    for i, ch in enumerate(word):
+        if is_cjk(ch):
+            cjk += 1
+        else:
+            other += 1
+        if cjk + (other + 3) // 4 > max_tokens:
+            yield word[start:i]
+            start = i
+            cjk, other = (1, 0) if is_cjk(ch) else (0, 1)
+    yield word[start:]
+
+
+def _split_words(sentence: str, max_tokens: int):
+    piece = []
+    size = 0
+    for word in sentence.split(" "):
+        cost = estimate_tokens(word) + 1
+        if cost > max_tokens:
+            if piece:
+                yield " ".join(piece)
+                piece, size = [], 0
+            yield from _split_chars(word, max_tokens)
+            continue
+        if piece and size + cost > max_tokens:
+            yield " ".join(piece)
+            piece, size = [], 0
+        piece.append(word)
+        size += cost
+    if piece:
+        yield " ".join(piece)
+
+
+def split_into_chunks(text: str, max_tokens: int = CHUNK_TOKENS):
+    """Split `text` into ordered chunks of at most ~max_tokens, preferring paragraph then sentence boundaries.
+
+    Each chunk keeps its own paragraph breaks; chunks are re-joined with a blank line.
+    """
+    chunks = []
+    current = []
+    size = 0
+
+    def flush():
+        nonlocal current, size
+        if current:
+            chunks.append("\n\n".join(current))
+        current, size = [], 0
+
+    for paragraph in text.replace("\r\n", "\n").split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        cost = estimate_tokens(paragraph)
+        if cost <= max_tokens:
+            if size + cost > max_tokens:
+                flush()
+            current.append(paragraph)
+            size += cost
+            continue
+
+        # Oversized paragraph: pack its sentences (or word runs) into chunks of their own.
+        flush()
+        sentences = []
+        for sentence in _split_sentences(paragraph):
+            if estimate_tokens(sentence) > max_tokens:
+                sentences.extend(_split_words(sentence, max_tokens))
+            else:
+                sentences.append(sentence)
+        piece, piece_size = [], 0
+        for sentence in sentences:
+            cost = estimate_tokens(sentence) + 1
+            if piece and piece_size + cost > max_tokens:
+                chunks.append(" ".join(piece))
+                piece, piece_size = [], 0
+            piece.append(sentence)
+            piece_size += cost
+        if piece:
+            chunks.append(" ".join(piece))
+    flush()
+    return chunks
+
+
+def _rewrite_chunk(chunk: str, tone: str, language: str, system_prompt: str, api_key: str, deadline: Deadline) -> str:
+    scrubbed = scrub(chunk)
+    key = prompt_key(system_prompt, scrubbed.text)
+    cached = REWRITE_CACHE.get(key)
+    if cached:
+        return scrubbed.restore(cached)
+    rewritten = call_model_fallbacks(system_prompt, scrubbed.text, api_key, deadline=deadline, language=language)
+    if rewritten:
+        REWRITE_CACHE.set(key, rewritten)
+        return scrubbed.restore(rewritten)
+    # Keep the document whole: a section no model could rewrite gets the rule-based pass.
+    metrics.incr("long_document.chunk_fallback")
+    return rule_rewrite(chunk, tone, language)
+
+
+def rewrite_long_document(text: str, tone: str, language: str, api_key: str, deadline: Deadline = None, heartbeat: float = None, workers: int = CHUNK_WORKERS, scheduler=None, session_id: str = ""):
+    """Rewrite a long document chunk by chunk, yielding (index, total, rewritten_chunk) strictly in order.
+
+    At most `workers * 2` chunks are submitted ahead of the next one to be yielded. With
+    `heartbeat`, (None, total, None) is yielded every `heartbeat` seconds while waiting.
+    Given a `scheduler`, chunks are queued as interactive jobs of `session_id`, so a long
+    document takes its fair turn with other sessions instead of using a private pool.
+    """
+    deadline = deadline or Deadline()
+    chunks = split_into_chunks(text)
+    total = len(chunks)
+    system_prompt = build_chunk_prompt(tone, language)
+    window = workers * 2
+
+    pool = None if scheduler is not None else ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk")
+    futures = {}
+    try:
+        submitted = 0
+        for index in range(total):
+            while submitted < total and submitted < index + window:
+                job_args = (chunks[submitted], tone, language, system_prompt, api_key, deadline)
+                if scheduler is not None:
+                    futures[submitted] = scheduler.run(_rewrite_chunk, *job_args, session_id=session_id, deadline=deadline)
+                else:
+                    futures[submitted] = pool.submit(_rewrite_chunk, *job_args)
+                submitted += 1
+            while True:
+                try:
+                    rewritten = futures[index].result(timeout=heartbeat)
+                    break
+                except FutureTimeout:
+                    yield None, total, None
+            del futures[index]
+            chunks[index] = None  # Release the source text as soon as its rewrite is out
+            yield index, total, rewritten
+    finally:
+        if futures:
+            deadline.token.cancel("long document abandoned")
+            logging.info(f"Long document abandoned with {len(futures)} chunks outstanding")
+        for future in futures.values():
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def frame_long_document(body: str, tone: str, language: str, format_as_email: bool) -> str:
+    """Give the stitched document the same outer structure a single rewrite would have."""
+    if format_as_email:
+        subject, greeting, closing = EMAIL_FRAME.get(language, EMAIL_FRAME["English"])
+        return f"{subject}\n\n{greeting}\n\n{body}\n\n{closing}"
+    return f"The Reframe:\n{body}\n\nBonus Tip:\n{rule_tip(tone, language)}"
@@ -0,0 +1,290 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+# ---------------------- Community feedback search ----------------------
+# An inverted index over the feedback rows' `original` and `suggestions` text, with facet
+# filters on `rating`, `like` and `improvements`, maintained incrementally: the feedback
+# store is append-only, so sync(rows) indexes only the rows past the ones already seen
+# (and rebuilds if the rows were replaced, e.g. a sheet edited by hand).
+#   terms       lowercased words; runs of CJK characters are indexed as character bigrams
+#   postings    term -> (row ids, term counts) as compact arrays, appended in row order, so
+#               they are always sorted and load into numpy with a single copy
+#   facets      value -> sorted row ids, the same way
+#   matching    every query term must match; the last one also matches as a prefix, so
+#               results follow the user's typing
+#   ranking     BM25 over both text fields; no query -> highest rating first, then newest
+# A search touches only its terms' postings and the selected facets, never every row:
+# the rarest term picks the candidates and the others are looked up by binary search.
+
+ORIGINAL_COLUMN = 5
+SUGGESTIONS_COLUMN = 4
+RATING_COLUMN = 1
+LIKE_COLUMN = 2
+IMPROVEMENTS_COLUMN = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+# A prefix expands to at most this many vocabulary terms (the most frequent ones).
+MAX_PREFIX_TERMS = 50
+
+_WORDS = re.compile(r"\w+")
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+
+
+def tokenize(text: str) -> list:
+    terms = []
+    for word in _WORDS.findall(text.lower()):
+        if _CJK.search(word) and len(word) > 1:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            terms.append(word)
+    return terms
+
+
+def _cell(row, column: int) -> str:
+    return str(row[column]) if len(row) > column and row[column] is not None else ""
+
+
+def _rating(row):
+    try:
+        rating = float(_cell(row, RATING_COLUMN))
+    except ValueError:
+        return None
+    return rating if 1 <= rating <= 5 else None
+
+
+def _numpy(values: array, dtype) -> np.ndarray:
+    # A copy: a live view would stop the array from growing when the next row arrives.
+    return np.frombuffer(values, dtype=dtype).copy() if len(values) else np.empty(0, dtype=dtype)
+
+
+def _ids(values: array) -> np.ndarray:
+    return _numpy(values, np.uint32)
+
+
+def _gather(values: array, ids: np.ndarray, dtype) -> np.ndarray:
+    # Fancy indexing copies, and the temporary view is gone before anything can append.
+    return np.frombuffer(values, dtype=dtype)[ids]
+
+
+def _keep(candidates: np.ndarray, sorted_ids: np.ndarray) -> np.ndarray:
+    """Mask of `candidates` that appear in `sorted_ids`."""
+    if not len(sorted_ids):
+        return np.zeros(len(candidates), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_ids, candidates), len(sorted_ids) - 1)
+    return sorted_ids[positions] == candidates
+
+
+def _allowed(candidates: np.ndarray, facet) -> np.ndarray:
+    """Mask of `candidates` in any of the facet's selected id arrays."""
+    mask = _keep(candidates, facet[0])
+    for ids in facet[1:]:
+        mask |= _keep(candidates, ids)
+    return mask
+
+
+def _best(ids: np.ndarray, scores: np.ndarray, limit: int) -> np.ndarray:
+    """Positions of the `limit` highest scores, newest (highest id) first among equals."""
+    if len(scores) > limit:
+        # Partition first so only the top scores (and anything tied with the last) get sorted.
+        cutoff = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        top = np.flatnonzero(scores >= cutoff)
+    else:
+        top = np.arange(len(scores))
+    return top[np.lexsort((-ids[top].astype(np.int64), -scores[top]))][:limit]
+
+
+class FeedbackIndex:
+    """Incrementally maintained search index over feedback rows (lists in FEEDBACK_COLUMNS order); thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.rows = []
+        self._first_row = None
+        # term -> (row ids "I", term counts "B")
+        self._postings = {}
+        self._lengths = array("I")
+        self._ratings = array("f")
+        self._total_length = 0
+        # facet value -> row ids; ratings are bucketed to whole stars
+        self._by_stars = {}
+        self._by_like = {}
+        self._by_improvement = {}
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def sync(self, rows) -> int:
+        """Index the rows not seen yet; returns how many were added."""
+        with self._lock:
+            if self.rows and (len(rows) < len(self.rows) or list(rows[0]) != self._first_row):
+                self._reset()
+            added = 0
+            for row in rows[len(self.rows):]:
+                self._add(row)
+                added += 1
+            if added:
+                self._vocabulary = None
+            return added
+
+    def add(self, row) -> None:
+        with self._lock:
+            self._add(row)
+            self._vocabulary = None
+
+    def _add(self, row) -> None:
+        row_id = len(self.rows)
+        if row_id == 0:
+            self._first_row = list(row)
+        self.rows.append(row)
+        rating = _rating(row)
+        self._ratings.append(rating or 0.0)
+        if rating is None:
+            # Unrated rows (header residue, hand edits) keep their number but are never shown.
+            self._lengths.append(0)
+            return
+        counts = {}
+        for term in tokenize(_cell(row, ORIGINAL_COLUMN) + "\n" + _cell(row, SUGGESTIONS_COLUMN)):
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array("I"), array("B"))
+            postings[0].append(row_id)
+            postings[1].append(min(count, 255))
+        length = sum(counts.values())
+        self._lengths.append(length)
+        self._total_length += length
+        self._by_stars.setdefault(int(round(rating)), array("I")).append(row_id)
+        like = _cell(row, LIKE_COLUMN).strip()
+        if like:
+            self._by_like.setdefault(like, array("I")).append(row_id)
+        for improvement in {part.strip() for part in _cell(row, IMPROVEMENTS_COLUMN).split(";")}:
+            if improvement:
+                self._by_improvement.setdefault(improvement, array("I")).append(row_id)
+
+    def facets(self) -> dict:
+        """{"rating": {stars: count}, "like": {value: count}, "improvements": {value: count}} for filter widgets."""
+        with self._lock:
+            return {
+                "rating": {stars: len(ids) for stars, ids in sorted(self._by_stars.items(), reverse=True)},
+                "like": {value: len(ids) for value, ids in self._by_like.items()},
+                "improvements": {value: len(ids) for value, ids in sorted(self._by_improvement.items(), key=lambda item: -len(item[1]))},
+            }
+
+    def search(self, query: str = "", ratings=None, likes=None, improvements=None, limit: int = 50) -> list:
+        """Best matching rows as (row, score) pairs, best first; facet arguments are collections of allowed values."""
+        with self._lock:
+            filters = self._filters(ratings, likes, improvements)
+            terms = tokenize(query)
+            if terms:
+                ids, scores = self._match(terms, query[-1:].isalnum(), filters)
+                order = _best(ids, scores, limit)
+            else:
+                ids = self._browse(filters, limit)
+                scores = np.zeros(len(ids))
+                order = _best(ids, _gather(self._ratings, ids, np.float32), limit)
+            return [(self.rows[int(ids[i])], float(scores[i])) for i in order]
+
+    def _filters(self, ratings, likes, improvements) -> list:
+        """Per facet in use, the sorted id arrays of its selected values (a row needs any one of them)."""
+        filters = []
+        for selected, groups in ((ratings, self._by_stars), (likes, self._by_like), (improvements, self._by_improvement)):
+            if selected:
+                filters.append([_ids(groups[value]) for value in selected if value in groups] or [np.empty(0, dtype=np.uint32)])
+        filters.sort(key=lambda facet: sum(map(len, facet)))
+        return filters
+
+    def _browse(self, filters, limit: int) -> np.ndarray:
+        """Enough rows passing the facets to fill `limit`: highest star bucket first, newest rows first."""
+        found = []
+        count = 0
+        for stars in sorted(self._by_stars, reverse=True):
+            bucket = self._by_stars[stars]
+            # Walk back from the newest rows in growing windows instead of filtering the whole bucket.
+            window = max(limit * 8, 1024)
+            end = len(bucket)
+            while end > 0 and count < limit:
+                start = max(0, end - window)
+                ids = _ids(bucket[start:end])
+                for facet in filters:
+                    ids = ids[_allowed(ids, facet)]
+                found.append(ids)
+                count += len(ids)
+                end, window = start, window * 4
+            if count >= limit:
+                break
+        return np.concatenate(found) if found else np.empty(0, dtype=np.uint32)
+
+    def _prefix_terms(self, prefix: str) -> list:
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        start = bisect_left(self._vocabulary, prefix)
+        terms = []
+        for term in self._vocabulary[start:]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        terms.sort(key=lambda t: -len(self._postings[t][0]))
+        return terms[:MAX_PREFIX_TERMS]
+
+    def _match(self, terms, last_is_prefix: bool, filters):
+        """(row ids, BM25 scores) of the rows matching every term and facet."""
+        # Each query term becomes a group of index terms: itself, or a prefix's expansions.
+        groups = [[term] for term in terms]
+        if last_is_prefix:
+            groups[-1] = self._prefix_terms(terms[-1]) or groups[-1]
+        groups = [[term for term in group if term in self._postings] for group in groups]
+        empty = np.empty(0, dtype=np.uint32), np.empty(0)
+        if any(not group for group in groups):
+            return empty
+        groups.sort(key=lambda group: sum(len(self._postings[term][0]) for term in group))
+        docs = len(self.rows)
+        average_length = self._total_length / docs if docs else 1.0
+
+        # The rarest group picks the candidates; facets and the other groups only narrow them.
+        ids, scores = self._group_scores(groups[0], None, docs, average_length)
+        for facet in filters:
+            mask = _allowed(ids, facet)
+            ids, scores = ids[mask], scores[mask]
+        for group in groups[1:]:
+            if not len(ids):
+                break
+            group_ids, group_scores = self._group_scores(group, ids, docs, average_length)
+            mask = _keep(ids, group_ids)
+            ids, scores = ids[mask], scores[mask] + group_scores
+        return ids, scores
+
+    def _group_scores(self, group, candidates, docs: int, average_length: float):
+        """Rows matching any term of `group` (only among sorted `candidates` if given), with summed BM25 scores."""
+        all_ids, all_scores = [], []
+        for term in group:
+            ids = _ids(self._postings[term][0])
+            counts = _numpy(self._postings[term][1], np.uint8)
+            idf = np.log(1 + (docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            if candidates is not None:
+                positions = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+                found = ids[positions] == candidates
+                ids, counts = candidates[found], counts[positions[found]]
+            counts = counts.astype(np.float64)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * _gather(self._lengths, ids, np.uint32) / average_length)
+            all_ids.append(ids)
+            all_scores.append(idf * counts * (BM25_K1 + 1) / (counts + norm))
+        if len(all_ids) == 1:
+            return all_ids[0], all_scores[0]
+        if sum(map(len, all_ids)) > docs // 4:
+            # Common prefixes: summing into a dense vector beats sorting the merged postings.
+            dense = np.zeros(docs)
+            for ids, scores in zip(all_ids, all_scores):
+                dense[ids] += scores
+            ids = np.flatnonzero(dense).astype(np.uint32)
+            return ids, dense[ids]
+        ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        return ids, np.bincount(inverse, weights=np.concatenate(all_scores), minlength=len(ids))
@@ -0,0 +1,178 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import accounting
+import metrics
+import rewriter
+from key_pool import as_pool
+from state_backend import SharedTokenBucket
+
+# ---------------------- Connection warm-up & model probes ----------------------
+# One background maintenance thread per process (app.py starts it once):
+#   warm-up  opens WARM_CONNECTIONS pooled connections to the OpenRouter host at startup,
+#            so the first user does not pay for DNS and TLS, and touches one every cycle
+#            so the pool does not go cold while the app is idle
+#   probes   sends a one-token completion to the fallback models, top of the chain first,
+#            re-probing each at most every PROBE_INTERVAL_SECONDS, and publishes liveness
+#            and latency to the shared state backend (rewriter.record_probe); the fallback
+#            chain then tries models last seen dead only after every other one
+# Probes cost tokens, so they draw from their own deployment-wide budget,
+# HEALTH_PROBES_PER_HOUR (0 turns probing off), shared by every replica. They never wait
+# for it, or for the upstream rate limit: users' requests go first. A refused key
+# (401/402/429) says nothing about the model, so such a probe is not recorded.
+
+HEALTH_PROBES_PER_HOUR = float(os.environ.get("HEALTH_PROBES_PER_HOUR", 60))
+HEALTH_PROBE_BURST = 8
+PROBE_INTERVAL_SECONDS = 300
+PROBE_TIMEOUT_SECONDS = 10
+CYCLE_SECONDS = 30
+WARM_CONNECTIONS = 4
+PROBE_MESSAGES = [{"role": "user", "content": "Reply with the single word OK."}]
+
+
+def warm_connections(count: int = WARM_CONNECTIONS, url: str = None) -> int:
+    """Open `count` pooled connections to the completions host in parallel; returns how many succeeded."""
+    url = url or rewriter.OPENROUTER_URL
+
+    def touch(_):
+        try:
+            # Any answer will do (HEAD on the completions URL is usually 404/405): the
+            # point is the TCP + TLS handshake, which leaves the connection in the pool.
+            rewriter.HTTP_SESSION.head(url, timeout=5).close()
+            return True
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Could not warm a connection to {url}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        return sum(pool.map(touch, range(count)))
+
+
+def probe_model(model: str, api_key) -> dict:
+    """Send one tiny completion to `model`; returns the published probe record, or {} if it was not run."""
+    keys = as_pool(api_key)
+    free_model = accounting.is_free_model(model)
+    key = keys.try_acquire(free_model)
+    if key is None:
+        return {}
+    status = None
+    started = time.monotonic()
+    try:
+        resp = rewriter.HTTP_SESSION.post(
+            rewriter.OPENROUTER_URL,
+            headers={"Authorization": f"Bearer {key.secret}", "Content-Type": "application/json"},
+            json={"model": model, "messages": PROBE_MESSAGES, "max_tokens": 1},
+            timeout=(5, PROBE_TIMEOUT_SECONDS),
+        )
+        status = resp.status_code
+        seconds = time.monotonic() - started
+        if status in (401, 402, 429):
+            keys.release(key, status, None, free_model)
+            key = None
+            return {}
+        alive = False
+        if status == 200:
+            body = resp.json()
+            alive = bool(body.get("choices"))
+            usage = body.get("usage") or {}
+            accounting.record_usage(body.get("model") or model, int(usage.get("prompt_tokens") or 10), int(usage.get("completion_tokens") or 1), seconds, not usage)
+        outcome = "ok" if alive else f"http_{status}"
+    except (requests.exceptions.RequestException, ValueError) as e:
+        seconds = time.monotonic() - started
+        alive, outcome = False, "timeout" if isinstance(e, requests.exceptions.Timeout) else "network"
+    finally:
+        if key is not None:
+            keys.release(key, status, None, free_model)
+    rewriter.record_probe(model, alive, seconds, outcome)
+    metrics.incr("health.probes.ok" if alive else "health.probes.dead")
+    if not alive:
+        logging.warning(f"Health probe: {model} looks dead ({outcome} after {seconds:.1f}s)")
+    return {"alive": alive, "seconds": seconds, "status": outcome}
+
+
+class HealthMonitor:
+    """Background warm-up and probe loop; `start()` once per process."""
+
+    def __init__(self, api_key, models=None, probes_per_hour: float = HEALTH_PROBES_PER_HOUR, cycle_seconds: float = CYCLE_SECONDS):
+        self.api_key = api_key
+        self.models = list(models or rewriter.MODEL_FALLBACKS)
+        self.cycle_seconds = cycle_seconds
+        self.budget = SharedTokenBucket("health_probes", probes_per_hour / 3600.0, HEALTH_PROBE_BURST) if probes_per_hour > 0 else None
+        self._stop = threading.Event()
+        self._thread = None
+        self.cycles = 0
+        self.probes = 0
+
+    def start(self) -> "HealthMonitor":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="model-health", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _loop(self):
+        warm_connections()
+        while not self._stop.is_set():
+            try:
+                self.run_cycle()
+            except Exception as e:
+                logging.warning(f"Health check cycle failed: {e}")
+            self._stop.wait(self.cycle_seconds)
+
+    def run_cycle(self) -> int:
+        """Keep one connection warm and probe the models that are due; returns the number probed."""
+        self.cycles += 1
+        if self.cycles > 1:
+            warm_connections(1)
+        if self.budget is None or not self.api_key:
+            return 0
+        liveness = rewriter.model_liveness(self.models)
+        now = time.time()
+        # Top of the chain first: those are the models users hit first.
+        due = [model for model in self.models if now - liveness.get(model, {}).get("ts", 0) >= PROBE_INTERVAL_SECONDS]
+        probed = 0
+        for model in due:
+            if self._stop.is_set() or not self.budget.try_acquire():
+                break
+            if not rewriter.UPSTREAM_RATE_LIMIT.try_acquire():
+                break
+            if probe_model(model, self.api_key):
+                probed += 1
+        self.probes += probed
+        return probed
+
+
+def start_health_monitor(api_key, models=None) -> HealthMonitor:
+    return HealthMonitor(api_key, models).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show (or refresh) the published model liveness.")
+    parser.add_argument("--probe", action="store_true", help="probe every model now (needs OPENROUTER_API_KEY)")
+    args = parser.parse_args()
+
+    if args.probe:
+        api_key = os.environ.get("OPENROUTER_API_KEY", "")
+        if not api_key:
+            raise SystemExit("Set OPENROUTER_API_KEY to probe")
+        print(f"warmed {warm_connections()} connections")
+        for model in rewriter.MODEL_FALLBACKS:
+            probe_model(model, api_key)
+    liveness = rewriter.model_liveness()
+    if not liveness:
+        raise SystemExit("No probe results published yet")
+    for model in rewriter.MODEL_FALLBACKS:
+        record = liveness.get(model)
+        if record:
+            age = time.time() - record["ts"]
+            print(f"{'alive' if record['alive'] else 'DEAD':<6} {record['seconds']:>6.2f}s  {record['status']:<10} {age:>5.0f}s ago  {model}")
+        else:
+            print(f"{'-':<6} {'':>7}  {'':<10} {'':>9}  {model}")
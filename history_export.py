@@ -0,0 +1,168 @@
+import argparse
+import csv
+import io
+import json
+import re
+import tempfile
+import zipfile
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+# ---------------------- History export ----------------------
+# "Export My Data" streams the whole history, entry by entry, in one of three formats:
+#   csv    one row per entry (EXPORT_COLUMNS)
+#   jsonl  one JSON object per line, same fields
+#   eml    a zip of .eml files, one per Email Mode rewrite: the subject comes from the
+#          "Subject:" first line, the rest is the body; other entries are left out
+# Each format is a generator of byte chunks holding one entry at a time, so memory does
+# not grow with the history (aside from the zip's central directory: zipfile keeps about
+# 1 KB per .eml file until the bundle is closed).
+# The app runs the export only when the download is clicked and writes it to an unbuffered
+# temporary file, which Streamlit reads once to serve.
+# `python history_export.py spill.json --format eml -o history.zip` exports an offloaded
+# session's history (see session_monitor.py).
+
+EXPORT_COLUMNS = ("timestamp", "tone", "language", "email", "original", "rewritten")
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "eml": ("application/zip", "zip"),
+}
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_SUBJECT = re.compile(r"\s*Subject:\s*(.*)", re.IGNORECASE)
+_UNSAFE = re.compile(r"[^\w-]+")
+
+
+def export_rows(entries):
+    """History entries as dicts with every EXPORT_COLUMNS field (older entries lack some)."""
+    for entry in entries:
+        row = {column: entry.get(column, "") for column in EXPORT_COLUMNS}
+        row["email"] = bool(entry.get("email"))
+        yield row
+
+
+def iter_csv(entries):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in export_rows(entries):
+        writer.writerow([row[column] for column in EXPORT_COLUMNS])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only (an empty history)
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def iter_jsonl(entries):
+    for row in export_rows(entries):
+        yield (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def split_email(text: str):
+    """(subject, body) of an Email Mode rewrite; the subject is "" if the first line has none."""
+    first, _, rest = text.strip().partition("\n")
+    match = _SUBJECT.fullmatch(first)
+    if match is None:
+        return "", text.strip()
+    return match.group(1).strip(), rest.strip()
+
+
+def to_eml(row: dict) -> bytes:
+    subject, body = split_email(row["rewritten"])
+    message = EmailMessage()
+    message["Subject"] = subject or "Reframed message"
+    try:
+        # History timestamps are UTC
+        message["Date"] = format_datetime(datetime.strptime(row["timestamp"], TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc))
+    except (TypeError, ValueError):
+        pass
+    if row["tone"]:
+        message["X-Reframe-Tone"] = row["tone"]
+    if row["language"]:
+        message["Content-Language"] = row["language"]
+    message.set_content(body + "\n")
+    return message.as_bytes()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable target: zipfile then streams (data descriptors, no seeking back)."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_eml_zip(entries):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+        count = 0
+        for row in export_rows(entries):
+            if not row["email"]:
+                continue
+            count += 1
+            subject, _ = split_email(row["rewritten"])
+            name = f"{count:04d}-{_UNSAFE.sub('-', subject.lower()).strip('-')[:50] or 'message'}.eml"
+            info = zipfile.ZipInfo(name, date_time=_zip_time(row["timestamp"]))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            bundle.writestr(info, to_eml(row))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _zip_time(timestamp: str):
+    try:
+        return datetime.strptime(timestamp, TIMESTAMP_FORMAT).timetuple()[:6]
+    except (TypeError, ValueError):
+        return (1980, 1, 1, 0, 0, 0)
+
+
+def iter_export(entries, fmt: str):
+    """Byte chunks of `entries` exported as `fmt` (a key of EXPORT_FORMATS)."""
+    if fmt == "csv":
+        return iter_csv(entries)
+    if fmt == "jsonl":
+        return iter_jsonl(entries)
+    if fmt == "eml":
+        return iter_eml_zip(entries)
+    raise ValueError(f"Unknown export format {fmt!r}")
+
+
+def spool_export(entries, fmt: str):
+    """The export in a temporary file (raw, unbuffered: the file type st.download_button accepts)."""
+    spool = tempfile.TemporaryFile(buffering=0)
+    for chunk in iter_export(entries, fmt):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export an offloaded session's history.")
+    parser.add_argument("spill", help="session spill file (SESSION_SPILL_DIR/<session>.json)")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    from text_codec import unpack
+
+    with open(args.spill, "rb") as f:
+        history = json.loads(unpack(f.read())).get("rewrites", [])
+    written = 0
+    with open(args.output, "wb") as out:
+        for chunk in iter_export(history, args.format):
+            written += out.write(chunk)
+    print(f"{len(history)} history entries -> {args.output} ({written:,} bytes)")
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+# ---------------------- OpenRouter API key pool ----------------------
+# Spreads upstream calls over several OpenRouter keys so one exhausted or rate-limited
+# key no longer degrades every session at once, and throughput ceilings add up per key.
+# Keys come from the OPENROUTER_API_KEYS secret (a TOML list, or a comma-separated
+# string); an entry may carry a weight as "sk-or-...*3" or {key = "sk-or-...", weight = 3}.
+# A single OPENROUTER_API_KEY still works: it is a pool of one.
+#   selection  least loaded by weight: the usable key with the fewest in-flight calls per
+#              unit of weight, ties going to the key with the fewest calls so far per
+#              unit of weight (so idle traffic rotates in proportion to the weights)
+#   401        key revoked or invalid: drained for REVOKED_COOLDOWN_SECONDS
+#   402        out of credits: paid models skip the key for NO_CREDITS_COOLDOWN_SECONDS,
+#              free models keep using it
+#   429        rate limited: the key rests for its Retry-After (or RATE_LIMIT_COOLDOWN_SECONDS)
+# Drained keys are restored automatically when their cooldown ends; each repeat failure
+# doubles the cooldown (up to MAX_COOLDOWN_SECONDS), a success resets it.
+# State is per process: replicas drain keys independently.
+
+REVOKED_COOLDOWN_SECONDS = float(os.environ.get("KEY_REVOKED_COOLDOWN", 600))
+NO_CREDITS_COOLDOWN_SECONDS = float(os.environ.get("KEY_NO_CREDITS_COOLDOWN", 300))
+RATE_LIMIT_COOLDOWN_SECONDS = 5.0
+MAX_COOLDOWN_SECONDS = 3600.0
+
+
+def mask(secret: str) -> str:
+    """A key as it may appear in logs and the UI."""
+    return f"…{secret[-4:]}" if len(secret) > 8 else "…"
+
+
+class PooledKey:
+    """One key's weight, usage and rate-limit state (guarded by the pool's lock)."""
+
+    def __init__(self, secret: str, weight: float = 1.0):
+        self.secret = secret
+        self.weight = max(weight, 0.01)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.disabled_until = 0.0
+        self.paid_disabled_until = 0.0
+        self.drained_reason = ""
+        self.strikes = 0
+
+    def usable(self, now: float, free_model: bool) -> bool:
+        return now >= self.disabled_until and (free_model or now >= self.paid_disabled_until)
+
+    @property
+    def label(self) -> str:
+        return mask(self.secret)
+
+
+def _parse_entry(entry):
+    if hasattr(entry, "get"):
+        return str(entry.get("key", "")).strip(), float(entry.get("weight", 1))
+    secret, _, weight = str(entry).strip().partition("*")
+    return secret.strip(), float(weight) if weight.strip() else 1.0
+
+
+class KeyPool:
+    """Thread-safe pool of OpenRouter keys; `acquire()` a key per attempt, `release()` it with the HTTP status."""
+
+    def __init__(self, keys):
+        self.keys = []
+        seen = set()
+        for entry in keys:
+            secret, weight = _parse_entry(entry)
+            if secret and secret not in seen:
+                seen.add(secret)
+                self.keys.append(PooledKey(secret, weight))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, value):
+        """A pool from a secret value: a list, a comma-separated string, or a single key."""
+        if not value:
+            return cls([])
+        if isinstance(value, str):
+            return cls(value.split(","))
+        return cls(list(value))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def try_acquire(self, free_model: bool = False):
+        """The least loaded usable key (marked in flight), or None if every key is drained right now."""
+        now = time.monotonic()
+        with self._lock:
+            usable = [key for key in self.keys if key.usable(now, free_model)]
+            if not usable:
+                return None
+            # Not (in_flight + 1) / weight: with nothing in flight that always picks the heaviest
+            # key, and sequential traffic would never rotate.
+            key = min(usable, key=lambda k: (k.in_flight / k.weight, k.requests / k.weight))
+            key.in_flight += 1
+            key.requests += 1
+            return key
+
+    def acquire(self, free_model: bool = False, timeout: float = None, cancelled=None):
+        """Like try_acquire, but waits for a resting key that is restored within `timeout` seconds.
+
+        Returns None at once when no key comes back in time (revoked or out-of-credits keys
+        usually don't), or when `cancelled()` turns true while waiting.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            key = self.try_acquire(free_model)
+            if key is not None:
+                return key
+            restored_at = self._next_restore(free_model)
+            if restored_at is None or (deadline is not None and restored_at > deadline):
+                return None
+            if cancelled is not None and cancelled():
+                return None
+            time.sleep(min(0.1, max(0.0, restored_at - time.monotonic())))
+
+    def _next_restore(self, free_model: bool):
+        with self._lock:
+            if not self.keys:
+                return None
+            return min(key.disabled_until if free_model else max(key.disabled_until, key.paid_disabled_until) for key in self.keys)
+
+    def release(self, key: PooledKey, status: int = None, retry_after: float = None, free_model: bool = False) -> None:
+        """Return `key` after an attempt; `status` is the HTTP status (None for a network error)."""
+        now = time.monotonic()
+        with self._lock:
+            key.in_flight -= 1
+            if status == 200:
+                key.strikes = 0
+                return
+            key.failures += 1
+            if status not in (401, 402, 429):
+                return
+            key.strikes += 1
+            backoff = 2 ** min(key.strikes - 1, 10)
+            if status == 401:
+                key.disabled_until = now + min(REVOKED_COOLDOWN_SECONDS * backoff, MAX_COOLDOWN_SECONDS)
+                key.drained_reason = "revoked"
+            elif status == 402 and free_model:
+                # Even free models are refused: nothing can use the key for now.
+                key.disabled_until = now + min(NO_CREDITS_COOLDOWN_SECONDS * backoff, MAX_COOLDOWN_SECONDS)
+                key.drained_reason = "out of credits"
+            elif status == 402:
+                key.paid_disabled_until = now + min(NO_CREDITS_COOLDOWN_SECONDS * backoff, MAX_COOLDOWN_SECONDS)
+                key.drained_reason = "out of credits"
+            else:
+                key.disabled_until = now + min(retry_after or RATE_LIMIT_COOLDOWN_SECONDS * backoff, MAX_COOLDOWN_SECONDS)
+                key.drained_reason = "rate limited"
+        metrics.incr(f"keys.drained.{status}")
+        logging.warning(f"OpenRouter key {key.label} {key.drained_reason} (HTTP {status}); resting it")
+
+    def has_usable(self, free_model: bool = False) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return any(key.usable(now, free_model) for key in self.keys)
+
+    def snapshot(self) -> list:
+        """Per-key state for status pages: label, weight, in flight, calls, failures, and seconds until restored."""
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                "key": key.label,
+                "weight": key.weight,
+                "in_flight": key.in_flight,
+                "requests": key.requests,
+                "failures": key.failures,
+                "drained": key.drained_reason if not key.usable(now, False) else "",
+                "restores_in": round(max(key.disabled_until, key.paid_disabled_until) - now, 1) if not key.usable(now, False) else 0.0,
+            } for key in self.keys]
+
+
+def as_pool(api_key) -> KeyPool:
+    """`api_key` as a KeyPool: pools pass through, a plain key becomes a one-key pool for this call."""
+    if isinstance(api_key, KeyPool):
+        return api_key
+    return KeyPool([api_key] if api_key else [])
@@ -0,0 +1,283 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+import rewriter
+from key_pool import KeyPool
+from cancellation import Deadline, DEFAULT_BUDGET_SECONDS
+from openrouter_stub import StubConfig, filler_text, start_stub
+from options import tone_options, language_options
+from rewrite_cache import RewriteCache
+from scheduler import QueueFull, Scheduler
+from similarity_index import SimilarityIndex
+from state_backend import SharedTokenBucket
+from traffic_recorder import load_records
+
+# ---------------------- Replay & load test ----------------------
+# Replays a TRAFFIC_LOG recording (see traffic_recorder.py) against openrouter_stub.py,
+# keeping its arrival times, sessions and request mix, compressed by --speed:
+#   python loadtest.py traffic.jsonl --speed 10             headless: rewrite_message via the Scheduler
+#   python loadtest.py traffic.jsonl --mode app             through app.py, one AppTest per recorded session
+#   python loadtest.py --synthetic 300 --rate 8             no recording yet: Poisson arrivals, sample mix
+# Recordings hold no text, so each request gets filler in its target language (the stub
+# cannot translate, and the quality gate rejects answers in the wrong language) at the
+# recorded length, unique per request so nothing is served from the rewrite caches.
+# The local fallback backend is left out: a request either gets a model answer or counts
+# as an error. The upstream rate limit is lifted unless --keep-rate-limit is given.
+# --keys N spreads the replay over N API keys; with --key-rps / --key-quota the stub
+# enforces per-key limits, showing how throughput scales with the key pool.
+
+REPORT_PERCENTILES = (50, 95, 99)
+
+
+def synthesize_input(record: dict, index: int) -> str:
+    """Filler text of the recorded length in the record's language; the leading tag keeps every request distinct."""
+    return filler_text(record.get("language", "English"), max(1, int(record.get("input_chars") or 80)), seed=index, tag=f"#{index}")
+
+
+def synthetic_records(count: int, rate: float, seed: int = 0) -> list:
+    """A recording-shaped request mix: Poisson arrivals at `rate`/s over a few dozen sessions."""
+    rng = random.Random(seed)
+    sessions = [f"synthetic-{i}" for i in range(max(1, count // 5))]
+    records = []
+    ts = 0.0
+    for _ in range(count):
+        ts += rng.expovariate(rate)
+        records.append({
+            "ts": ts,
+            "session": rng.choice(sessions),
+            "input_chars": int(rng.lognormvariate(5.3, 0.6)),
+            "tone": rng.choice(list(tone_options)),
+            "language": rng.choice(["English"] * 6 + list(language_options)),
+            "email": rng.random() < 0.3,
+            "seconds": 0.0,
+        })
+    return records
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+class LoadResult:
+    """Outcomes of one replay; thread-safe `add`, then `report()`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = Counter()
+        self.by_language = defaultdict(list)
+        self.transforms = []
+        self.started = time.monotonic()
+        self.finished = None
+
+    def add(self, outcome: str, seconds: float, language: str = "") -> None:
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if outcome == "ok":
+                self.latencies.append(seconds)
+                self.by_language[language].append(seconds)
+
+    def add_transform(self, record: dict) -> None:
+        """One completed transform's {"reruns", "server_seconds"} (app mode)."""
+        with self._lock:
+            self.transforms.append(record)
+
+    def report(self, records, speed: float = 1.0) -> dict:
+        wall = (self.finished or time.monotonic()) - self.started
+        span = (records[-1].get("ts", 0) - records[0].get("ts", 0)) / speed if len(records) > 1 else 0.0
+        latencies = sorted(self.latencies)
+        total = sum(self.outcomes.values())
+        recorded = sorted(r["seconds"] for r in records if r.get("seconds") and r.get("status", "ok") == "ok")
+        return {
+            "requests": total,
+            "wall_seconds": wall,
+            "offered_rps": len(records) / span if span else 0.0,
+            "throughput_rps": self.outcomes["ok"] / wall if wall else 0.0,
+            "error_rate": (total - self.outcomes["ok"]) / total if total else 0.0,
+            "outcomes": dict(self.outcomes),
+            "latency": {f"p{p}": percentile(latencies, p) for p in REPORT_PERCENTILES},
+            "recorded_latency": {f"p{p}": percentile(recorded, p) for p in REPORT_PERCENTILES},
+            "latency_by_language": {language: percentile(sorted(values), 50) for language, values in self.by_language.items()},
+            "reruns_per_transform": sum(t["reruns"] for t in self.transforms) / len(self.transforms) if self.transforms else 0.0,
+            "server_seconds_per_transform": sum(t["server_seconds"] for t in self.transforms) / len(self.transforms) if self.transforms else 0.0,
+        }
+
+
+def _pace(records, speed: float):
+    """Yield (index, record) at the recorded offsets divided by `speed`."""
+    first = records[0].get("ts", 0) if records else 0
+    started = time.monotonic()
+    for index, record in enumerate(records):
+        delay = (record.get("ts", first) - first) / speed - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+        yield index, record
+
+
+# ---------------------- Headless replay ----------------------
+def replay_headless(records, speed: float, workers: int, api_key: str, budget: float) -> LoadResult:
+    scheduler = Scheduler(workers=workers)
+    result = LoadResult()
+    futures = []
+
+    def timed(submitted, language, *args):
+        # Runs on the scheduler worker, so the latency includes the time spent queued.
+        try:
+            text = rewriter.rewrite_message(*args)
+        except Exception:
+            result.add("exception", time.monotonic() - submitted)
+            raise
+        result.add("ok" if text else "failed", time.monotonic() - submitted, language)
+        return text
+
+    for index, record in _pace(records, speed):
+        language = record.get("language", "English")
+        args = (synthesize_input(record, index), record.get("tone", "managerial"), language, bool(record.get("email")), api_key, None, Deadline(budget))
+        try:
+            futures.append(scheduler.run(timed, time.monotonic(), language, *args, session_id=record.get("session") or f"anon-{index}"))
+        except QueueFull:
+            result.add("rejected", 0.0)
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            pass
+    result.finished = time.monotonic()
+    return result
+
+
+# ---------------------- AppTest replay ----------------------
+# AppTest swaps process-wide globals (st.secrets, the runtime) for the length of a run,
+# so app-mode reruns happen one at a time: it measures the full per-request server path
+# (script rerun, widgets, scheduler, rewrite), while headless mode measures concurrency.
+def _new_session(app_path: str, api_keys):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(app_path, default_timeout=DEFAULT_BUDGET_SECONDS + 30)
+    at.secrets["OPENROUTER_API_KEYS"] = list(api_keys)
+    at.secrets["LOCAL_FALLBACK"] = "false"
+    return at.run()
+
+
+def _submit_through_app(at, record: dict, index: int) -> str:
+    """Type, choose and click like a user would; returns the outcome."""
+    # The input and the choices live in one form: nothing runs until the Reframe click.
+    at.text_area(key="user_input").set_value(synthesize_input(record, index))
+    at.selectbox(key="tone_selector").set_value(record.get("tone", "managerial"))
+    at.selectbox(key="language_selector").set_value(record.get("language", "English"))
+    at.checkbox(key="email_checkbox").set_value(bool(record.get("email")))
+    at.button(key="transform_btn").click().run()
+    if at.exception:
+        return "exception"
+    if any("busy" in warning.value for warning in at.warning):
+        return "rejected"
+    return "ok" if at.session_state.rewritten_text else "failed"
+
+
+def replay_app(records, speed: float, api_keys, app_path: str = "app.py") -> LoadResult:
+    # One AppTest per recorded session, so session state carries over like a real user's.
+    sessions = {}
+    result = LoadResult()
+    for index, record in _pace(records, speed):
+        session_id = record.get("session") or f"anon-{index}"
+        try:
+            if session_id not in sessions:
+                sessions[session_id] = _new_session(app_path, api_keys)
+            request_started = time.monotonic()
+            outcome = _submit_through_app(sessions[session_id], record, index)
+            if outcome == "ok":
+                result.add_transform(sessions[session_id].session_state["last_transform"])
+        except Exception:
+            outcome, request_started = "exception", time.monotonic()
+        result.add(outcome, time.monotonic() - request_started, record.get("language", ""))
+    result.finished = time.monotonic()
+    return result
+
+
+def run_loadtest(records, speed: float = 1.0, mode: str = "headless", workers: int = 16, url: str = "", config: StubConfig = None,
+                 keep_rate_limit: bool = False, budget: float = DEFAULT_BUDGET_SECONDS, app_path: str = "app.py", keys: int = 1) -> dict:
+    """Replay `records` against the stub (or `url`) and return the report dict."""
+    stub = None
+    if not url:
+        stub = start_stub(config=config or StubConfig())
+        url = stub.url
+    rewriter.OPENROUTER_URL = url
+    # A fresh namespace so earlier runs (or a shared backend) cannot serve cached answers.
+    rewriter.REWRITE_CACHE = RewriteCache(namespace=f"loadtest:{time.time_ns()}")
+    rewriter.SIMILAR_INPUTS = SimilarityIndex(threshold=rewriter.SIMILAR_INPUTS.threshold)
+    if not keep_rate_limit:
+        rewriter.UPSTREAM_RATE_LIMIT = SharedTokenBucket("loadtest", 1e6, 1e6)
+    api_keys = [f"stub-key-{i}" for i in range(max(1, keys))]
+    try:
+        if mode == "app":
+            result = replay_app(records, speed, api_keys, app_path)
+        else:
+            result = replay_headless(records, speed, workers, KeyPool(api_keys), budget)
+    finally:
+        if stub is not None:
+            stub.shutdown()
+    report = result.report(records, speed)
+    report["mode"] = mode
+    report["speed"] = speed
+    report["keys"] = len(api_keys)
+    if stub is not None:
+        report["stub"] = dict(stub.stats)
+        report["stub_keys"] = {key: stub.key_stats.get(key, {"ok": 0, "refused": {}}) for key in api_keys}
+    return report
+
+
+def print_report(report: dict) -> None:
+    print(f"mode {report['mode']}  speed {report['speed']}x  keys {report['keys']}  requests {report['requests']}  wall {report['wall_seconds']:.1f}s")
+    print(f"offered {report['offered_rps']:.2f} req/s  throughput {report['throughput_rps']:.2f} req/s  error rate {report['error_rate']:.1%}")
+    print("outcomes  " + "  ".join(f"{name} {count}" for name, count in sorted(report["outcomes"].items())))
+    print(f"{'':<10} " + " ".join(f"{name:>8}" for name in report["latency"]))
+    print(f"{'replay s':<10} " + " ".join(f"{value:>8.2f}" for value in report["latency"].values()))
+    if any(report["recorded_latency"].values()):
+        print(f"{'recorded s':<10} " + " ".join(f"{value:>8.2f}" for value in report["recorded_latency"].values()))
+    if report["reruns_per_transform"]:
+        print(f"script runs per transform {report['reruns_per_transform']:.1f}  server time per transform {report['server_seconds_per_transform']:.2f}s")
+    for key, stats in report.get("stub_keys", {}).items():
+        refused = "  ".join(f"{status} x{count}" for status, count in sorted(stats["refused"].items()))
+        print(f"  {key:<12} served {stats['ok']:>5}  {refused}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded traffic against the local OpenRouter stub.")
+    parser.add_argument("log", nargs="?", help="TRAFFIC_LOG file to replay")
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N", help="replay N synthetic requests instead of a log")
+    parser.add_argument("--rate", type=float, default=5.0, help="synthetic arrival rate (requests/s before --speed)")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay N times faster than recorded")
+    parser.add_argument("--limit", type=int, default=0, help="only replay the first N requests")
+    parser.add_argument("--mode", choices=("headless", "app"), default="headless")
+    parser.add_argument("--workers", type=int, default=16, help="scheduler workers (headless mode)")
+    parser.add_argument("--url", default="", help="completions URL of an already running stub")
+    parser.add_argument("--prefill-ms", type=float, default=0.5)
+    parser.add_argument("--decode-ms", type=float, default=4.0)
+    parser.add_argument("--keep-rate-limit", action="store_true", help="keep UPSTREAM_RPS/UPSTREAM_BURST in force")
+    parser.add_argument("--keys", type=int, default=1, help="API keys in the pool")
+    parser.add_argument("--key-rps", type=float, default=0, help="stub: requests per second per key (0 = unlimited)")
+    parser.add_argument("--key-quota", type=int, default=0, help="stub: requests per key before 402 (0 = unlimited)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        records = synthetic_records(args.synthetic, args.rate)
+    elif args.log:
+        records = load_records(args.log)
+    else:
+        parser.error("give a traffic log or --synthetic N")
+    if args.limit:
+        records = records[:args.limit]
+
+    config = StubConfig(args.prefill_ms, args.decode_ms, key_rps=args.key_rps, key_quota=args.key_quota)
+    report = run_loadtest(records, args.speed, args.mode, args.workers, args.url, config, args.keep_rate_limit, keys=args.keys)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,41 @@
+import threading
+from collections import defaultdict
+
+# ---------------------- Process-wide metrics ----------------------
+# Tiny in-process counters and timings. Everything is cumulative since process
+# start; snapshot() is what the app and offline tools read.
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_timings = {}
+
+
+def incr(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, seconds: float) -> None:
+    """Record one duration under `name` (count, total and max are kept)."""
+    with _lock:
+        stat = _timings.get(name)
+        if stat is None:
+            _timings[name] = {"count": 1, "total": seconds, "max": seconds}
+        else:
+            stat["count"] += 1
+            stat["total"] += seconds
+            stat["max"] = max(stat["max"], seconds)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "timings": {name: dict(stat) for name, stat in _timings.items()},
+        }
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -0,0 +1,280 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from accounting import estimate_tokens
+from options import language_options, viral_samples
+from prompts import STYLE_MARKER
+from quality_gate import CJK_SCRIPTS, LATIN_SAMPLES
+from rule_rewriter import LEXICON, TIPS, rule_rewrite_formatted
+
+# ---------------------- Local OpenRouter stand-in ----------------------
+# Speaks the subset of the chat completions API the app uses (SSE streaming, usage,
+# the served model) and answers with the rule-based rewriter, so latency and load
+# experiments need no network, key or credits:
+#   python openrouter_stub.py --port 8799
+#   OPENROUTER_URL=http://127.0.0.1:8799/api/v1/chat/completions streamlit run app.py
+# Latency is modelled as prefill + decode: every uncached prompt token costs
+# `prefill_ms` and every generated token `decode_ms`. Prompt prefixes are cached the
+# way providers do it: automatically for identical prefixes (auto_cache), or only the
+# parts marked with cache_control. Cached tokens prefill at CACHED_PREFILL_FACTOR.
+# Model names select behaviour: "...-down" answers 503, "...-broken" breaks the format.
+# Per-key quotas exercise the app's key pool: each bearer key may make `key_rps` requests
+# per second (429 with Retry-After beyond that) and `key_quota` requests in total (402
+# afterwards for paid models, as when credits run out); keys listed in `revoked_keys`
+# always get 401.
+# The stub cannot translate: translation requests get filler text in the target
+# language, of the same length and structure, which is all latency tests need.
+
+CACHED_PREFILL_FACTOR = 0.1
+PREFIX_CACHE_ENTRIES = 256
+TOKENS_PER_EVENT = 4
+
+
+class StubConfig:
+    def __init__(self, prefill_ms: float = 0.5, decode_ms: float = 4.0, base_ms: float = 20.0, auto_cache: bool = False,
+                 key_rps: float = 0, key_quota: int = 0, revoked_keys=()):
+        self.prefill_ms = prefill_ms
+        self.decode_ms = decode_ms
+        self.base_ms = base_ms
+        self.auto_cache = auto_cache
+        # 0 means unlimited.
+        self.key_rps = key_rps
+        self.key_quota = key_quota
+        self.revoked_keys = set(revoked_keys)
+
+
+class PrefixCache:
+    """LRU of prompt-prefix hashes the stub has already 'prefilled'."""
+
+    def __init__(self, max_entries: int = PREFIX_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, text: str) -> bool:
+        key = hashlib.sha256(text.encode("utf-8")).digest()
+        with self._lock:
+            hit = key in self._seen
+            self._seen[key] = True
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return hit
+
+
+def _text_parts(message: dict):
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return [(content, False)]
+    return [(part.get("text", ""), "cache_control" in part) for part in content]
+
+
+def _cacheable_prefix(messages, auto_cache: bool) -> str:
+    """The leading text a provider would serve from its prompt cache."""
+    system = _text_parts(messages[0]) if messages else []
+    marked = "".join(text for text, cached in system if cached)
+    if marked:
+        return marked
+    if auto_cache and system:
+        # Automatic caching works on the longest previously seen prefix; the system
+        # prompt's static part (everything before the style suffix) is what repeats.
+        text = system[0][0]
+        return text.partition(STYLE_MARKER)[0] if STYLE_MARKER in text else ""
+    return ""
+
+
+def _filler_pieces(language: str):
+    """(pieces, separator) to build filler text in `language` from."""
+    if language in CJK_SCRIPTS:
+        return list(LEXICON.get(language, {})) + list(TIPS[language].values()), ""
+    if language in LATIN_SAMPLES:
+        return LATIN_SAMPLES[language].split(), " "
+    return " ".join(viral_samples).split(), " "
+
+
+_FILLER = {language: _filler_pieces(language) for language in language_options}
+
+
+def filler_text(language: str, chars: int, seed: int = 0, tag: str = "") -> str:
+    """Deterministic workplace-sounding text of about `chars` characters in `language`."""
+    rng = random.Random(seed)
+    pieces, separator = _FILLER.get(language, _FILLER["English"])
+    parts = [tag] if tag else []
+    length = len(tag)
+    while length < chars:
+        piece = rng.choice(pieces)
+        parts.append(piece)
+        length += len(piece) + len(separator)
+    return separator.join(parts)[:max(1, chars)]
+
+
+def _style(system_text: str):
+    tone = re.search(r"Tone: (\w+)", system_text)
+    language = re.search(r"perfect (\w+)", system_text)
+    return (tone.group(1) if tone else "managerial"), (language.group(1) if language else "English")
+
+
+def _completion(model: str, messages) -> str:
+    system_text = "".join(text for text, _ in _text_parts(messages[0])) if messages else ""
+    user_text = "".join(text for text, _ in _text_parts(messages[-1])) if messages else ""
+    tone, language = _style(system_text)
+    is_email = "email" in system_text.lower()
+    if "translator" in system_text:
+        user_text = filler_text(language, len(user_text), seed=len(user_text))
+    text = rule_rewrite_formatted(user_text, tone, language, is_email)
+    if model.endswith("-broken"):
+        return "Sure! Here is a friendlier version of your message:\n" + text
+    return text
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = body.get("model", "")
+        messages = body.get("messages") or []
+        status = server.admit(self, model)
+        if status != 200:
+            self._send_json(status, {"error": {"code": status, "message": "stub refused the request"}}, {"Retry-After": "1"} if status == 429 else None)
+            return
+
+        config = server.config
+        prompt_tokens = sum(estimate_tokens(text) for message in messages for text, _ in _text_parts(message))
+        prefix = _cacheable_prefix(messages, config.auto_cache)
+        cached_tokens = estimate_tokens(prefix) if prefix and server.prefix_cache.check_and_add(prefix) else 0
+        prefill_ms = (prompt_tokens - cached_tokens) * config.prefill_ms + cached_tokens * config.prefill_ms * CACHED_PREFILL_FACTOR
+        time.sleep((config.base_ms + prefill_ms) / 1000)
+
+        text = _completion(model, messages)
+        completion_tokens = estimate_tokens(text)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        server.record(prompt_tokens, cached_tokens, completion_tokens)
+
+        if not body.get("stream"):
+            time.sleep(completion_tokens * config.decode_ms / 1000)
+            self._send_json(200, {"model": model, "choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        step = TOKENS_PER_EVENT * 4
+        self._chunk(b": OPENROUTER PROCESSING\n\n")
+        for i in range(0, len(text), step):
+            time.sleep(TOKENS_PER_EVENT * config.decode_ms / 1000)
+            event = {"model": model, "choices": [{"delta": {"content": text[i:i + step]}}]}
+            self._chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        if (body.get("usage") or {}).get("include"):
+            self._chunk(f"data: {json.dumps({'model': model, 'choices': [{'delta': {}}], 'usage': usage})}\n\n".encode("utf-8"))
+        self._chunk(b"data: [DONE]\n\n")
+        self._chunk(b"")
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class OpenRouterStub(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, config: StubConfig = None):
+        super().__init__(address, StubHandler)
+        self.config = config or StubConfig()
+        self.prefix_cache = PrefixCache()
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        # bearer key -> {"ok": served, "refused": {status: count}} and its request times this second
+        self.key_stats = {}
+        self._key_window = {}
+
+    def handle_error(self, request, client_address):
+        # Clients abandoning a stream (cancellation, malformed-output checks) are expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/v1/chat/completions"
+
+    def admit(self, handler, model: str) -> int:
+        """HTTP status for this request before any work is done (200 to serve it)."""
+        if model.endswith("-down"):
+            return 503
+        key = handler.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        config = self.config
+        now = time.monotonic()
+        with self._lock:
+            stats = self.key_stats.setdefault(key, {"ok": 0, "refused": {}})
+            window = self._key_window.setdefault(key, [])
+            window[:] = [t for t in window if now - t < 1.0]
+            if key in config.revoked_keys:
+                status = 401
+            elif config.key_quota and stats["ok"] >= config.key_quota and not model.endswith(":free"):
+                status = 402
+            elif config.key_rps and len(window) >= config.key_rps:
+                status = 429
+            else:
+                window.append(now)
+                stats["ok"] += 1
+                return 200
+            stats["refused"][status] = stats["refused"].get(status, 0) + 1
+            return status
+
+    def record(self, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached_tokens
+            self.stats["completion_tokens"] += completion_tokens
+
+
+def start_stub(port: int = 0, config: StubConfig = None, host: str = "127.0.0.1") -> OpenRouterStub:
+    """Start the stub on a background thread (port 0 picks a free one); see `.url` and `.shutdown()`."""
+    server = OpenRouterStub((host, port), config)
+    threading.Thread(target=server.serve_forever, name="openrouter-stub", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenRouter stand-in answering with the rule-based rewriter.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="milliseconds per uncached prompt token")
+    parser.add_argument("--decode-ms", type=float, default=4.0, help="milliseconds per generated token")
+    parser.add_argument("--auto-cache", action="store_true", help="cache identical prompt prefixes without cache_control")
+    parser.add_argument("--key-rps", type=float, default=0, help="requests per second allowed per API key (0 = unlimited)")
+    parser.add_argument("--key-quota", type=int, default=0, help="requests each API key may make before it gets 402 (0 = unlimited)")
+    parser.add_argument("--revoked-key", action="append", default=[], help="API key to answer with 401 (repeatable)")
+    args = parser.parse_args()
+
+    config = StubConfig(args.prefill_ms, args.decode_ms, auto_cache=args.auto_cache, key_rps=args.key_rps, key_quota=args.key_quota, revoked_keys=args.revoked_key)
+    server = OpenRouterStub((args.host, args.port), config)
+    print(f"OpenRouter stub listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,79 @@
+# ---------------------- Tone & Language Options ----------------------
+tone_options = {
+    "managerial": "🧭 Managerial - Balanced Leadership",
+    "empathetic": "💖 Empathetic - Caring & Supportive", 
+    "formal": "🧾 Formal - Corporate Professional",
+    "friendly": "😊 Friendly - Warm & Approachable",
+    "assertive": "💼 Assertive - Direct & Confident"
+}
+
+language_options = {
+    "English": "🇺🇸 English",
+    "Spanish": "🇪🇸 Español", 
+    "French": "🇫🇷 Français",
+    "German": "🇩🇪 Deutsch",
+    "Italian": "🇮🇹 Italiano",
+    "Portuguese": "🇵🇹 Português",
+    "Japanese": "🇯🇵 日本語",
+    "Korean": "🇰🇷 한국어",
+    "Chinese": "🇨🇳 中文"
+}
+
+# ---------------------- VIRAL SAMPLE TEXTS ----------------------
+viral_samples = [
+    "You never listen in meetings and always interrupt others. It's really annoying.",
+    "Your code is always buggy and creates more work for everyone else.",
+    "You're constantly late to everything and it shows you don't respect our time.",
+    "Your presentations are boring and put everyone to sleep.",
+    "You take credit for other people's work and it's not fair.",
+    "You're always on your phone during important discussions.",
+    "Your emails are confusing and no one understands what you want.",
+    "You never help your teammates and only care about yourself.",
+    "Why did you refactor working code that wasn’t even assigned to you?",
+    "The project is way behind schedule because you didn't deliver your part on time.",
+    "I disagree with your proposal, it's just not going to work.",
+    "You're not a good fit for this team, your personality clashes with everyone.",
+    "This report is useless. The data is all wrong and the conclusions don't make sense.",
+    "You need to be more proactive. I shouldn't have to follow up with you all the time.",
+    "I'm not happy with your performance. You've been making a lot of simple mistakes lately.",
+    "We trust you to manage your time — but you must be online from 9–5.",
+    "We need to let you go. This role is no longer a good fit for the company's direction.",
+    "You are not meeting the performance expectations of your role. There's been no improvement since our last talk.",
+    "Your behavior in meetings is unprofessional and is making your colleagues uncomfortable.",
+    "You've been out of compliance with company policy regarding expense reports for three months.",
+    "The last employee survey showed a high level of dissatisfaction with your department's leadership.",
+    "You missed the sprint deadline again. This is impacting the entire team's velocity.",
+    "Your user stories are consistently incomplete at the end of the sprint.",
+    "You're not actively participating in our daily stand-ups and that's not what Scrum is about.",
+    "Your task estimates are consistently inaccurate, making sprint planning impossible.",
+    "You are not updating your tasks on the board, which makes it hard for the team to see what's a blocker.",
+    "You're not responding to emails, only DMs and texts. That's not how we do professional communication here.",
+    "Per my last email: I told you twice already.",
+    "We value feedback — but don’t question leadership decisions.",
+    "You committed directly to main again. We have a branch policy for a reason.",
+    "Thanks for working weekends! We’ll 'keep it in mind during reviews'.",
+    "You said the work was 'cringe' and not a good use of your time. This is part of the job.",
+    "The way you handled that disagreement on LinkedIn violated our social media policy.",
+    "You completely ignored the formal process for requesting time off and just messaged me directly.",
+    "You're constantly missing team meetings or leaving early without warning. It's unprofessional.",
+    "You haven't completed the mandatory compliance training, which is putting the team at risk.",
+    "You've been taking days off without formally applying for leave through the HR system.",
+    "You were out on long-term leave for a week and I had no idea until a colleague told me.",
+    "Your promotion to Senior Developer is effective next Monday. Congrats.",
+    "We expect you to be available after hours during 'critical releases'.",
+    "I'm giving you a promotion. It comes with more responsibilities so get ready.",
+    "We decided to promote you. You'll have a new title and salary.",
+    "It's your fifth anniversary. Keep up the good work.",
+    "Congrats on ten years. Your team couldn't have done it without you.",
+    "Your salary increase request cannot be approved at this time. We need to stick to the budget.",
+    "Your performance is below expectations. I need you to show more initiative and ownership.",
+    "We're making changes and your position is being eliminated. We have to let you go.",
+    "The feedback we've received indicates that you are not a team player.",
+    "I’m resigning — not because of the pay, but because I’m doing 3 people’s jobs.",
+    "Your current work is not meeting the quality standards we expect from a senior role.",
+    "I'm resigning because I was promised growth but got stuck doing the same thing for a year.",
+    "It's time for me to leave — I can't keep covering for your poor management.",
+    "I'm stepping down because the team culture feels toxic and no one holds themselves accountable.",
+    "I'm out — I gave my best, but my efforts were never recognized.",
+    "I'm leaving because I found a place that values work-life balance — something we clearly don’t have here."
+]
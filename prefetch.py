@@ -0,0 +1,79 @@
+import logging
+import threading
+
+from cancellation import CancelToken, Deadline
+from rate_limit import TokenBucket
+from rewriter import rewrite_message, is_cached
+from scheduler import PREFETCH, QueueFull, RewriteJob, Scheduler
+
+# ---------------------- Speculative prefetch ----------------------
+# After a successful rewrite the next click is usually "Try New Tone" or toggling
+# Email Mode. The prefetcher warms the rewrite cache for those combinations in the
+# scheduler's PREFETCH class, within its own upstream budget, and cancels work for any
+# session whose input has changed since the prefetch was scheduled.
+
+PREFETCH_PER_RESULT = 3
+PREFETCH_BUDGET_SECONDS = 45
+
+
+def likely_next_choices(tone: str, language: str, format_as_email: bool, tones, limit: int = PREFETCH_PER_RESULT):
+    """Most likely next (tone, language, email) choices after a result, best first."""
+    choices = [(tone, language, not format_as_email)]
+    choices += [(t, language, format_as_email) for t in tones if t != tone]
+    return choices[:limit]
+
+
+class Prefetcher:
+    """Schedules background rewrites that only populate the cache; results are never shown directly."""
+
+    def __init__(self, rate_per_minute: float = 20, burst: int = 6, scheduler: Scheduler = None):
+        self.budget = TokenBucket(rate_per_minute / 60.0, burst)
+        self.scheduler = scheduler or Scheduler(workers=2)
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.skipped = 0
+
+    def cancel(self, session_id: str) -> None:
+        """Drop queued prefetches for a session and abort its in-flight ones (e.g. the user edited the input)."""
+        with self._lock:
+            token = self._tokens.pop(session_id, None)
+        if token is not None:
+            token.cancel("input changed")
+
+    def schedule(self, session_id: str, user_input: str, choices, api_key: str, catalog=None) -> int:
+        """Queue prefetches for `choices`; returns how many were queued."""
+        self.cancel(session_id)
+        token = CancelToken()
+        with self._lock:
+            self._tokens[session_id] = token
+
+        queued = 0
+        for tone, language, format_as_email in choices:
+            if is_cached(user_input, tone, language, format_as_email, catalog):
+                continue
+            deadline = Deadline(PREFETCH_BUDGET_SECONDS, token)
+            job = RewriteJob(self._run, (deadline, user_input, tone, language, format_as_email, api_key, catalog), session_id=session_id, priority=PREFETCH, deadline=deadline)
+            try:
+                self.scheduler.submit(job)
+            except QueueFull:
+                # Busy: speculative work is the first thing to give up.
+                with self._lock:
+                    self.skipped += 1
+                break
+            queued += 1
+        return queued
+
+    def _run(self, deadline, user_input, tone, language, format_as_email, api_key, catalog):
+        # Re-check right before spending upstream budget: the user may have moved on.
+        if deadline.token.cancelled or not self.budget.try_acquire():
+            with self._lock:
+                self.skipped += 1
+            return
+        try:
+            rewrite_message(user_input, tone, language, format_as_email, api_key, catalog, deadline)
+            # Workers finish concurrently, and += on an attribute is not atomic
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            logging.warning(f"Prefetch for {tone}/{language} failed: {e}")
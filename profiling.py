@@ -0,0 +1,327 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+
+import metrics
+
+# ---------------------- Rerun profiling (opt-in) ----------------------
+# With PROFILE_RERUNS=1 (or the PROFILE_RERUNS secret), every app.py script run is timed
+# section by section: app.py calls rerun.mark("input"), rerun.mark("results"), ... and
+# each mark closes the previous section. While a run is active, one shared sampler thread
+# also records the script thread's Python stack every SAMPLE_INTERVAL_SECONDS; runs slower
+# than SLOW_RERUN_SECONDS keep those samples as a collapsed-stack file (one "a;b;c count"
+# line per stack, the input flamegraph.pl, speedscope and inferno all accept).
+# Every run is appended to PROFILE_DIR/reruns.jsonl; `python profiling.py` summarises the
+# slowest sections across all sessions (and replicas, if they share PROFILE_DIR).
+# A run cut short by st.rerun() is closed when the next run of that session starts.
+
+PROFILE_RERUNS = os.environ.get("PROFILE_RERUNS", "").lower() in ("1", "true", "yes")
+SLOW_RERUN_SECONDS = float(os.environ.get("SLOW_RERUN_SECONDS", 1.0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "") or os.path.join(tempfile.gettempdir(), "reframe-profiles")
+SAMPLE_INTERVAL_SECONDS = 0.005
+# A run never closed (the session went away mid-run) stops being sampled after this long.
+MAX_SAMPLED_SECONDS = 120
+SECTION_HISTORY = 2000
+SESSION_KEY = "_rerun_profile"
+
+
+class _Sampler:
+    """One daemon thread sampling the stacks of every thread that is being profiled."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self._watching = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, thread_id: int) -> Counter:
+        stacks = Counter()
+        with self._lock:
+            self._watching[thread_id] = (stacks, time.monotonic() + MAX_SAMPLED_SECONDS)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="rerun-sampler", daemon=True)
+                self._thread.start()
+        return stacks
+
+    def unwatch(self, thread_id: int, stacks: Counter = None) -> None:
+        with self._lock:
+            watched = self._watching.get(thread_id)
+            # Thread ids are reused; only drop the watch if it is still the caller's.
+            if watched is not None and (stacks is None or watched[0] is stacks):
+                del self._watching[thread_id]
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._watching:
+                    continue
+                watching = list(self._watching.items())
+            frames = sys._current_frames()
+            now = time.monotonic()
+            for thread_id, (stacks, expires_at) in watching:
+                if now > expires_at:
+                    self.unwatch(thread_id, stacks)
+                    continue
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stacks[_collapse(frame)] += 1
+
+
+def _collapse(frame) -> str:
+    """Root-first "func (file:line)" frames joined by ';', starting at the script's <module> frame."""
+    names = []
+    script_depth = None
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        if code.co_name == "<module>":
+            # Everything above the outermost module frame is Streamlit's script runner.
+            script_depth = len(names)
+        frame = frame.f_back
+    if script_depth is not None:
+        names = names[:script_depth]
+    return ";".join(reversed(names))
+
+
+_sampler = _Sampler()
+_stats_lock = threading.Lock()
+_section_seconds = {}
+_slowest_runs = []
+_write_lock = threading.Lock()
+
+
+class RerunProfile:
+    """Section timings (and, for slow runs, a sampled profile) of one script run."""
+
+    def __init__(self, session_id: str = "", sample: bool = True):
+        self.session_id = session_id
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._section = "setup"
+        self._section_started = self._started
+        self.sections = {}
+        self.finished = False
+        self._thread_id = threading.get_ident()
+        self._stacks = _sampler.watch(self._thread_id) if sample else None
+
+    def mark(self, section: str) -> None:
+        """End the current section and start timing `section`."""
+        now = time.perf_counter()
+        self.sections[self._section] = self.sections.get(self._section, 0.0) + now - self._section_started
+        self._section = section
+        self._section_started = now
+
+    def finish(self, status: str = "ok") -> dict:
+        """Close the run and record it; returns its summary record."""
+        if self.finished:
+            return {}
+        self.mark("")
+        self.sections.pop("", None)
+        self.finished = True
+        if self._stacks is not None:
+            _sampler.unwatch(self._thread_id, self._stacks)
+        seconds = time.perf_counter() - self._started
+        record = {
+            "ts": round(self.started_at, 3),
+            "session": self.session_id,
+            "status": status,
+            "seconds": round(seconds, 4),
+            "sections": {name: round(value, 4) for name, value in self.sections.items()},
+            "profile": "",
+        }
+        if seconds >= SLOW_RERUN_SECONDS and self._stacks:
+            record["profile"] = _write_collapsed(self._stacks, self.started_at, self.session_id)
+        _remember(record)
+        _append_run(record)
+        return record
+
+
+class _NullProfile:
+    """Stand-in when profiling is off, so app.py can call mark()/finish() unconditionally."""
+
+    sections = {}
+
+    def mark(self, section: str) -> None:
+        pass
+
+    def finish(self, status: str = "ok") -> dict:
+        return {}
+
+
+def start_rerun(state, session_id: str = "", enabled: bool = None):
+    """Begin profiling this script run; `state` is st.session_state (any dict-like works).
+
+    Closes the session's previous run first if it never reached finish() (st.rerun()).
+    """
+    previous = state.get(SESSION_KEY)
+    if previous is not None and not previous.finished:
+        previous.finish("rerun")
+    if not (PROFILE_RERUNS if enabled is None else enabled):
+        return _NullProfile()
+    profile = RerunProfile(session_id)
+    state[SESSION_KEY] = profile
+    return profile
+
+
+def _write_collapsed(stacks: Counter, started_at: float, session_id: str) -> str:
+    name = f"rerun-{time.strftime('%Y%m%d-%H%M%S', time.gmtime(started_at))}-{session_id or 'anon'}-{int(started_at * 1000) % 1000:03d}.folded"
+    path = os.path.join(PROFILE_DIR, name)
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+    except OSError as e:
+        logging.warning(f"Could not write rerun profile {path}: {e}")
+        return ""
+
+
+def _remember(record: dict) -> None:
+    for name, seconds in record["sections"].items():
+        metrics.observe(f"rerun.section.{name}", seconds)
+    metrics.observe("rerun.total", record["seconds"])
+    with _stats_lock:
+        for name, seconds in record["sections"].items():
+            _section_seconds.setdefault(name, deque(maxlen=SECTION_HISTORY)).append(seconds)
+        _slowest_runs.append(record)
+        _slowest_runs.sort(key=lambda r: -r["seconds"])
+        del _slowest_runs[10:]
+
+
+def _append_run(record: dict) -> None:
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with _write_lock:
+            with open(os.path.join(PROFILE_DIR, "reruns.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record rerun timings: {e}")
+
+
+# ---------------------- Reruns per transform ----------------------
+# Always on, whatever PROFILE_RERUNS says: it is a few numbers in session state. Every
+# script run of a session is counted (with its server time) until a transform completes;
+# that run's end closes the tally as {"reruns", "server_seconds"}, which app.py keeps in
+# session_state["last_transform"] (where AppTest and `loadtest.py --mode app` read it)
+# and which feeds the transform.reruns / transform.completed / transform.server_seconds
+# metrics. A run cut short by st.rerun() is counted but not timed.
+TALLY_KEY = "_transform_tally"
+
+
+def count_run(state) -> None:
+    """Call at the top of every script run."""
+    tally = state.get(TALLY_KEY)
+    if tally is None:
+        tally = state[TALLY_KEY] = {"runs": 0, "seconds": 0.0, "started": 0.0, "done": False}
+    tally["runs"] += 1
+    tally["started"] = time.perf_counter()
+
+
+def transform_done(state) -> None:
+    """Call when a transform has produced its result; the tally closes at the end of this run."""
+    tally = state.get(TALLY_KEY)
+    if tally is not None:
+        tally["done"] = True
+
+
+def close_run(state) -> dict:
+    """Call at the end of every script run; returns the transform's record if one completed in it, else {}."""
+    tally = state.get(TALLY_KEY)
+    if not tally or not tally["started"]:
+        return {}
+    tally["seconds"] += time.perf_counter() - tally["started"]
+    tally["started"] = 0.0
+    if not tally["done"]:
+        return {}
+    record = {"reruns": tally["runs"], "server_seconds": round(tally["seconds"], 4)}
+    tally.update(runs=0, seconds=0.0, done=False)
+    metrics.incr("transform.completed")
+    metrics.incr("transform.reruns", record["reruns"])
+    metrics.observe("transform.server_seconds", record["server_seconds"])
+    return record
+
+
+# ---------------------- Summaries ----------------------
+def summarize(section_seconds: dict) -> list:
+    """Per-section count, mean, p95, max and share of all rerun time, slowest (by total) first."""
+    grand_total = sum(sum(values) for values in section_seconds.values()) or 1.0
+    rows = []
+    for name, values in section_seconds.items():
+        ordered = sorted(values)
+        if not ordered:
+            continue
+        total = sum(ordered)
+        rows.append({
+            "section": name,
+            "count": len(ordered),
+            "mean": total / len(ordered),
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1],
+            "share": total / grand_total,
+        })
+    rows.sort(key=lambda row: -row["mean"] * row["count"])
+    return rows
+
+
+def summary() -> dict:
+    """This process's section summary and slowest runs (what the app shows when profiling is on)."""
+    with _stats_lock:
+        sections = {name: list(values) for name, values in _section_seconds.items()}
+        slowest = list(_slowest_runs)
+    return {"sections": summarize(sections), "slowest_runs": slowest}
+
+
+def load_runs(directory: str = None) -> list:
+    path = os.path.join(directory or PROFILE_DIR, "reruns.jsonl")
+    runs = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    runs.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return runs
+
+
+def summarize_runs(runs) -> dict:
+    sections = {}
+    for run in runs:
+        for name, seconds in run.get("sections", {}).items():
+            sections.setdefault(name, []).append(seconds)
+    slowest = sorted(runs, key=lambda r: -r.get("seconds", 0))[:10]
+    return {"sections": summarize(sections), "slowest_runs": slowest}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise recorded Streamlit rerun timings.")
+    parser.add_argument("--dir", default=PROFILE_DIR, help="PROFILE_DIR the app wrote to")
+    parser.add_argument("--session", help="only runs of this session")
+    args = parser.parse_args()
+
+    runs = load_runs(args.dir)
+    if args.session:
+        runs = [run for run in runs if run.get("session") == args.session]
+    if not runs:
+        raise SystemExit(f"No reruns recorded in {args.dir}")
+    report = summarize_runs(runs)
+    sessions = len({run.get("session") for run in runs})
+    print(f"{len(runs)} reruns from {sessions} sessions")
+    print(f"{'section':<16} {'runs':>6} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9} {'share':>7}")
+    for row in report["sections"]:
+        print(f"{row['section']:<16} {row['count']:>6} {row['mean'] * 1000:>9.1f} {row['p95'] * 1000:>9.1f} {row['max'] * 1000:>9.1f} {row['share']:>7.1%}")
+    print()
+    print("slowest reruns:")
+    for run in report["slowest_runs"]:
+        top = max(run["sections"].items(), key=lambda item: item[1])[0] if run.get("sections") else "-"
+        print(f"  {run['seconds']:>7.2f}s  {run.get('status', ''):<6} session {run.get('session', '')}  mostly {top}  {run.get('profile') or ''}")
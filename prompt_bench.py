@@ -0,0 +1,104 @@
+import argparse
+import statistics
+import time
+
+import rewriter
+from accounting import estimate_tokens
+from options import tone_options, language_options, viral_samples
+from openrouter_stub import StubConfig, start_stub
+from prompts import PROMPT_VARIANTS, build_system_prompt, split_system_prompt
+from state_backend import SharedTokenBucket
+
+# ---------------------- Prompt size & latency harness ----------------------
+# Offline measurements for the prompt variants:
+#   python prompt_bench.py                 token counts only
+#   python prompt_bench.py --latency 40    plus end-to-end latency against openrouter_stub.py
+# Token counts use the same estimate as accounting.py, so they line up with the usage
+# report. Latency runs go through rewriter.call_model_fallbacks unchanged, with the
+# upstream rate limit lifted, once without prompt caching, once with the provider caching
+# identical prefixes automatically, and once for a model that needs cache_control.
+
+CACHE_SCENARIOS = (
+    ("no cache", "stub/model", False),
+    ("auto prefix cache", "stub/model", True),
+    ("cache_control", "anthropic/stub-model", False),
+)
+
+
+def _combinations():
+    for tone in tone_options:
+        for language in language_options:
+            yield tone, language
+
+
+def token_report() -> list:
+    """One row per (variant, mode): prefix/suffix/total prompt tokens and prefix stability."""
+    rows = []
+    for variant in PROMPT_VARIANTS:
+        for format_as_email in (False, True):
+            prefixes = set()
+            suffix_tokens = []
+            total_tokens = []
+            for tone, language in _combinations():
+                prompt = build_system_prompt(tone, language, format_as_email, variant)
+                prefix, suffix = split_system_prompt(prompt)
+                prefixes.add(prefix)
+                suffix_tokens.append(estimate_tokens(suffix))
+                total_tokens.append(estimate_tokens(prompt))
+            rows.append({
+                "variant": variant,
+                "mode": "email" if format_as_email else "reframe",
+                "prefix_tokens": estimate_tokens(next(iter(prefixes))),
+                "suffix_tokens": max(suffix_tokens),
+                "total_tokens": statistics.mean(total_tokens),
+                "distinct_prefixes": len(prefixes),
+            })
+    return rows
+
+
+def latency_report(requests_per_scenario: int, prefill_ms: float, decode_ms: float) -> list:
+    rewriter.UPSTREAM_RATE_LIMIT = SharedTokenBucket("prompt-bench", 1e6, 1e6)
+    combos = list(_combinations())
+    rows = []
+    for label, model, auto_cache in CACHE_SCENARIOS:
+        for variant in PROMPT_VARIANTS:
+            stub = start_stub(config=StubConfig(prefill_ms, decode_ms, auto_cache=auto_cache))
+            rewriter.OPENROUTER_URL = stub.url
+            latencies = []
+            try:
+                for i in range(requests_per_scenario):
+                    tone, language = combos[i % len(combos)]
+                    prompt = build_system_prompt(tone, language, False, variant)
+                    started = time.perf_counter()
+                    rewriter.call_model_fallbacks(prompt, viral_samples[i % len(viral_samples)], "stub-key", [model], format_as_email=False)
+                    latencies.append((time.perf_counter() - started) * 1000)
+            finally:
+                stub.shutdown()
+            latencies.sort()
+            stats = stub.stats
+            rows.append({
+                "cache": label,
+                "variant": variant,
+                "p50_ms": latencies[len(latencies) // 2],
+                "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                "prefilled_tokens": (stats["prompt_tokens"] - stats["cached_tokens"]) / max(1, stats["requests"]),
+            })
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure system prompt size and its latency impact.")
+    parser.add_argument("--latency", type=int, default=0, metavar="N", help="also time N requests per scenario against the local stub")
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="stub prefill cost per uncached prompt token")
+    parser.add_argument("--decode-ms", type=float, default=4.0, help="stub decode cost per generated token")
+    args = parser.parse_args()
+
+    print(f"{'variant':<9} {'mode':<8} {'prefix':>7} {'suffix':>7} {'total':>7} {'prefixes':>9}")
+    for row in token_report():
+        print(f"{row['variant']:<9} {row['mode']:<8} {row['prefix_tokens']:>7} {row['suffix_tokens']:>7} {row['total_tokens']:>7.0f} {row['distinct_prefixes']:>9}")
+
+    if args.latency:
+        print()
+        print(f"{'cache':<18} {'variant':<9} {'p50 ms':>8} {'p95 ms':>8} {'prefilled tok':>14}")
+        for row in latency_report(args.latency, args.prefill_ms, args.decode_ms):
+            print(f"{row['cache']:<18} {row['variant']:<9} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['prefilled_tokens']:>14.0f}")
@@ -1,3 +1,6 @@
+import hashlib
+import os
+
 import requests
 
 def rewrite_feedback(feedback: str, tone: str, api_key: str) -> str:
@@ -31,3 +34,157 @@ def rewrite_feedback(feedback: str, tone: str, api_key: str) -> str:
         return response.json()["choices"][0]["message"]["content"].strip()
     else:
         return f"Error: {response.status_code} - {response.text}"
+
+
+# ---------------------- System prompts ----------------------
+# Every system prompt is a static prefix, byte-identical for all tones and languages,
+# followed by STYLE_MARKER and a short per-request style suffix. Providers that cache
+# prompts by prefix (automatically, or via cache_control) then only prefill the suffix.
+# PROMPT_VARIANT picks the prefix wording: "full" (the original rules plus a worked
+# example) or "compact" (same rules, no example; see prompt_bench.py for the numbers).
+
+PROMPT_VARIANTS = ("full", "compact")
+PROMPT_VARIANT = os.environ.get("PROMPT_VARIANT", "full")
+STYLE_MARKER = "\n\nFor this message:\n"
+
+_REFRAME_PREFIX = {
+    "full": (
+        "You are a seasoned and empathetic communication coach for professionals. "
+        "Your task is to transform the user's raw feedback into a highly professional and constructive statement. "
+        "The feedback is from the user to a professional peer, manager, report, or team member, not a self-critique. Never, under any circumstances, generate an apology from the user's perspective unless they are explicitly stating they made one. "
+        "Use the tone and language given at the end of these instructions. For non-English, use natural, culturally appropriate expressions without any English words. "
+        "Respond in **exactly this format**:\n\n"
+        "The Reframe:\n"
+        "<Insert your full reframe here. Start with a positive or neutral observation, explain the impact, and suggest a collaborative path forward. Be specific and solution-focused.>\n\n"
+        "Bonus Tip:\n"
+        "<Insert a short, practical suggestion for how to deliver this feedback effectively — e.g., suggest a private 1:1, a specific opening line, or ideal timing. Keep it to **1–2 clear sentences**. Do not add fluff, disclaimers, or generic advice.>\n\n"
+        "Rules:\n\n"
+        "- Start with 'The Reframe:' on its own line.\n"
+        "- Put the reframe content on the next line — do not combine.\n"
+        "- After a blank line, write 'Bonus Tip:' on its own line.\n"
+        "- Write the tip content **below** 'Bonus Tip:', not on the same line.\n"
+        "- The tip must be 1–2 sentences. No more.\n"
+        "- Do not use markdown, quotes, asterisks, or formatting.\n"
+        "- Do not add greetings, closings, or explanations.\n\n"
+        "Example Output:\n"
+        "The Reframe:\n"
+        "I've noticed that sometimes in meetings, multiple people start speaking at once, which can make it hard to follow the discussion. To help us collaborate more effectively, it would be great if we could practice pausing briefly before responding. This small change can make a big difference in ensuring everyone feels heard.\n\n"
+        "Bonus Tip:\n"
+        "Bring this up in a private 1:1 and start with, 'I’ve been thinking about how we can make our meetings even better — would you be open to some feedback?'"
+    ),
+    "compact": (
+        "You are an empathetic workplace communication coach. Rewrite the user's raw feedback to a peer, manager, report or teammate "
+        "(not a self-critique) as professional, constructive feedback in the tone and language given below, with natural, culturally appropriate wording and no English words in other languages. "
+        "Never apologise on the user's behalf unless they say they made a mistake.\n"
+        "Reply in exactly this plain-text format, with no markdown, greetings or explanations:\n"
+        "The Reframe:\n"
+        "<reframe: open with a positive or neutral observation, explain the impact, suggest a specific collaborative way forward>\n\n"
+        "Bonus Tip:\n"
+        "<1–2 sentences on delivering it, e.g. a private 1:1, an opening line or timing>"
+    ),
+}
+
+_EMAIL_PREFIX = {
+    "full": (
+        "You are a seasoned workplace communication expert. Your task is to transform a user's raw feedback into a professional and well-structured email. "
+        "The email is written by the user to a professional peer, manager, report, or team member. "
+        "Keep it warm, constructive, and solution-oriented in the tone given at the end of these instructions. "
+        "Write everything exclusively in the language given at the end of these instructions, using native greetings, expressions, and cultural norms without any English words. "
+        "The email must have a clear subject line, a respectful greeting, a body that provides specific and actionable feedback, and a professional closing. "
+        "The body of the email must be more than a simple sentence. It should provide a clear, positive context, explain the 'why' behind the feedback, and offer a forward-looking solution. "
+        "Never write from the perspective of the sender apologizing for their own mistake unless they are explicitly stating they made one. "
+        "Do not use any introductory conversational text like 'Here is the email:' before the email content. Start your response directly with the email's subject line. "
+        "The goal is to help the recipient grow, kindly, clearly, and respectfully."
+    ),
+    "compact": (
+        "You are a workplace communication expert. Turn the user's raw feedback to a peer, manager, report or teammate into a professional email: "
+        "subject line first, then a respectful greeting, a body with positive context, the why, and a concrete way forward, and a professional closing. "
+        "Write only in the language given below, with its native greetings and expressions, in the tone given below. Never apologise on the sender's behalf unless they say they made a mistake. "
+        "No introductory text before the subject line."
+    ),
+}
+
+_CHUNK_PREFIX = (
+    "You are a seasoned and empathetic communication coach for professionals. "
+    "You are rewriting ONE SECTION of a longer piece of workplace feedback; other sections are rewritten separately and joined afterwards. "
+    "Rewrite only the text you are given into professional, constructive language in the tone and language given at the end of these instructions. "
+    "Keep the same meaning, facts, order and paragraph breaks. "
+    "Do not add headers, greetings, closings, summaries, tips or explanations, and never apologise on the user's behalf. "
+    "Output only the rewritten section."
+)
+
+# Multi-language mode translates the finished rewrite instead of rewriting it again per
+# language; the instructions are short because the model only has to translate.
+_TRANSLATE_PREFIX = {
+    False: (
+        "You are a professional translator of workplace communication. Translate the user's message into the language given below, "
+        "keeping its meaning, tone, level of formality and paragraph breaks, with natural, culturally appropriate wording. "
+        "Keep the lines 'The Reframe:' and 'Bonus Tip:' exactly as they are, in English, each on its own line, and translate everything else. "
+        "Output only the translation, with no notes or explanations."
+    ),
+    True: (
+        "You are a professional translator of workplace communication. Translate the user's email into the language given below, "
+        "keeping its meaning, tone, level of formality and paragraph breaks. Start with the translated subject line, and use the "
+        "language's native greeting and closing. Output only the translated email, with no notes or explanations."
+    ),
+}
+
+
+def _style_suffix(tone: str, language: str) -> str:
+    return f"{STYLE_MARKER}Tone: {tone}\nLanguage: write exclusively in perfect {language}"
+
+
+def build_system_prompt(tone: str, language: str, format_as_email: bool, variant: str = None) -> str:
+    """System prompt used by the app for a tone / language / email-mode choice."""
+    variant = variant or PROMPT_VARIANT
+    prefixes = _EMAIL_PREFIX if format_as_email else _REFRAME_PREFIX
+    return prefixes.get(variant, prefixes["full"]) + _style_suffix(tone, language)
+
+
+def build_chunk_prompt(tone: str, language: str) -> str:
+    """System prompt for one section of a long document; identical for every section so tone stays consistent."""
+    return _CHUNK_PREFIX + _style_suffix(tone, language)
+
+
+def build_translation_prompt(language: str, format_as_email: bool) -> str:
+    """System prompt that translates an already reframed message (or email) into `language`."""
+    return _TRANSLATE_PREFIX[bool(format_as_email)] + f"{STYLE_MARKER}Language: translate into perfect {language}"
+
+
+def split_system_prompt(system_prompt: str):
+    """(static prefix, per-request suffix) of a prompt built here; ("", prompt) for anything else."""
+    prefix, marker, style = system_prompt.partition(STYLE_MARKER)
+    if not marker:
+        return "", system_prompt
+    return prefix, marker + style
+
+
+# Providers that only cache prompt prefixes marked with cache_control; most others
+# (OpenAI, DeepSeek, ...) cache identical prefixes automatically and need nothing.
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+
+def build_messages(system_prompt: str, user_input: str, model: str = "") -> list:
+    """Chat messages for one attempt, marking the static prefix cacheable where the provider needs it."""
+    prefix, style = split_system_prompt(system_prompt)
+    if prefix and model.startswith(CACHE_CONTROL_MODEL_PREFIXES):
+        system = {"role": "system", "content": [
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": style},
+        ]}
+    else:
+        system = {"role": "system", "content": system_prompt}
+    return [system, {"role": "user", "content": user_input}]
+
+
+def prompt_fingerprint() -> str:
+    """Hash of every system prompt the app can send; changes whenever a prompt is edited."""
+    from options import tone_options, language_options
+
+    h = hashlib.sha256()
+    for tone in tone_options:
+        for language in language_options:
+            for format_as_email in (False, True):
+                h.update(build_system_prompt(tone, language, format_as_email).encode("utf-8"))
+                h.update(b"\x00")
+    return h.hexdigest()
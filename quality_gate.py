@@ -0,0 +1,211 @@
+import math
+from collections import Counter
+from itertools import repeat
+
+from response_parser import MalformedResponse
+from rule_rewriter import PhraseMatcher
+import metrics
+
+# ---------------------- Response quality gate ----------------------
+# Cheap local checks run on every model answer before it is accepted; a failure is
+# raised as QualityRejected (a MalformedResponse), so the fallback loop simply moves on
+# to the next model. Three checks, all well under a millisecond on typical answers:
+#   language  script ratios for Japanese / Korean / Chinese, and a character-trigram
+#             naive Bayes over short built-in samples for the Latin-script languages
+#   refusal   "as an AI..." / "I can't help with that" in any supported language, and
+#             apologies unless the user's own message contains one (the prompts forbid them)
+#   format    prompt instructions copied into the answer, answers that just echo the input, near-empty text
+
+LANGUAGE_SAMPLE_CHARS = 400
+MIN_LANGUAGE_LETTERS = 40
+# The target language must score within this many nats per trigram of the best one.
+LANGUAGE_MARGIN = 0.15
+MIN_ANSWER_CHARS = 20
+
+# Workplace-register samples; enough for trigram profiles that separate these six.
+LATIN_SAMPLES = {
+    "English": (
+        "I have noticed that the weekly updates have been arriving later than planned, which makes it harder for the team "
+        "to prepare. It would really help if we could agree on a shared deadline and check in together when something is "
+        "blocking you. Thank you for the effort you are putting into this project; your ideas in the last meeting were "
+        "valuable and I would like to hear more of them. Could we find some time this week to talk about how I can support you?"
+    ),
+    "Spanish": (
+        "He notado que los informes semanales están llegando más tarde de lo previsto, lo que dificulta que el equipo se "
+        "prepare. Nos ayudaría mucho acordar una fecha límite común y hablar juntos cuando algo te esté bloqueando. Gracias "
+        "por el esfuerzo que estás dedicando a este proyecto; tus ideas en la última reunión fueron valiosas y me gustaría "
+        "escuchar más. ¿Podríamos encontrar un momento esta semana para hablar de cómo puedo apoyarte?"
+    ),
+    "French": (
+        "J'ai remarqué que les comptes rendus hebdomadaires arrivent plus tard que prévu, ce qui complique la préparation de "
+        "l'équipe. Il serait vraiment utile de convenir d'une échéance commune et d'en parler ensemble lorsque quelque chose "
+        "vous bloque. Merci pour les efforts que vous consacrez à ce projet ; vos idées lors de la dernière réunion étaient "
+        "précieuses et j'aimerais en entendre davantage. Pourrions-nous trouver un moment cette semaine pour voir comment je peux vous aider ?"
+    ),
+    "German": (
+        "Mir ist aufgefallen, dass die wöchentlichen Berichte später als geplant eintreffen, was die Vorbereitung des Teams "
+        "erschwert. Es würde sehr helfen, wenn wir uns auf eine gemeinsame Frist einigen und uns abstimmen, sobald dich etwas "
+        "blockiert. Danke für den Einsatz, den du in dieses Projekt steckst; deine Ideen in der letzten Besprechung waren "
+        "wertvoll und ich würde gerne mehr davon hören. Können wir diese Woche einen Termin finden, um zu besprechen, wie ich dich unterstützen kann?"
+    ),
+    "Italian": (
+        "Ho notato che i resoconti settimanali arrivano più tardi del previsto, e questo rende più difficile la preparazione "
+        "del team. Sarebbe davvero utile concordare una scadenza comune e parlarne insieme quando qualcosa ti blocca. Grazie "
+        "per l'impegno che stai mettendo in questo progetto; le tue idee nell'ultima riunione sono state preziose e mi "
+        "piacerebbe sentirne altre. Potremmo trovare un momento questa settimana per parlare di come posso aiutarti?"
+    ),
+    "Portuguese": (
+        "Percebi que os relatórios semanais estão chegando mais tarde do que o previsto, o que dificulta a preparação da "
+        "equipe. Ajudaria muito se pudéssemos combinar um prazo comum e conversar juntos quando algo estiver te bloqueando. "
+        "Obrigado pelo esforço que você está dedicando a este projeto; suas ideias na última reunião foram valiosas e eu "
+        "gostaria de ouvir mais. Podemos encontrar um tempo nesta semana para conversar sobre como posso te apoiar?"
+    ),
+}
+
+# Minimum share of letters that must be in the target script.
+CJK_SCRIPTS = {"Japanese": 0.3, "Korean": 0.3, "Chinese": 0.3}
+
+REFUSAL_PHRASES = [
+    "as an ai", "as a language model", "as an ai language model",
+    "i can't help with", "i cannot help with", "i can't assist", "i cannot assist", "i'm unable to help", "i am unable to help",
+    "i can't fulfill", "i cannot fulfill", "i won't be able to help", "i'm not able to help",
+    "no puedo ayudar", "como modelo de lenguaje", "je ne peux pas vous aider", "en tant qu'ia",
+    "ich kann dir dabei nicht helfen", "ich kann ihnen dabei nicht helfen", "als ki", "non posso aiutarti", "come modello linguistico",
+    "não posso ajudar", "como modelo de linguagem",
+    "お手伝いできません", "言語モデルとして", "도와드릴 수 없습니다", "언어 모델로서", "我无法帮助", "作为一个ai", "作为人工智能",
+]
+# Explicit apologies only; sympathy such as "I'm sorry to hear that" is fine in a reframe.
+APOLOGY_PHRASES = [
+    "i apologize", "i apologise", "my apologies", "sorry for",
+    "pido disculpas", "mis disculpas", "perdón por", "je m'excuse", "toutes mes excuses", "désolé pour", "désolée pour",
+    "ich entschuldige mich", "entschuldigung für", "mi scuso", "chiedo scusa", "scusa per", "scusate per",
+    "peço desculpas", "desculpe por", "desculpa por",
+    "申し訳ありません", "申し訳ございません", "ごめんなさい", "죄송합니다", "사과드립니다", "对不起", "我道歉",
+]
+# Instruction text copied from the prompt's template. Not "[Your Name]": models sign emails
+# that way, and the user fills it in.
+PLACEHOLDERS = ("<insert", "<reframe", "<1–2 sentences")
+
+
+class QualityRejected(MalformedResponse):
+    """The answer parsed, but is in the wrong language, refuses, apologises, or is a non-answer."""
+
+
+def _profile(text: str):
+    """(trigram -> add-one smoothed log probability, log probability of an unseen trigram)."""
+    counts = Counter(_trigrams(text))
+    total = sum(counts.values())
+    vocabulary = len(counts) + 1
+    return {gram: math.log((count + 1) / (total + vocabulary)) for gram, count in counts.items()}, math.log(1 / (total + vocabulary))
+
+
+def _trigrams(text: str):
+    padded = f" {' '.join(text.lower().split())} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+_PROFILES = {language: _profile(sample) for language, sample in LATIN_SAMPLES.items()}
+# One automaton for both lists: a single pass over the answer finds refusals and apologies.
+_REFUSALS = frozenset(p.replace("’", "'") for p in REFUSAL_PHRASES)
+_APOLOGIES = frozenset(p.replace("’", "'") for p in APOLOGY_PHRASES)
+_MATCHER = PhraseMatcher(sorted(_REFUSALS | _APOLOGIES))
+
+
+def _script_counts(text: str):
+    latin = kana = hangul = han = 0
+    for ch in text:
+        if ch < "ɐ":
+            if ch.isalpha():
+                latin += 1
+        elif "぀" <= ch <= "ヿ":
+            kana += 1
+        elif "가" <= ch <= "힯" or "ᄀ" <= ch <= "ᇿ":
+            hangul += 1
+        elif "一" <= ch <= "鿿" or "㐀" <= ch <= "䶿":
+            han += 1
+    return latin, kana, hangul, han
+
+
+def latin_scores(text: str) -> dict:
+    """Average trigram log-likelihood of `text` under each Latin-script profile (higher is closer)."""
+    grams = _trigrams(text)
+    if not grams:
+        return {}
+    # map(dict.get, grams, repeat(floor)) keeps the per-trigram work in C.
+    return {language: sum(map(profile.get, grams, repeat(floor, len(grams)))) / len(grams) for language, (profile, floor) in _PROFILES.items()}
+
+
+def detect_language(text: str) -> str:
+    """Best guess among the app's nine languages, or "" when the text is too short to tell."""
+    sample = text[:LANGUAGE_SAMPLE_CHARS]
+    latin, kana, hangul, han = _script_counts(sample)
+    cjk = kana + hangul + han
+    if cjk > latin:
+        if hangul >= max(kana, han):
+            return "Korean"
+        return "Japanese" if kana >= 0.1 * (kana + han) else "Chinese"
+    if latin < MIN_LANGUAGE_LETTERS:
+        return ""
+    scores = latin_scores(sample)
+    return max(scores, key=scores.get)
+
+
+def _language_problem(text: str, language: str) -> str:
+    sample = text[:LANGUAGE_SAMPLE_CHARS]
+    latin, kana, hangul, han = _script_counts(sample)
+    letters = latin + kana + hangul + han
+    if not letters:
+        return ""
+    if language in CJK_SCRIPTS:
+        share = {"Japanese": kana + han, "Korean": hangul, "Chinese": han}[language] / letters
+        if share < CJK_SCRIPTS[language]:
+            return f"not written in {language}"
+        if language == "Chinese" and kana > 0.1 * (kana + han):
+            return "written in Japanese instead of Chinese"
+        if language == "Japanese" and kana < 0.1 * (kana + han):
+            return "written in Chinese instead of Japanese"
+        return ""
+    if language not in _PROFILES:
+        return ""
+    if kana + hangul + han > latin:
+        return f"not written in {language}"
+    if latin < MIN_LANGUAGE_LETTERS:
+        return ""
+    scores = latin_scores(sample)
+    best = max(scores, key=scores.get)
+    if best != language and scores[best] - scores[language] > LANGUAGE_MARGIN:
+        return f"written in {best} instead of {language}"
+    return ""
+
+
+def _strip_headers(text: str) -> str:
+    # "The Reframe:" / "Bonus Tip:" are fixed English markers in every language.
+    return text.replace("The Reframe:", " ").replace("Bonus Tip:", " ")
+
+
+def _flagged_phrases(text: str) -> set:
+    lowered = text.lower()
+    return {lowered[start:end] for start, end in _MATCHER.find(text)}
+
+
+def check_response(text: str, language: str = None, user_input: str = "") -> None:
+    """Raise QualityRejected if `text` should not be shown for this request."""
+    normalized = text.replace("’", "'")
+    lowered = normalized.lower()
+    flagged = _flagged_phrases(normalized)
+    check, reason = "format", ""
+    if len(text.strip()) < MIN_ANSWER_CHARS:
+        reason = "answer too short"
+    elif any(marker in lowered for marker in PLACEHOLDERS):
+        reason = "template placeholder left in the answer"
+    elif user_input and " ".join(_strip_headers(text).split()) == " ".join(user_input.split()):
+        reason = "answer repeats the input"
+    elif flagged & _REFUSALS:
+        check, reason = "refusal", "refusal"
+    elif flagged & _APOLOGIES and not _flagged_phrases(user_input.replace("’", "'")) & _APOLOGIES:
+        check, reason = "apology", "unrequested apology"
+    elif language:
+        check, reason = "language", _language_problem(_strip_headers(text), language)
+    if reason:
+        metrics.incr(f"quality_gate.rejected.{check}")
+        raise QualityRejected(reason)
@@ -0,0 +1,161 @@
+import argparse
+import socketserver
+import threading
+import time
+
+# ---------------------- Redis stand-in ----------------------
+# A tiny in-memory server speaking enough of the Redis protocol (RESP2) for
+# state_backend.RedisBackend, so multi-replica setups can be exercised locally:
+#   python redis_stub.py --port 6399
+#   STATE_BACKEND=redis://localhost:6399 streamlit run app.py --server.port 8501
+#   STATE_BACKEND=redis://localhost:6399 streamlit run app.py --server.port 8502
+# Not for production: no persistence, no eviction, one global lock.
+
+_lock = threading.Lock()
+_data = {}
+_expires = {}
+
+
+class CommandError(Exception):
+    pass
+
+
+class Status(str):
+    """A simple-string reply (+OK) as opposed to a bulk string."""
+
+
+def _live(key):
+    expires = _expires.get(key)
+    if expires is not None and expires <= time.time():
+        _data.pop(key, None)
+        _expires.pop(key, None)
+    return _data.get(key)
+
+
+def _typed(key, kind):
+    value = _live(key)
+    if value is not None and not isinstance(value, kind):
+        raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+    return value
+
+
+def _number(value):
+    return f"{value:.17g}"
+
+
+def run_command(args):
+    name = args[0].upper()
+    if name == "PING":
+        return Status("PONG")
+    if name in ("SELECT", "AUTH"):
+        return Status("OK")
+    if name == "GET":
+        return _typed(args[1], str)
+    if name == "SET":
+        _data[args[1]] = args[2]
+        _expires.pop(args[1], None)
+        if len(args) >= 5 and args[3].upper() == "EX":
+            _expires[args[1]] = time.time() + int(args[4])
+        return Status("OK")
+    if name == "DEL":
+        removed = 0
+        for key in args[1:]:
+            if _live(key) is not None:
+                removed += 1
+            _data.pop(key, None)
+            _expires.pop(key, None)
+        return removed
+    if name == "EXPIRE":
+        if _live(args[1]) is None:
+            return 0
+        _expires[args[1]] = time.time() + int(args[2])
+        return 1
+    if name in ("INCR", "INCRBY"):
+        amount = int(args[2]) if name == "INCRBY" else 1
+        value = int(_typed(args[1], str) or 0) + amount
+        _data[args[1]] = str(value)
+        return value
+    if name == "HINCRBYFLOAT":
+        fields = _typed(args[1], dict)
+        if fields is None:
+            fields = _data[args[1]] = {}
+        fields[args[2]] = float(fields.get(args[2], 0)) + float(args[3])
+        return _number(fields[args[2]])
+    if name == "HGETALL":
+        fields = _typed(args[1], dict) or {}
+        flat = []
+        for field, value in fields.items():
+            flat += [field, _number(value)]
+        return flat
+    if name == "RPUSH":
+        values = _typed(args[1], list)
+        if values is None:
+            values = _data[args[1]] = []
+        values.extend(args[2:])
+        return len(values)
+    if name == "LRANGE":
+        values = _typed(args[1], list) or []
+        start, stop = int(args[2]), int(args[3])
+        stop = len(values) + stop if stop < 0 else stop
+        return values[start:stop + 1]
+    if name == "FLUSHDB":
+        _data.clear()
+        _expires.clear()
+        return Status("OK")
+    raise CommandError(f"ERR unknown command '{args[0]}'")
+
+
+def _encode(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(_encode(item) for item in reply)
+    if isinstance(reply, Status):
+        return b"+%s\r\n" % reply.encode()
+    data = reply.encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.startswith(b"*"):
+                continue
+            args = []
+            for _ in range(int(line[1:])):
+                size = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(size + 2)[:-2].decode("utf-8"))
+            try:
+                with _lock:
+                    reply = _encode(run_command(args))
+            except CommandError as e:
+                reply = f"-{e}\r\n".encode()
+            except (ValueError, IndexError) as e:
+                reply = f"-ERR {e}\r\n".encode()
+            self.wfile.write(reply)
+
+
+class RedisStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_stub(port: int = 6399, host: str = "127.0.0.1") -> RedisStub:
+    """Start the stand-in on a background thread and return the server (call .shutdown() to stop)."""
+    server = RedisStub((host, port), RESPHandler)
+    threading.Thread(target=server.serve_forever, name="redis-stub", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory Redis protocol stand-in for local multi-replica testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6399)
+    args = parser.parse_args()
+    print(f"Redis stand-in listening on {args.host}:{args.port}")
+    RedisStub((args.host, args.port), RESPHandler).serve_forever()
@@ -0,0 +1,220 @@
+from abc import ABC, abstractmethod
+
+# ---------------------- Structured response parsing ----------------------
+# Incremental, single-pass parsers for the two output formats the prompts ask for.
+# Tokens are fed as they stream in; only complete lines are examined, each exactly
+# once, with plain string operations (no regex, so no backtracking on long outputs).
+# A response that breaks the format raises MalformedResponse as early as possible so
+# the fallback loop can abandon the stream and move on to the next model.
+
+REFRAME_HEADER = "the reframe:"
+TIP_HEADER = "bonus tip:"
+
+# Subject prefixes models commonly emit in the nine supported languages.
+SUBJECT_PREFIXES = (
+    "subject:", "asunto:", "objet :", "objet:", "betreff:", "oggetto:", "assunto:",
+    "件名:", "件名：", "제목:", "제목 :", "主题:", "主题：", "主題:", "主題：",
+)
+
+# Openers the email prompt explicitly forbids ("Here is the email:").
+CHATTY_OPENERS = ("here is", "here's", "sure", "certainly", "of course", "below is")
+
+MAX_HEADER_PROBE = 64
+
+
+class MalformedResponse(ValueError):
+    """The model output does not follow the requested structure."""
+
+
+def _normalize_header(line: str) -> str:
+    # Tolerate markdown emphasis and heading marks around the section labels.
+    return line.strip().strip("*#_ ").lower()
+
+
+class _LineParser(ABC):
+    """Splits streamed text into lines; subclasses validate each line and build the result."""
+
+    def __init__(self):
+        self._parts = []
+        self._probing = True  # Subclasses clear this once the opening has been validated
+
+    def feed(self, chunk: str) -> None:
+        """Consume the next piece of streamed text."""
+        if not chunk:
+            return
+        start = 0
+        while True:
+            end = chunk.find("\n", start)
+            if end < 0:
+                break
+            self._parts.append(chunk[start:end])
+            line = "".join(self._parts)
+            self._parts = []
+            self._line(line.rstrip("\r"))
+            start = end + 1
+        if start < len(chunk):
+            self._parts.append(chunk[start:])
+            if self._probing:
+                self._partial("".join(self._parts)[:MAX_HEADER_PROBE + 1])
+
+    def close(self) -> dict:
+        """Flush the last line and return the extracted parts (raises MalformedResponse)."""
+        if self._parts:
+            line = "".join(self._parts)
+            self._parts = []
+            self._line(line)
+        return self._finish()
+
+    def _partial(self, text: str) -> None:
+        pass
+
+    @abstractmethod
+    def _line(self, line: str) -> None:
+        """Examine one complete line (raises MalformedResponse)."""
+
+    @abstractmethod
+    def _finish(self) -> dict:
+        """The extracted parts once the stream has ended (raises MalformedResponse)."""
+
+
+class ReframeParser(_LineParser):
+    """Parses "The Reframe:\\n...\\n\\nBonus Tip:\\n..." into reframe and tip."""
+
+    def __init__(self):
+        super().__init__()
+        self._state = "start"
+        self._reframe = []
+        self._tip = []
+
+    def _partial(self, text: str) -> None:
+        # Reject before the first newline arrives if the opening can no longer be the header.
+        if self._state != "start":
+            return
+        probe = _normalize_header(text)
+        if probe.startswith(REFRAME_HEADER):
+            self._probing = False
+        elif probe and not REFRAME_HEADER.startswith(probe):
+            raise MalformedResponse("response does not start with 'The Reframe:'")
+
+    def _line(self, line: str) -> None:
+        header = _normalize_header(line)
+        if self._state == "start":
+            if not header:
+                return
+            if not header.startswith(REFRAME_HEADER):
+                raise MalformedResponse("response does not start with 'The Reframe:'")
+            self._state = "reframe"
+            self._probing = False
+            rest = line.split(":", 1)[1].strip().strip("*").strip()
+            if rest:
+                self._reframe.append(rest)
+        elif self._state == "reframe":
+            if header.startswith(TIP_HEADER):
+                if not "".join(self._reframe).strip():
+                    raise MalformedResponse("'Bonus Tip:' arrived before any reframe text")
+                self._state = "tip"
+                rest = line.split(":", 1)[1].strip().strip("*").strip()
+                if rest:
+                    self._tip.append(rest)
+            else:
+                self._reframe.append(line)
+        else:
+            if header.startswith(REFRAME_HEADER) or header.startswith(TIP_HEADER):
+                raise MalformedResponse("section header repeated")
+            self._tip.append(line)
+
+    def _finish(self) -> dict:
+        reframe = "\n".join(self._reframe).strip()
+        tip = "\n".join(self._tip).strip()
+        if not reframe:
+            raise MalformedResponse("missing reframe text")
+        if not tip:
+            raise MalformedResponse("missing 'Bonus Tip:' section")
+        return {
+            "reframe": reframe,
+            "tip": tip,
+            "text": f"The Reframe:\n{reframe}\n\nBonus Tip:\n{tip}",
+        }
+
+
+class EmailParser(_LineParser):
+    """Parses an email that starts with its subject line into subject, greeting, body and closing."""
+
+    def __init__(self):
+        super().__init__()
+        self._subject = None
+        self._greeting = None
+        self._blocks = []
+        self._current = []
+        self._lines = []
+
+    def _partial(self, text: str) -> None:
+        if self._subject is None:
+            self._check_opener(text)
+            # Every forbidden opener is short; past that length there is nothing left to probe.
+            if len(text.strip()) > 16:
+                self._probing = False
+
+    def _check_opener(self, text: str) -> None:
+        probe = text.strip().lower()
+        for opener in CHATTY_OPENERS:
+            if probe.startswith(opener):
+                raise MalformedResponse("email starts with conversational text instead of a subject line")
+
+    def _line(self, line: str) -> None:
+        self._lines.append(line)
+        stripped = line.strip()
+        if self._subject is None:
+            if not stripped:
+                return
+            self._check_opener(stripped)
+            subject = stripped.strip("*# ")
+            lowered = subject.lower()
+            for prefix in SUBJECT_PREFIXES:
+                if lowered.startswith(prefix):
+                    subject = subject[len(prefix):].strip().strip("*").strip()
+                    break
+            if not subject:
+                raise MalformedResponse("empty subject line")
+            self._subject = subject
+            self._probing = False
+        elif self._greeting is None:
+            if stripped:
+                self._greeting = stripped
+        elif stripped:
+            self._current.append(stripped)
+        elif self._current:
+            self._blocks.append("\n".join(self._current))
+            self._current = []
+
+    def _finish(self) -> dict:
+        if self._current:
+            self._blocks.append("\n".join(self._current))
+            self._current = []
+        if self._subject is None:
+            raise MalformedResponse("missing subject line")
+        if self._greeting is None or not self._blocks:
+            raise MalformedResponse("missing greeting or body")
+        # The last paragraph is the sign-off when there is more than one.
+        if len(self._blocks) > 1:
+            body, closing = self._blocks[:-1], self._blocks[-1]
+        else:
+            body, closing = self._blocks, ""
+        return {
+            "subject": self._subject,
+            "greeting": self._greeting,
+            "body": "\n\n".join(body),
+            "closing": closing,
+            "text": "\n".join(self._lines).strip(),
+        }
+
+
+def new_parser(format_as_email: bool):
+    return EmailParser() if format_as_email else ReframeParser()
+
+
+def parse_response(text: str, format_as_email: bool) -> dict:
+    """Parse a complete response in one call."""
+    parser = new_parser(format_as_email)
+    parser.feed(text)
+    return parser.close()
@@ -0,0 +1,81 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from state_backend import shared_state
+from text_codec import decode_text, encode_text, pack, unpack
+
+SHARED_TTL_SECONDS = 7 * 24 * 3600
+
+
+class RewriteCache:
+    """Thread-safe LRU of finished rewrites keyed by rewriter.prompt_key().
+
+    When a shared state backend is configured the LRU sits in front of it: misses are
+    looked up in (and sets written through to) the shared store, so a rewrite computed
+    by one replica is served by all of them. With COMPRESS_TEXT on, both keep the rewrites
+    compressed (see text_codec.py); reads decompress transparently.
+    """
+
+    def __init__(self, max_entries: int = 2048, namespace: str = "rewrite"):
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, value: str) -> None:
+        with self._lock:
+            self._items[key] = pack(value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def _shared_get(self, key: str):
+        backend = shared_state()
+        if not backend.shared:
+            return None
+        try:
+            return decode_text(backend.get(f"{self.namespace}:{key}"))
+        except Exception as e:
+            logging.warning(f"Shared cache read failed: {e}")
+            return None
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return unpack(value)
+        value = self._shared_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+        self._remember(key, value)
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        if not value:
+            return
+        self._remember(key, value)
+        backend = shared_state()
+        if backend.shared:
+            try:
+                backend.set(f"{self.namespace}:{key}", encode_text(value), ttl=SHARED_TTL_SECONDS)
+            except Exception as e:
+                logging.warning(f"Shared cache write failed: {e}")
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._items:
+                return True
+        return self._shared_get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
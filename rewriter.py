@@ -0,0 +1,516 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from prompts import build_messages, build_system_prompt, build_translation_prompt
+from rewrite_cache import RewriteCache
+from similarity_index import SimilarityIndex
+from response_parser import MalformedResponse, new_parser
+from quality_gate import QualityRejected, check_response
+from cancellation import Cancelled, Deadline, DeadlineExceeded
+from state_backend import SharedTokenBucket, shared_state
+import accounting
+from key_pool import as_pool
+import metrics
+import traffic_recorder
+from pii import scrub
+
+# Overridable so the app and the offline tools can be pointed at openrouter_stub.py.
+OPENROUTER_URL = os.environ.get("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# One pooled session per process so concurrent rewrites reuse TLS connections.
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+HTTP_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Finished rewrites shared by every Streamlit session in this process (and every replica, with a shared backend).
+REWRITE_CACHE = RewriteCache()
+
+# Near-identical earlier inputs (a typo fixed, a sample lightly edited) reuse their rewrite.
+# SIMILARITY_THRESHOLD is the minimum character-trigram Jaccard similarity; 0 turns reuse off.
+SIMILAR_INPUTS = SimilarityIndex(threshold=float(os.environ.get("SIMILARITY_THRESHOLD", 0.8)))
+
+# Every upstream attempt (users, comparisons, long documents) draws from one bucket, shared across replicas.
+UPSTREAM_RATE_LIMIT = SharedTokenBucket("upstream", float(os.environ.get("UPSTREAM_RPS", 5)), float(os.environ.get("UPSTREAM_BURST", 20)))
+
+# ---------------------- Model fallback chain ----------------------
+MODEL_FALLBACKS = [
+    "mistral/mistral-7b-instruct",
+    "mistralai/mixtral-8x7b-instruct",
+    "gryphe/mythomax-l2-13b",
+    "openchat/openchat-7b",
+    "qwen/qwen3-4b:free",
+    "google/gemma-3n-e2b-it:free",
+    "nousresearch/nous-capybara-7b",
+    "mistralai/mistral-small-3.2-24b-instruct:free",
+    "mistralai/devstral-small-2505:free",
+    "z-ai/glm-4.5-air:free",
+    "google/gemma-3n-e4b-it:free",
+    "openrouter/gpt-oss-20b:free",
+    "deepseek/deepseek-chat-v3-0324:free",
+    "deepseek/deepseek-r1:free",
+    "microsoft/mai-ds-r1:free",
+    "tngtech/deepseek-r1t-chimera:free",
+    "qwen/qwen3-coder:free",
+    "qwen/qwen3-8b:free",
+    "qwen/qwen3-14b:free",
+    "qwen/qwen3-30b-a3b:free",
+    "qwen/qwen3-235b-a22b:free",
+    "moonshotai/kimi-k2:free",
+    "sarvamai/sarvam-m:free",
+    "meta-llama/llama-2-70b-chat"
+]
+
+
+def prompt_key(system_prompt: str, user_input: str) -> str:
+    """Stable hash of everything that determines a rewrite (used by the catalog and caches)."""
+    h = hashlib.sha256()
+    h.update(system_prompt.encode("utf-8"))
+    h.update(b"\x00")
+    h.update(user_input.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _iter_event_lines(raw):
+    """Yield SSE lines as soon as they arrive.
+
+    requests' iter_lines() waits for a full 512-byte chunk, which delays both tokens and
+    cancellation checks; read1() hands back whatever bytes the socket already has.
+    """
+    buffer = b""
+    read = getattr(raw, "read1", None) or raw.read
+    while True:
+        chunk = read(8192, decode_content=True)
+        if not chunk:
+            break
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer:
+        yield buffer
+
+
+def _read_completion(resp, parser=None, deadline=None, meta=None) -> str:
+    """Collect the completion text, feeding `parser` token by token when the response is streamed.
+
+    `meta`, if given, receives the served "model", the provider's "usage" and the number of
+    completion characters seen so far ("chars"), even when reading stops early.
+    """
+    meta = {} if meta is None else meta
+    meta.setdefault("chars", 0)
+    if resp.headers.get("Content-Type", "").startswith("application/json"):
+        # Provider ignored "stream": the whole completion arrives at once.
+        body = resp.json()
+        meta["model"] = body.get("model") or meta.get("model")
+        meta["usage"] = body.get("usage") or meta.get("usage")
+        choices = body.get("choices") or [{}]
+        content = choices[0].get("message", {}).get("content") or ""
+        meta["chars"] += len(content)
+        if parser is not None:
+            parser.feed(content)
+        return content
+
+    pieces = []
+    for raw in _iter_event_lines(resp.raw):
+        if deadline is not None:
+            deadline.check()
+        line = raw.decode("utf-8", errors="replace")
+        # Server-sent events: skip keep-alive comments such as ": OPENROUTER PROCESSING"
+        if not line.startswith("data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            break
+        event = json.loads(payload)
+        if "error" in event:
+            raise MalformedResponse(f"upstream error mid-stream: {event['error']}")
+        if event.get("model"):
+            meta["model"] = event["model"]
+        if event.get("usage"):
+            meta["usage"] = event["usage"]
+        delta = ((event.get("choices") or [{}])[0].get("delta") or {}).get("content") or ""
+        if delta:
+            meta["chars"] += len(delta)
+            pieces.append(delta)
+            if parser is not None:
+                parser.feed(delta)
+    return "".join(pieces)
+
+
+def call_model_fallbacks(system_prompt: str, user_input: str, api_key, models=None, format_as_email=None, deadline=None, language=None):
+    """Walk the fallback chain until a model returns usable content. Returns None if all fail.
+
+    When `format_as_email` is given, responses are streamed through the matching structure
+    parser and a model that breaks the format is abandoned mid-stream for the next one.
+    Every answer then passes the quality gate (refusals, apologies, and with `language`
+    the output language) before it is accepted.
+    Every attempt is bounded by `deadline`; cancelling its token aborts the in-flight call.
+    `api_key` is one key or a KeyPool; a key that answers 401/402/429 is drained and the
+    same model is retried with another key while the pool has one.
+    """
+    deadline = deadline or Deadline()
+    pool = as_pool(api_key)
+    # usage.include asks OpenRouter to append token counts to the final streamed chunk.
+    data = {"stream": True, "usage": {"include": True}}
+    models = demote_dead_models(accounting.affordable_models(models or MODEL_FALLBACKS))
+    started = time.monotonic()
+
+    for attempt, model in enumerate(models):
+        attempt_started = None
+        key = None
+        status = None
+        try:
+            deadline.check()
+            if not UPSTREAM_RATE_LIMIT.acquire(timeout=deadline.remaining(), cancelled=lambda: deadline.token.cancelled):
+                deadline.check()
+                raise DeadlineExceeded("rate limited until the deadline")
+            free_model = accounting.is_free_model(model)
+            key = pool.acquire(free_model, timeout=deadline.remaining(), cancelled=lambda: deadline.token.cancelled)
+            if key is None:
+                # Every key is drained, or resting past the deadline; a free model may still have one.
+                traffic_recorder.note_attempt(model, "no_key", 0.0)
+                continue
+            headers = {"Authorization": f"Bearer {key.secret}", "Content-Type": "application/json"}
+            data["model"] = model
+            data["messages"] = build_messages(system_prompt, user_input, model)
+            attempt_started = time.monotonic()
+            outcome = "network"
+            timeout = deadline.attempt_timeout(len(models) - attempt)
+            with HTTP_SESSION.post(OPENROUTER_URL, headers=headers, json=data, timeout=(min(5, timeout), timeout), stream=True) as resp:
+                # Closing the response unblocks a read that is waiting on the socket.
+                unregister = deadline.token.on_cancel(resp.close)
+                status = resp.status_code
+                outcome = f"http_{resp.status_code}"
+                try:
+                    if resp.status_code in (401, 402, 429):
+                        refused, key = key, None
+                        pool.release(refused, resp.status_code, _retry_after(resp), free_model)
+                    # Check for insufficient credits
+                    if resp.status_code == 402:
+                        if pool.has_usable(free_model):
+                            models.insert(attempt + 1, model)
+                        else:
+                            logging.error("😐 The service is currently experiencing high demand and is unable to process your request. Please try again in a few moments!")
+                            accounting.record_out_of_credits()
+                            if not free_model:
+                                models[attempt + 1:] = [m for m in models[attempt + 1:] if accounting.is_free_model(m)]
+                    # Check for general authentication errors
+                    elif resp.status_code == 401:
+                        if pool.has_usable(free_model):
+                            models.insert(attempt + 1, model)
+                        else:
+                            logging.error("⚠️ We're having trouble connecting to the service. Please try again in a few moments!")
+                    elif resp.status_code == 429 and pool.has_usable(free_model):
+                        models.insert(attempt + 1, model)
+                    elif resp.status_code == 200:
+                        parser = new_parser(format_as_email) if format_as_email is not None else None
+                        meta = {}
+                        try:
+                            content = _read_completion(resp, parser, deadline, meta)
+                            text = parser.close()["text"] if parser is not None else content.strip()
+                            outcome = "empty"
+                            if text:
+                                check_response(text, language, user_input)
+                                record_model_result(model, True, time.monotonic() - attempt_started)
+                                traffic_recorder.note_attempt(model, "ok", time.monotonic() - attempt_started)
+                                return text
+                        except MalformedResponse as e:
+                            outcome = "rejected" if isinstance(e, QualityRejected) else "malformed"
+                            logging.warning(f"{model} returned an unusable response ({e}); trying the next model")
+                        finally:
+                            # Tokens are billed whether or not the answer was usable.
+                            _record_attempt_usage(model, meta, system_prompt, user_input, time.monotonic() - attempt_started)
+                    else:
+                        logging.warning(f"API call to {model} failed with status code: {resp.status_code}")
+                        deadline.sleep(0.5)  # Wait before trying the next model
+                finally:
+                    unregister()
+            if status in (401, 402, 429):
+                # The key was refused, not the model; its health is unaffected.
+                traffic_recorder.note_attempt(model, outcome, time.monotonic() - attempt_started)
+                continue
+            record_model_result(model, False, time.monotonic() - attempt_started)
+            traffic_recorder.note_attempt(model, outcome, time.monotonic() - attempt_started)
+
+        except Cancelled as e:
+            if attempt_started is not None:
+                traffic_recorder.note_attempt(model, "cancelled", time.monotonic() - attempt_started)
+            _account_abandoned(str(e), isinstance(e, DeadlineExceeded), started)
+            return None
+        except (requests.exceptions.RequestException, ValueError):
+            if deadline.token.cancelled or deadline.expired:
+                # The call was cut short on purpose, not by the network.
+                if attempt_started is not None:
+                    traffic_recorder.note_attempt(model, "cancelled", time.monotonic() - attempt_started)
+                _account_abandoned(deadline.token.reason or "deadline", not deadline.token.cancelled, started)
+                return None
+            # A ValueError can come before the request is sent (building the messages,
+            # picking a key); only a call that was made counts against the model.
+            if attempt_started is not None:
+                record_model_result(model, False, time.monotonic() - attempt_started)
+                traffic_recorder.note_attempt(model, "network", time.monotonic() - attempt_started)
+            logging.error(f"⚠️ It looks like we're having trouble connecting to the internet. Please check your connection and try again 🙂")
+            deadline.sleep(0.5)  # Wait before trying the next model
+        finally:
+            if key is not None:
+                pool.release(key, status)
+    return None
+
+
+def _retry_after(resp):
+    try:
+        return float(resp.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+# ---------------------- Model health ----------------------
+# Per-model outcome counters in the shared state backend, so every replica sees the same picture.
+MODEL_HEALTH_KEY = "model_health"
+
+
+def record_model_result(model: str, ok: bool, seconds: float) -> None:
+    try:
+        backend = shared_state()
+        backend.hincr(MODEL_HEALTH_KEY, f"{model}|{'ok' if ok else 'fail'}")
+        backend.hincr(MODEL_HEALTH_KEY, f"{model}|seconds", seconds)
+    except Exception as e:
+        logging.warning(f"Could not record health for {model}: {e}")
+
+
+def model_health() -> dict:
+    """{model: {"ok", "fail", "avg_seconds"}} aggregated across all replicas."""
+    try:
+        fields = shared_state().hgetall(MODEL_HEALTH_KEY)
+    except Exception as e:
+        logging.warning(f"Could not read model health: {e}")
+        return {}
+    health = {}
+    for field, value in fields.items():
+        model, _, stat = field.rpartition("|")
+        health.setdefault(model, {"ok": 0.0, "fail": 0.0, "seconds": 0.0})[stat] = value
+    for stats in health.values():
+        attempts = stats["ok"] + stats["fail"]
+        stats["avg_seconds"] = stats.pop("seconds") / attempts if attempts else 0.0
+    return health
+
+
+# Active probes (health.py) publish each model's latest liveness and latency; the chain
+# tries models last seen dead only after every other one, so users never wait on them first.
+MODEL_PROBE_PREFIX = "model_probe:"
+PROBE_TTL_SECONDS = 900
+LIVENESS_CACHE_SECONDS = 10
+_liveness = {}
+_liveness_lock = threading.Lock()
+
+
+def record_probe(model: str, alive: bool, seconds: float, status: str) -> None:
+    record = {"alive": alive, "seconds": round(seconds, 3), "status": status, "ts": round(time.time(), 3)}
+    try:
+        shared_state().set(MODEL_PROBE_PREFIX + model, json.dumps(record), ttl=PROBE_TTL_SECONDS)
+    except Exception as e:
+        logging.warning(f"Could not publish probe result for {model}: {e}")
+    with _liveness_lock:
+        _liveness[model] = (time.monotonic(), record)
+
+
+def model_liveness(models=None) -> dict:
+    """{model: latest probe {"alive", "seconds", "status", "ts"}} for probed models, shared across replicas."""
+    now = time.monotonic()
+    liveness = {}
+    for model in models or MODEL_FALLBACKS:
+        with _liveness_lock:
+            fetched_at, record = _liveness.get(model, (None, None))
+        if fetched_at is None or now - fetched_at > LIVENESS_CACHE_SECONDS:
+            try:
+                raw = shared_state().get(MODEL_PROBE_PREFIX + model)
+                record = json.loads(raw) if raw else None
+            except Exception as e:
+                logging.warning(f"Could not read probe result for {model}: {e}")
+            with _liveness_lock:
+                _liveness[model] = (now, record)
+        if record:
+            liveness[model] = record
+    return liveness
+
+
+def demote_dead_models(models) -> list:
+    """`models` with the ones whose latest probe failed moved to the end (order otherwise kept)."""
+    liveness = model_liveness(models)
+    dead = [model for model in models if not liveness.get(model, {}).get("alive", True)]
+    if not dead:
+        return models
+    metrics.incr("health.demoted", len(dead))
+    return [model for model in models if model not in dead] + dead
+
+
+def _record_attempt_usage(model: str, meta: dict, system_prompt: str, user_input: str, seconds: float) -> None:
+    usage = meta.get("usage") or {}
+    estimated = not usage
+    prompt_tokens = usage.get("prompt_tokens") or accounting.estimate_tokens(system_prompt) + accounting.estimate_tokens(user_input)
+    completion_tokens = usage.get("completion_tokens") or (meta.get("chars", 0) + 3) // 4
+    # Bill the model that actually served the request; routers may substitute a variant.
+    accounting.record_usage(meta.get("model") or model, int(prompt_tokens), int(completion_tokens), seconds, estimated)
+
+
+def _account_abandoned(reason: str, timed_out: bool, started: float) -> None:
+    metrics.incr("rewrite.deadline_exceeded" if timed_out else "rewrite.abandoned")
+    metrics.observe("rewrite.abandoned_seconds", time.monotonic() - started)
+    logging.info(f"Rewrite abandoned ({reason}) after {time.monotonic() - started:.1f}s")
+
+
+def is_cached(user_input: str, tone: str, language: str, format_as_email: bool, catalog=None) -> bool:
+    """True if this rewrite can be served without calling a model."""
+    key = prompt_key(build_system_prompt(tone, language, format_as_email), scrub(user_input).text)
+    if catalog is not None and catalog.get(key):
+        return True
+    return key in REWRITE_CACHE
+
+
+def rewrite_message(user_input: str, tone: str, language: str, format_as_email: bool, api_key: str, catalog=None, deadline=None, fallback=None, reuse_similar: bool = True):
+    """Rewrite one message, serving it from the precomputed catalog or the rewrite cache when possible.
+
+    With `reuse_similar`, a near-identical earlier input's rewrite (see SIMILAR_INPUTS) is
+    served before any model is called.
+    `fallback` is a backend (see backends.py) tried when every model in the chain fails; its
+    output is returned but never cached, so the next attempt goes back to the models.
+    Personal details are replaced by placeholders first (see pii.py): models, caches and the
+    similarity index only ever see the scrubbed text, and the answer gets them back.
+    """
+    scrubbed = scrub(user_input)
+    return scrubbed.restore(_rewrite_scrubbed(scrubbed.text, tone, language, format_as_email, api_key, catalog, deadline, fallback, reuse_similar))
+
+
+def _rewrite_scrubbed(user_input: str, tone: str, language: str, format_as_email: bool, api_key: str, catalog, deadline, fallback, reuse_similar: bool):
+    with traffic_recorder.recording(user_input, tone, language, format_as_email) as record:
+        system_prompt = build_system_prompt(tone, language, format_as_email)
+        key = prompt_key(system_prompt, user_input)
+        if catalog is not None:
+            cached = catalog.get(key)
+            if cached:
+                SIMILAR_INPUTS.add(user_input, tone, language, format_as_email, cached)
+                record.update(source="catalog", status="ok")
+                return cached
+        cached = REWRITE_CACHE.get(key)
+        if cached:
+            SIMILAR_INPUTS.add(user_input, tone, language, format_as_email, cached)
+            record.update(source="cache", status="ok")
+            return cached
+        if reuse_similar:
+            similar = SIMILAR_INPUTS.lookup(user_input, tone, language, format_as_email)
+            if similar is not None:
+                # Not stored under this input's key, so "rewrite from scratch" still reaches the models.
+                record.update(source="similar", status="ok")
+                return similar.rewrite
+        rewritten = call_model_fallbacks(system_prompt, user_input, api_key, format_as_email=format_as_email, deadline=deadline, language=language)
+        if rewritten:
+            REWRITE_CACHE.set(key, rewritten)
+            SIMILAR_INPUTS.add(user_input, tone, language, format_as_email, rewritten)
+            record.update(source="model", status="ok")
+            return rewritten
+        if deadline is not None and (deadline.token.cancelled or deadline.expired):
+            record["status"] = "cancelled" if deadline.token.cancelled else "timeout"
+        if fallback is not None and not (deadline is not None and deadline.token.cancelled):
+            metrics.incr(f"rewrite.fallback.{fallback.name}")
+            rewritten = fallback.rewrite(user_input, tone, language, format_as_email, system_prompt, deadline)
+            if rewritten:
+                record.update(source="fallback", status="ok")
+            return rewritten
+        return None
+
+
+def _fan_out(calls: dict, deadline, heartbeat: float, scheduler, session_id: str, what: str):
+    """Run {label: (fn, args)} concurrently, yielding (label, result) as each finishes.
+
+    With `heartbeat`, (None, None) is also yielded every `heartbeat` seconds while waiting, so a
+    Streamlit caller gets regular yield points at which a rerun can interrupt it.
+    Given a `scheduler`, each call is queued as an interactive job of `session_id`.
+    Closing the generator early cancels the shared deadline and every outstanding call.
+    """
+    pool = None if scheduler is not None else ThreadPoolExecutor(max_workers=len(calls) or 1, thread_name_prefix=what)
+    futures = {}
+    try:
+        for label, (fn, args) in calls.items():
+            if scheduler is not None:
+                futures[scheduler.run(fn, *args, session_id=session_id, deadline=deadline)] = label
+            else:
+                futures[pool.submit(fn, *args)] = label
+    except Exception:
+        # Not admitted (e.g. the scheduler is full): drop the calls that were queued.
+        deadline.token.cancel(f"{what} not admitted")
+        raise
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=heartbeat, return_when=FIRST_COMPLETED)
+            if not done:
+                yield None, None
+            for future in done:
+                label = futures[future]
+                try:
+                    yield label, future.result()
+                except Exception as e:
+                    logging.error(f"{what.capitalize()} {label} failed: {e}")
+                    yield label, None
+    finally:
+        if pending:
+            deadline.token.cancel(f"{what} abandoned")
+            for future in pending:
+                future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def rewrite_all_tones(user_input: str, tones, language: str, format_as_email: bool, api_key: str, catalog=None, deadline=None, heartbeat: float = None, fallback=None, scheduler=None, session_id: str = ""):
+    """Rewrite the same input in every tone concurrently, yielding (tone, rewritten) as each finishes.
+
+    Heartbeats, scheduling and cancellation work as described in _fan_out.
+    """
+    deadline = deadline or Deadline()
+    calls = {tone: (rewrite_message, (user_input, tone, language, format_as_email, api_key, catalog, deadline, fallback)) for tone in tones}
+    yield from _fan_out(calls, deadline, heartbeat, scheduler, session_id, "comparison")
+
+
+# ---------------------- Multi-language mode ----------------------
+# The reframe is written once, in the user's chosen language; every extra language is a
+# short translation-only call on that text (cached like rewrites), all run in parallel,
+# so N languages cost about one rewrite plus one translation instead of N rewrites.
+def translate_rewrite(rewritten: str, user_input: str, tone: str, language: str, format_as_email: bool, api_key: str, catalog=None, deadline=None, fallback=None):
+    """`rewritten` in `language`: an existing rewrite of `user_input` if one is cached, else a translation."""
+    # Both texts are scrubbed on their own, so each answer is restored with its own placeholders.
+    source = scrub(user_input)
+    key = prompt_key(build_system_prompt(tone, language, format_as_email), source.text)
+    cached = (catalog.get(key) if catalog is not None else None) or REWRITE_CACHE.get(key)
+    if cached:
+        return source.restore(cached)
+    system_prompt = build_translation_prompt(language, format_as_email)
+    text = scrub(rewritten)
+    translation_key = prompt_key(system_prompt, text.text)
+    cached = REWRITE_CACHE.get(translation_key)
+    if cached:
+        metrics.incr("translate.cache_hits")
+        return text.restore(cached)
+    translated = call_model_fallbacks(system_prompt, text.text, api_key, format_as_email=format_as_email, deadline=deadline, language=language)
+    if translated:
+        metrics.incr("translate.model")
+        REWRITE_CACHE.set(translation_key, translated)
+        return text.restore(translated)
+    if fallback is not None and not (deadline is not None and deadline.token.cancelled):
+        metrics.incr(f"rewrite.fallback.{fallback.name}")
+        return source.restore(fallback.rewrite(source.text, tone, language, format_as_email, build_system_prompt(tone, language, format_as_email), deadline))
+    return None
+
+
+def translate_all(rewritten: str, user_input: str, tone: str, languages, format_as_email: bool, api_key: str, catalog=None, deadline=None, heartbeat: float = None, fallback=None, scheduler=None, session_id: str = ""):
+    """Translate `rewritten` (the reframe of `user_input`) into every language concurrently, yielding (language, text) as each finishes."""
+    deadline = deadline or Deadline()
+    calls = {language: (translate_rewrite, (rewritten, user_input, tone, language, format_as_email, api_key, catalog, deadline, fallback)) for language in languages}
+    yield from _fan_out(calls, deadline, heartbeat, scheduler, session_id, "translation")
@@ -0,0 +1,325 @@
+import threading
+
+# ---------------------- Rule-based rewriter ----------------------
+# Deterministic, network-free softening of harsh phrasing. All lexicon phrases for a
+# language are compiled into one Aho-Corasick automaton, so the input is scanned once,
+# left to right, regardless of how many phrases there are (linear in the input size).
+# Used for the instant preview shown while a model call is in flight and by the local
+# fallback backend when every model fails.
+
+DEFAULT = "default"
+
+# phrase -> substitution, either one string for every tone or {tone: text, "default": text}.
+# Phrases are matched case-insensitively on word boundaries (except CJK, which has none).
+LEXICON = {
+    "English": {
+        "you never": {
+            DEFAULT: "I'd like to see you more consistently",
+            "empathetic": "I know it isn't always easy, but it would mean a lot if you could more consistently",
+            "formal": "It would be appreciated if you could more consistently",
+            "friendly": "It'd be great if you could more often",
+            "assertive": "I need you to consistently",
+        },
+        "you always": {
+            DEFAULT: "I've noticed you often",
+            "empathetic": "I've noticed that sometimes you",
+            "formal": "It has been observed that you frequently",
+            "friendly": "I've noticed you tend to",
+            "assertive": "You frequently",
+        },
+        "you're constantly": {DEFAULT: "you're often", "formal": "you are frequently", "empathetic": "you're sometimes"},
+        "you are constantly": {DEFAULT: "you are often", "empathetic": "you are sometimes"},
+        "you need to": {
+            DEFAULT: "it would help if you could",
+            "formal": "it would be beneficial for you to",
+            "friendly": "it'd really help if you could",
+            "assertive": "I need you to",
+        },
+        "you must": {DEFAULT: "please make sure to", "assertive": "you need to"},
+        "you should": {DEFAULT: "you might consider", "assertive": "I'd like you to"},
+        "i shouldn't have to": "I'd prefer not to have to",
+        "i told you twice already": "as I mentioned earlier",
+        "per my last email": "following up on my earlier email",
+        "is always buggy": {DEFAULT: "sometimes has issues that need attention", "formal": "occasionally contains defects that require attention"},
+        "always buggy": "sometimes buggy",
+        "always": {DEFAULT: "often", "empathetic": "sometimes", "formal": "frequently"},
+        "never": {DEFAULT: "rarely", "empathetic": "not always"},
+        "it's really annoying": {DEFAULT: "it makes collaboration harder", "empathetic": "it can be hard for others", "friendly": "it can throw people off a bit"},
+        "really annoying": "quite distracting",
+        "annoying": "distracting",
+        "is useless": {DEFAULT: "isn't yet as useful as it could be", "assertive": "isn't meeting the need"},
+        "useless": "not yet useful",
+        "are boring": {DEFAULT: "could be more engaging", "friendly": "could use a bit more energy"},
+        "is boring": {DEFAULT: "could be more engaging", "friendly": "could use a bit more energy"},
+        "boring": "a bit dry",
+        "put everyone to sleep": "could hold people's attention better",
+        "stupid": "unclear",
+        "dumb": "unclear",
+        "terrible": "below what we need",
+        "awful": "not where we need it to be",
+        "horrible": "not where we need it to be",
+        "lazy": "less engaged than usual",
+        "unprofessional": {DEFAULT: "not in line with our professional standards", "friendly": "not quite how we like to work together"},
+        "incompetent": "still building the skills this needs",
+        "ridiculous": "hard to understand",
+        "waste of time": "not the best use of our time",
+        "doesn't make sense": "needs more clarity",
+        "don't make sense": "need more clarity",
+        "all wrong": "partly inaccurate",
+        "it's not fair": "it's something we should talk about",
+        "not fair": "something we should talk about",
+        "your fault": "something we can fix together",
+        "shut up": "let others finish",
+        "i hate": "I struggle with",
+        "no one understands": "some people find it hard to follow",
+        "only care about yourself": "could focus more on the team",
+        "not a team player": "could collaborate more closely with the team",
+        "creates more work for everyone else": "creates extra follow-up work for the team",
+        "it's just not going to work": "I have some concerns about how it would work",
+        "not going to work": "likely to face some challenges",
+        "you're not a good fit for this team": "there may be a mismatch between you and how this team works",
+        "you're not a good fit": "this may not be the best fit",
+        "cant": "can't",
+        "dont": "don't",
+        "wont": "won't",
+    },
+    "Spanish": {
+        "nunca escuchas": "me gustaría que escucharas más",
+        "siempre": "a menudo",
+        "muy molesto": "algo incómodo",
+        "molesto": "incómodo",
+        "inútil": "mejorable",
+        "aburrido": "poco dinámico",
+        "terrible": "por debajo de lo esperado",
+        "horrible": "por debajo de lo esperado",
+    },
+    "French": {
+        "tu n'écoutes jamais": "j'aimerais que tu écoutes davantage",
+        "toujours": "souvent",
+        "agaçant": "gênant",
+        "inutile": "perfectible",
+        "ennuyeux": "peu dynamique",
+        "nul": "à améliorer",
+        "horrible": "en deçà des attentes",
+    },
+    "German": {
+        "du hörst nie zu": "ich wünsche mir, dass du öfter zuhörst",
+        "immer": "oft",
+        "nervig": "störend",
+        "nutzlos": "verbesserungsfähig",
+        "langweilig": "wenig mitreißend",
+        "schrecklich": "nicht wie erwartet",
+    },
+    "Italian": {
+        "non ascolti mai": "mi piacerebbe che ascoltassi di più",
+        "sempre": "spesso",
+        "fastidioso": "poco piacevole",
+        "inutile": "migliorabile",
+        "noioso": "poco coinvolgente",
+        "terribile": "al di sotto delle aspettative",
+    },
+    "Portuguese": {
+        "você nunca escuta": "gostaria que você escutasse mais",
+        "sempre": "muitas vezes",
+        "irritante": "incômodo",
+        "inútil": "melhorável",
+        "chato": "pouco envolvente",
+        "péssimo": "abaixo do esperado",
+    },
+    "Japanese": {
+        "いつも": "時々",
+        "うるさい": "少し気になる",
+        "役に立たない": "改善の余地がある",
+        "つまらない": "もう少し工夫できる",
+        "最悪": "改善が必要",
+    },
+    "Korean": {
+        "항상": "가끔",
+        "짜증나": "조금 불편해",
+        "쓸모없": "개선할 여지가 있",
+        "지루해": "조금 더 흥미로울 수 있어",
+        "최악": "개선이 필요해",
+    },
+    "Chinese": {
+        "总是": "有时",
+        "烦人": "让人有些困扰",
+        "没用": "还有改进空间",
+        "无聊": "可以更生动",
+        "糟糕": "需要改进",
+    },
+}
+
+# Delivery tips per tone, and the email frame, in each supported language.
+TIPS = {
+    "English": {
+        DEFAULT: "Share this in a private 1:1 and ask how you can help.",
+        "empathetic": "Open by asking how they're doing, then share this privately and listen before suggesting next steps.",
+        "formal": "Raise this in a scheduled 1:1 and follow up in writing with the agreed next steps.",
+        "friendly": "Bring it up casually over a coffee chat and keep the tone light and supportive.",
+        "assertive": "Say this directly in a 1:1, agree on one concrete change, and set a date to check in.",
+    },
+    "Spanish": {DEFAULT: "Compártelo en una conversación privada y pregunta cómo puedes ayudar."},
+    "French": {DEFAULT: "Partagez-le lors d'un échange en tête-à-tête et demandez comment vous pouvez aider."},
+    "German": {DEFAULT: "Sprich es in einem Vier-Augen-Gespräch an und frag, wie du unterstützen kannst."},
+    "Italian": {DEFAULT: "Condividilo in un incontro privato e chiedi come puoi aiutare."},
+    "Portuguese": {DEFAULT: "Compartilhe isso em uma conversa individual e pergunte como você pode ajudar."},
+    "Japanese": {DEFAULT: "1対1の場で伝え、どのようにサポートできるか尋ねましょう。"},
+    "Korean": {DEFAULT: "1:1 자리에서 전달하고 어떻게 도울 수 있을지 물어보세요."},
+    "Chinese": {DEFAULT: "在一对一的私下交流中提出，并询问你能提供什么帮助。"},
+}
+
+EMAIL_FRAME = {
+    "English": ("Subject: Some thoughts on how we work together", "Hi,", "Best regards,"),
+    "Spanish": ("Asunto: Algunas ideas sobre cómo trabajamos juntos", "Hola:", "Saludos cordiales,"),
+    "French": ("Objet : Quelques réflexions sur notre collaboration", "Bonjour,", "Cordialement,"),
+    "German": ("Betreff: Gedanken zu unserer Zusammenarbeit", "Hallo,", "Viele Grüße"),
+    "Italian": ("Oggetto: Alcune riflessioni sulla nostra collaborazione", "Ciao,", "Cordiali saluti,"),
+    "Portuguese": ("Assunto: Algumas ideias sobre como trabalhamos juntos", "Olá,", "Atenciosamente,"),
+    "Japanese": ("件名: 今後の協力について", "お疲れさまです。", "よろしくお願いいたします。"),
+    "Korean": ("제목: 함께 일하는 방식에 대한 생각", "안녕하세요,", "감사합니다."),
+    "Chinese": ("主题：关于我们合作方式的一些想法", "你好，", "此致敬礼"),
+}
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch in "'’"
+
+
+def _needs_boundary(ch: str) -> bool:
+    # CJK scripts do not separate words with spaces, so boundaries only apply elsewhere.
+    return _is_word_char(ch) and ord(ch) < 0x3000
+
+
+class PhraseMatcher:
+    """Aho-Corasick automaton over lowercase phrases; finds leftmost-longest, non-overlapping matches."""
+
+    def __init__(self, phrases):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]  # phrase lengths ending at each node, longest first
+        for phrase in phrases:
+            node = 0
+            for ch in phrase:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = nxt
+            self._out[node] = (len(phrase),)
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        order = list(self._goto[0].values())
+        head = 0
+        while head < len(order):
+            node = order[head]
+            head += 1
+            for ch, child in self._goto[node].items():
+                order.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = tuple(sorted(set(self._out[child] + self._out[self._fail[child]]), reverse=True))
+
+    def find(self, text: str):
+        """Yield (start, end) spans of non-overlapping matches, leftmost first, longest at each start."""
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # Rare characters change length when lowercased; fold them one by one instead.
+            lowered = "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+        goto, fail, out = self._goto, self._fail, self._out
+        best = {}  # start -> longest valid match length starting there
+        node = 0
+        n = len(text)
+        for i, ch in enumerate(lowered):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if not out[node]:
+                continue
+            end = i + 1
+            for length in out[node]:
+                start = end - length
+                if _needs_boundary(lowered[start]) and start > 0 and _is_word_char(lowered[start - 1]):
+                    continue
+                if _needs_boundary(lowered[i]) and end < n and _is_word_char(lowered[end]):
+                    continue
+                if length > best.get(start, 0):
+                    best[start] = length
+                break
+
+        # Starts were discovered out of order (by end position); resolve overlaps left to right.
+        last_end = 0
+        for start in sorted(best):
+            if start >= last_end:
+                last_end = start + best[start]
+                yield start, last_end
+
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+def _lexicon_for(language: str) -> dict:
+    # Inputs are often written in English even when the output language differs.
+    merged = dict(LEXICON["English"])
+    if language != "English":
+        merged.update(LEXICON.get(language, {}))
+    return merged
+
+
+def _matcher_for(language: str):
+    with _matchers_lock:
+        entry = _matchers.get(language)
+        if entry is None:
+            lexicon = _lexicon_for(language)
+            entry = (PhraseMatcher(lexicon), lexicon)
+            _matchers[language] = entry
+        return entry
+
+
+def _substitution(value, tone: str) -> str:
+    if isinstance(value, str):
+        return value
+    return value.get(tone) or value[DEFAULT]
+
+
+def rule_rewrite(text: str, tone: str, language: str = "English") -> str:
+    """Soften harsh phrases in `text` in a single pass; returns the rewritten text only."""
+    text = text.strip()
+    if not text:
+        return ""
+    matcher, lexicon = _matcher_for(language)
+    pieces = []
+    last = 0
+    for start, end in matcher.find(text):
+        matched = text[start:end]
+        replacement = _substitution(lexicon[matched.lower()], tone)
+        if matched[0].isupper() and replacement[0].islower():
+            replacement = replacement[0].upper() + replacement[1:]
+        pieces.append(text[last:start])
+        pieces.append(replacement)
+        last = end
+    pieces.append(text[last:])
+    out = "".join(pieces)
+    return out[0].upper() + out[1:]
+
+
+def rule_tip(tone: str, language: str) -> str:
+    tips = TIPS.get(language, TIPS["English"])
+    return tips.get(tone) or tips[DEFAULT]
+
+
+def rule_rewrite_formatted(text: str, tone: str, language: str, format_as_email: bool) -> str:
+    """Rule-based rewrite wrapped in the same structure the prompts ask models for."""
+    rewritten = rule_rewrite(text, tone, language)
+    if format_as_email:
+        subject, greeting, closing = EMAIL_FRAME.get(language, EMAIL_FRAME["English"])
+        return f"{subject}\n\n{greeting}\n\n{rewritten}\n\n{closing}"
+    return f"The Reframe:\n{rewritten}\n\nBonus Tip:\n{rule_tip(tone, language)}"
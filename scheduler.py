@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import accounting
+import metrics
+
+# ---------------------- Rewrite job scheduler ----------------------
+# Every rewrite the app runs is a RewriteJob submitted here. Jobs are served strictly by
+# priority class, and round-robin across sessions within a class, so one session with
+# twenty queued inputs gets one worker turn for every turn of each other waiting session.
+# Prefetch and batch work may only occupy BACKGROUND_SHARE of the workers, leaving the
+# rest free for interactive jobs. Admission control rejects work up front (QueueFull)
+# instead of letting the queue grow without bound.
+
+INTERACTIVE = 0
+PREFETCH = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", PREFETCH: "prefetch", BATCH: "batch"}
+
+MAX_QUEUED_PER_SESSION = 32
+MAX_QUEUED_TOTAL = 512
+BACKGROUND_SHARE = 0.5
+INITIAL_SERVICE_SECONDS = 5.0
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RewriteJob:
+    """One unit of upstream work: `fn(*args, **kwargs)` on behalf of `session_id`.
+
+    `deadline` (optional) lets a job that is cancelled while still queued be dropped
+    without ever reaching a worker.
+    """
+
+    def __init__(self, fn, args=(), kwargs=None, session_id: str = "", priority: int = INTERACTIVE, deadline=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.session_id = session_id
+        self.priority = priority
+        self.deadline = deadline
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.future.cancelled() or (self.deadline is not None and self.deadline.token.cancelled)
+
+
+class Scheduler:
+    def __init__(self, workers: int = 16, max_per_session: int = MAX_QUEUED_PER_SESSION, max_total: int = MAX_QUEUED_TOTAL, background_share: float = BACKGROUND_SHARE):
+        self.workers = workers
+        self.max_per_session = max_per_session
+        self.max_total = max_total
+        self.background_slots = max(1, int(workers * background_share))
+        # priority -> OrderedDict(session_id -> deque of jobs); dict order is the round-robin order
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._queued = 0
+        self._running_background = 0
+        self._service_seconds = INITIAL_SERVICE_SECONDS
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"rewrite-{i}", daemon=True).start()
+
+    # ---- submission ----
+    def submit(self, job: RewriteJob) -> Future:
+        """Queue `job` and return its future; raises QueueFull if it cannot be admitted."""
+        with self._cond:
+            sessions = self._queues[job.priority]
+            pending = sessions.get(job.session_id)
+            if self._queued >= self.max_total:
+                raise QueueFull("the service is at capacity")
+            if pending is not None and len(pending) >= self.max_per_session:
+                raise QueueFull("too many requests from this session are already waiting")
+            if job.priority != INTERACTIVE and self._queued >= self.workers:
+                # Background work is only admitted while the system has idle capacity.
+                raise QueueFull(f"{PRIORITY_NAMES[job.priority]} work deferred while busy")
+            if pending is None:
+                pending = sessions[job.session_id] = deque()
+            pending.append(job)
+            self._queued += 1
+            self._cond.notify()
+        metrics.incr(f"scheduler.submitted.{PRIORITY_NAMES[job.priority]}")
+        return job.future
+
+    def run(self, fn, *args, session_id: str = "", priority: int = INTERACTIVE, deadline=None, **kwargs) -> Future:
+        """Shorthand for submit(RewriteJob(fn, args, kwargs, ...))."""
+        return self.submit(RewriteJob(fn, args, kwargs, session_id, priority, deadline))
+
+    # ---- dispatch ----
+    def _next_job(self):
+        """Pop the next job to run (caller holds the lock), or None if nothing is runnable."""
+        for priority, sessions in self._queues.items():
+            if priority != INTERACTIVE and self._running_background >= self.background_slots:
+                continue
+            while sessions:
+                session_id, pending = next(iter(sessions.items()))
+                job = pending.popleft()
+                self._queued -= 1
+                # Rotate: this session goes to the back of the line for its next job.
+                del sessions[session_id]
+                if pending:
+                    sessions[session_id] = pending
+                if job.cancelled:
+                    job.future.cancel()
+                    metrics.incr("scheduler.dropped_cancelled")
+                    continue
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                if job.priority != INTERACTIVE:
+                    self._running_background += 1
+            if job.future.set_running_or_notify_cancel():
+                job.started_at = time.monotonic()
+                metrics.observe(f"scheduler.wait.{PRIORITY_NAMES[job.priority]}", job.started_at - job.submitted_at)
+                try:
+                    # Upstream usage inside the job is charged to the session that submitted it.
+                    with accounting.session(job.session_id):
+                        result = job.fn(*job.args, **job.kwargs)
+                    job.future.set_result(result)
+                except Exception as e:
+                    logging.error(f"Rewrite job failed: {e}")
+                    job.future.set_exception(e)
+                elapsed = time.monotonic() - job.started_at
+            else:
+                elapsed = None
+            with self._cond:
+                if job.priority != INTERACTIVE:
+                    self._running_background -= 1
+                    self._cond.notify()
+                if elapsed is not None:
+                    # Exponentially weighted service time, used for wait estimates.
+                    self._service_seconds += 0.2 * (elapsed - self._service_seconds)
+
+    # ---- introspection ----
+    def position(self, job: RewriteJob):
+        """Jobs that will be dispatched before `job`, or None once it has left the queue."""
+        with self._cond:
+            sessions = self._queues[job.priority]
+            pending = sessions.get(job.session_id)
+            if pending is None or job not in pending:
+                return None
+            index = pending.index(job)
+            ahead = sum(len(queue) for priority, other in self._queues.items() if priority < job.priority for queue in other.values())
+            # Round-robin: each session ahead of ours in the rotation gets index + 1 turns first, the rest index turns.
+            before = True
+            for session_id, queue in sessions.items():
+                if session_id == job.session_id:
+                    before = False
+                    continue
+                ahead += min(len(queue), index + 1 if before else index)
+            return ahead + index
+
+    def estimated_wait(self, job: RewriteJob):
+        """Rough seconds until `job` starts, from its position and the recent service time."""
+        ahead = self.position(job)
+        if ahead is None:
+            return None
+        return (ahead // self.workers + 1) * self._service_seconds
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": {PRIORITY_NAMES[p]: sum(len(q) for q in s.values()) for p, s in self._queues.items()},
+                "sessions_waiting": len({sid for s in self._queues.values() for sid in s}),
+                "running_background": self._running_background,
+                "service_seconds": self._service_seconds,
+            }
@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import metrics
+from text_codec import pack, unpack
+
+# ---------------------- Session footprint & idle offload ----------------------
+# Every connected browser keeps its st.session_state in server memory for as long as its
+# websocket lives, idle or not. The monitor estimates each session's footprint at the end
+# of every script run (checkpoint) and, from a background sweep, moves the unbounded
+# containers of sessions idle for SESSION_IDLE_SECONDS to a JSON file in SESSION_SPILL_DIR:
+#   offloaded   OFFLOAD_KEYS (history, tone comparisons, translations); emptied in place,
+#               so the objects session_state holds are the ones refilled later
+#   kept        strings and flags; they are bounded by MAX_INPUT_CHARS and small
+# With COMPRESS_TEXT on, spill files are compressed with the text dictionary (text_codec.py).
+# The next script run of that session starts with resume(), which refills the containers
+# before anything reads them. Memory therefore grows with active users, not connected
+# ones. Spill files of sessions that never come back are deleted after SPILL_TTL_SECONDS,
+# including those left behind by an earlier process.
+# Spill files hold users' raw messages (they must restore exactly), so the directory is
+# private to the app's user (0700), each file is created 0600, and files are named by the
+# session's random id; a file is deleted as soon as its session is restored.
+
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", 900))
+SESSION_SPILL_DIR = os.environ.get("SESSION_SPILL_DIR", "") or os.path.join(tempfile.gettempdir(), "reframe-sessions")
+SWEEP_SECONDS = 60
+SPILL_TTL_SECONDS = 24 * 3600
+# A run that never reached checkpoint() (st.rerun(), an exception) stops counting as active after this long.
+MAX_RUN_SECONDS = 600
+OFFLOAD_KEYS = ("rewrites", "tone_variants", "translations")
+
+
+def estimate_bytes(value, _seen=None, _depth=0) -> int:
+    """Approximate memory held by `value`: sys.getsizeof summed over strings and nested containers."""
+    seen = set() if _seen is None else _seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value, 64)
+    if _depth > 8:
+        return size
+    if isinstance(value, dict):
+        size += sum(estimate_bytes(k, seen, _depth + 1) + estimate_bytes(v, seen, _depth + 1) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_bytes(item, seen, _depth + 1) for item in value)
+    return size
+
+
+class _Session:
+    __slots__ = ("session_id", "containers", "bytes", "last_seen", "running_since", "spill_path", "lock")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.containers = {}
+        self.bytes = 0
+        self.last_seen = time.monotonic()
+        self.running_since = None
+        self.spill_path = ""
+        self.lock = threading.Lock()
+
+
+class SessionMonitor:
+    """Per-session footprint estimates plus offloading of idle sessions' large fields; thread-safe."""
+
+    def __init__(self, idle_seconds: float = SESSION_IDLE_SECONDS, spill_dir: str = SESSION_SPILL_DIR, sweep_seconds: float = SWEEP_SECONDS):
+        self.idle_seconds = idle_seconds
+        self.spill_dir = spill_dir
+        self.sweep_seconds = sweep_seconds
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.offloaded = 0
+        self.rehydrated = 0
+
+    def start(self) -> "SessionMonitor":
+        if self._thread is None and self.idle_seconds > 0:
+            self._thread = threading.Thread(target=self._loop, name="session-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def _loop(self):
+        while True:
+            time.sleep(self.sweep_seconds)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.warning(f"Session sweep failed: {e}")
+
+    def _session(self, session_id: str) -> _Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session(session_id)
+            return session
+
+    def resume(self, session_id: str) -> bool:
+        """Call at the top of every script run; refills offloaded fields. True if it had to."""
+        session = self._session(session_id)
+        with session.lock:
+            session.running_since = time.monotonic()
+            session.last_seen = session.running_since
+            if not session.spill_path:
+                return False
+            try:
+                with open(session.spill_path, "rb") as f:
+                    saved = json.loads(unpack(f.read()))
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not restore offloaded session {session_id}: {e}")
+                saved = {}
+            for key, container in session.containers.items():
+                if key not in saved:
+                    continue
+                if isinstance(container, list):
+                    container[:] = saved[key]
+                else:
+                    container.update(saved[key])
+            self._remove(session.spill_path)
+            session.spill_path = ""
+        self.rehydrated += 1
+        metrics.incr("sessions.rehydrated")
+        return True
+
+    def checkpoint(self, session_id: str, state) -> int:
+        """Call at the end of every script run with st.session_state; returns the session's estimated bytes."""
+        session = self._session(session_id)
+        items = dict(state.items())
+        size = estimate_bytes(items)
+        with session.lock:
+            session.bytes = size
+            session.containers = {key: items[key] for key in OFFLOAD_KEYS if isinstance(items.get(key), (list, dict))}
+            session.last_seen = time.monotonic()
+            session.running_since = None
+        return size
+
+    def sweep(self, now: float = None) -> int:
+        """Offload every idle session's large fields and forget long-gone sessions; returns how many were offloaded."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            sessions = list(self._sessions.values())
+        offloaded = 0
+        for session in sessions:
+            if now - session.last_seen > SPILL_TTL_SECONDS:
+                with session.lock:
+                    if session.spill_path:
+                        self._remove(session.spill_path)
+                with self._lock:
+                    self._sessions.pop(session.session_id, None)
+                continue
+            if self._offload(session, now):
+                offloaded += 1
+        self._remove_orphans()
+        self.offloaded += offloaded
+        if offloaded:
+            metrics.incr("sessions.offloaded", offloaded)
+        return offloaded
+
+    def _offload(self, session: _Session, now: float) -> bool:
+        with session.lock:
+            running = session.running_since is not None and now - session.running_since < MAX_RUN_SECONDS
+            if running or session.spill_path or now - session.last_seen < self.idle_seconds or not any(session.containers.values()):
+                return False
+            path = os.path.join(self.spill_dir, f"{session.session_id}.json")
+            try:
+                os.makedirs(self.spill_dir, mode=0o700, exist_ok=True)
+                # makedirs leaves an existing directory's mode alone
+                os.chmod(self.spill_dir, 0o700)
+                data = pack(json.dumps(session.containers, ensure_ascii=False))
+                fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with open(fd, "wb") as f:
+                    f.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+                os.replace(path + ".tmp", path)
+            except (OSError, TypeError, ValueError) as e:
+                logging.warning(f"Could not offload session {session.session_id}: {e}")
+                self._remove(path + ".tmp")
+                return False
+            freed = estimate_bytes(session.containers)
+            for container in session.containers.values():
+                container.clear()
+            session.bytes = max(0, session.bytes - freed) + estimate_bytes(session.containers)
+            session.spill_path = path
+            return True
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _remove_orphans(self) -> None:
+        """Delete spill files older than SPILL_TTL_SECONDS that no tracked session owns (a restarted process)."""
+        with self._lock:
+            owned = {session.spill_path for session in self._sessions.values()}
+        try:
+            names = os.listdir(self.spill_dir)
+        except OSError:
+            return
+        cutoff = time.time() - SPILL_TTL_SECONDS
+        for name in names:
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if path not in owned and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def report(self) -> dict:
+        """Sessions tracked, how many are offloaded, estimated bytes in total and for the largest sessions."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        largest = sorted(sessions, key=lambda s: -s.bytes)[:10]
+        return {
+            "sessions": len(sessions),
+            "offloaded": sum(1 for s in sessions if s.spill_path),
+            "total_bytes": sum(s.bytes for s in sessions),
+            "largest": [{"session": s.session_id, "bytes": s.bytes, "idle_seconds": round(time.monotonic() - s.last_seen), "offloaded": bool(s.spill_path)} for s in largest],
+        }
@@ -0,0 +1,213 @@
+import re
+import threading
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+
+import metrics
+from text_codec import pack, unpack
+
+# ---------------------- Near-duplicate input index ----------------------
+# Finds a previously rewritten input that is nearly the same as a new one (a typo fixed,
+# a word swapped, a viral sample lightly edited), so its rewrite can be reused instead of
+# walking the model fallback chain again. Entries are partitioned by (tone, language,
+# email mode); a match never crosses partitions.
+#   signature  MinHash over character 3-grams, computed with one-permutation hashing
+#              (a single hash per shingle, 64 bins, empty bins densified from a neighbour)
+#   LSH        16 bands of 4 bins; inputs sharing any band are candidates
+#   verify     exact Jaccard similarity of the candidates' shingle sets >= threshold, the
+#              same numbers (a changed date or count must not reuse the old rewrite), and
+#              only word-for-word edits: every changed word must be a respelling of one on
+#              the other side, so an inserted "not" or an added sentence is never "similar"
+# Lookups touch a handful of candidates and stay well under a millisecond. Memory is
+# bounded by max_entries (LRU) and MAX_INDEXED_CHARS per input. Hashes come from Python's
+# per-process string hash, so the index lives in one process and is rebuilt as it runs.
+# Rewrites are kept through text_codec.pack (compressed when COMPRESS_TEXT is on).
+
+SHINGLE_CHARS = 3
+NUM_BINS = 64
+BANDS = 16
+ROWS = NUM_BINS // BANDS
+MIN_INDEXED_CHARS = 20
+MAX_INDEXED_CHARS = 4000
+MAX_CANDIDATES = 4
+# Candidates must share this many bands; at the default threshold a true match shares
+# about 6 of 16, and fewer than 2 happens for well under 1% of them.
+MIN_BAND_VOTES = 2
+DEFAULT_THRESHOLD = 0.8
+# Two words count as respellings of each other at this difflib ratio.
+RESPELLING_RATIO = 0.6
+
+_EMPTY = 1 << 64
+_VALUE_MASK = (1 << 58) - 1
+_DIGITS = re.compile(r"\d+")
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _shingles(normalized: str) -> set:
+    # zip over shifted copies is about twice as fast as slicing in a comprehension.
+    if len(normalized) <= SHINGLE_CHARS:
+        return {normalized}
+    return set(map("".join, zip(*(normalized[i:] for i in range(SHINGLE_CHARS)))))
+
+
+def _signature(shingles) -> list:
+    bins = [_EMPTY] * NUM_BINS
+    for h in map(hash, shingles):
+        b = h & (NUM_BINS - 1)
+        v = (h >> 6) & _VALUE_MASK
+        if v < bins[b]:
+            bins[b] = v
+    if _EMPTY in bins:
+        # Densification: an empty bin takes the next non-empty bin's value, salted with
+        # the distance, so two inputs agree on it exactly when they agree on the source.
+        filled = bins[:]
+        for i, value in enumerate(bins):
+            if value == _EMPTY:
+                for distance in range(1, NUM_BINS):
+                    source = bins[(i + distance) % NUM_BINS]
+                    if source != _EMPTY:
+                        filled[i] = hash((source, distance))
+                        break
+        bins = filled
+    return bins
+
+
+def _band_keys(signature) -> list:
+    return [hash(tuple(signature[band * ROWS:(band + 1) * ROWS])) for band in range(BANDS)]
+
+
+def _only_respellings(a: str, b: str) -> bool:
+    """True if `b` differs from `a` only by words that are respellings of words in `a`."""
+    removed = list((Counter(a.split()) - Counter(b.split())).elements())
+    added = list((Counter(b.split()) - Counter(a.split())).elements())
+    if len(removed) != len(added):
+        return False
+    for word in added:
+        match = max(removed, key=lambda other: SequenceMatcher(None, word, other).ratio())
+        if SequenceMatcher(None, word, match).ratio() < RESPELLING_RATIO:
+            return False
+        removed.remove(match)
+    return True
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class SimilarMatch:
+    def __init__(self, rewrite: str, similarity: float, text: str):
+        self.rewrite = rewrite
+        self.similarity = similarity
+        self.text = text
+
+
+class _Entry:
+    __slots__ = ("partition", "text", "digits", "bands", "rewrite")
+
+    def __init__(self, partition, text, digits, bands, rewrite):
+        self.partition = partition
+        self.text = text
+        self.digits = digits
+        self.bands = bands
+        self.rewrite = rewrite
+
+
+class SimilarityIndex:
+    """Bounded LSH index of rewritten inputs; thread-safe."""
+
+    def __init__(self, max_entries: int = 4096, threshold: float = DEFAULT_THRESHOLD):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        # (partition, normalized text) -> _Entry, in LRU order
+        self._entries = OrderedDict()
+        # partition -> one {band key -> set of entry keys} per band
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.threshold <= 1
+
+    def add(self, text: str, tone: str, language: str, format_as_email: bool, rewrite: str) -> None:
+        """Index `text` (already rewritten as `rewrite`) for later near-duplicate lookups."""
+        normalized = _normalize(text)
+        if not self.enabled or not rewrite or not MIN_INDEXED_CHARS <= len(normalized) <= MAX_INDEXED_CHARS:
+            return
+        partition = (tone, language, bool(format_as_email))
+        key = (partition, normalized)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.rewrite = pack(rewrite)
+                self._entries.move_to_end(key)
+                return
+        bands = _band_keys(_signature(_shingles(normalized)))
+        entry = _Entry(partition, normalized, _DIGITS.findall(normalized), bands, pack(rewrite))
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            buckets = self._buckets.setdefault(partition, [{} for _ in range(BANDS)])
+            for band, band_key in enumerate(bands):
+                buckets[band].setdefault(band_key, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Drop the least recently used entry (caller holds the lock)."""
+        key, entry = self._entries.popitem(last=False)
+        buckets = self._buckets[entry.partition]
+        for band, band_key in enumerate(entry.bands):
+            members = buckets[band].get(band_key)
+            if members is not None:
+                members.discard(key)
+                if not members:
+                    del buckets[band][band_key]
+
+    def lookup(self, text: str, tone: str, language: str, format_as_email: bool, threshold: float = None):
+        """The most similar indexed input at or above the threshold, as a SimilarMatch, or None."""
+        threshold = self.threshold if threshold is None else threshold
+        normalized = _normalize(text)
+        if not self.enabled or not MIN_INDEXED_CHARS <= len(normalized) <= MAX_INDEXED_CHARS:
+            return None
+        partition = (tone, language, bool(format_as_email))
+        shingles = _shingles(normalized)
+        bands = _band_keys(_signature(shingles))
+        with self._lock:
+            buckets = self._buckets.get(partition)
+            votes = Counter()
+            if buckets is not None:
+                for band, band_key in enumerate(bands):
+                    votes.update(buckets[band].get(band_key, ()))
+            candidates = [self._entries[key] for key, count in votes.most_common(MAX_CANDIDATES) if count >= MIN_BAND_VOTES]
+        digits = _DIGITS.findall(normalized)
+        best = None
+        for entry in candidates:
+            if entry.digits != digits:
+                continue
+            similarity = 1.0 if entry.text == normalized else jaccard(shingles, _shingles(entry.text))
+            if similarity < threshold or (best is not None and similarity <= best.similarity):
+                continue
+            if similarity == 1.0 or _only_respellings(entry.text, normalized):
+                best = SimilarMatch(unpack(entry.rewrite), similarity, entry.text)
+        with self._lock:
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                key = (partition, best.text)
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+        metrics.incr("similarity.hits" if best is not None else "similarity.misses")
+        return best
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,444 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse
+
+from rate_limit import TokenBucket
+
+# ---------------------- Shared state backends ----------------------
+# State that must be shared by every replica of the app (rewrite cache, model health
+# stats, upstream rate-limit buckets, the feedback store) goes through one of these.
+# Selected by URL, from the STATE_BACKEND secret or environment variable:
+#   memory                      per-process (the default; a single replica)
+#   sqlite:///path/to/state.db  one node, any number of processes (WAL mode)
+#   redis://host:6379/0         any number of nodes
+# Values are strings; callers serialise anything richer themselves.
+
+DEFAULT_STATE_URL = "memory"
+# How often SQLiteBackend deletes expired keys (reads already skip and drop them).
+SQLITE_SWEEP_SECONDS = 60
+
+
+class StateBackendError(Exception):
+    pass
+
+
+class StateBackend(ABC):
+    """What every backend implements; `shared` is False when the state lives in this process only."""
+
+    shared = True
+
+    @abstractmethod
+    def get(self, key: str):
+        """Return the string stored at `key`, or None."""
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl: float = None) -> None:
+        """Store `value` at `key`; with `ttl` it expires after that many seconds."""
+
+    @abstractmethod
+    def hincr(self, name: str, field: str, amount: float = 1, ttl: float = None) -> float:
+        """Add `amount` to a numeric field of the hash `name`; returns the new value.
+
+        With `ttl`, the whole hash expires `ttl` seconds after this write.
+        """
+
+    @abstractmethod
+    def hgetall(self, name: str) -> dict:
+        """All fields of the hash `name` as {field: float}."""
+
+    @abstractmethod
+    def append(self, name: str, value: str) -> None:
+        """Append to the list `name`."""
+
+    @abstractmethod
+    def items(self, name: str, start: int = 0, stop: int = -1) -> list:
+        """Slice of the list `name`, inclusive of `stop` (Redis LRANGE semantics)."""
+
+    @abstractmethod
+    def take(self, name: str, tokens: float, rate: float, capacity: float) -> bool:
+        """Take `tokens` from the shared bucket `name` (`rate`/s, up to `capacity`) if available now."""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Per-process state; what the app used before there was more than one replica."""
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._hashes = {}
+        self._hash_expires = {}
+        self._lists = {}
+        self._buckets = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def hincr(self, name, field, amount=1, ttl=None):
+        with self._lock:
+            fields = self._live_hash(name)
+            if fields is None:
+                fields = self._hashes[name] = {}
+            fields[field] = fields.get(field, 0.0) + amount
+            if ttl:
+                self._hash_expires[name] = time.time() + ttl
+            return fields[field]
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._live_hash(name) or {})
+
+    def _live_hash(self, name):
+        expires = self._hash_expires.get(name)
+        if expires is not None and expires <= time.time():
+            del self._hash_expires[name]
+            self._hashes.pop(name, None)
+        return self._hashes.get(name)
+
+    def append(self, name, value):
+        with self._lock:
+            self._lists.setdefault(name, []).append(value)
+
+    def items(self, name, start=0, stop=-1):
+        with self._lock:
+            values = self._lists.get(name, [])
+            return values[start:] if stop == -1 else values[start:stop + 1]
+
+    def take(self, name, tokens, rate, capacity):
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = TokenBucket(rate, capacity)
+        return bucket.try_acquire(tokens)
+
+
+class SQLiteBackend(StateBackend):
+    """Single-node shared state in one SQLite file in WAL mode; safe across processes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._next_sweep = 0.0
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL);
+                CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires) WHERE expires IS NOT NULL;
+                CREATE TABLE IF NOT EXISTS hashes (name TEXT, field TEXT, value REAL NOT NULL, PRIMARY KEY (name, field));
+                CREATE TABLE IF NOT EXISTS hash_expires (name TEXT PRIMARY KEY, expires REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS lists (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, value TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS lists_name ON lists (name, id);
+                CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= time.time():
+            # The expiry check is repeated so a value another process just set is kept.
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires <= ?", (key, time.time()))
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl=None):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None),
+        )
+        self._sweep(conn)
+
+    def _sweep(self, conn) -> None:
+        """Delete expired keys and hashes, at most once per SQLITE_SWEEP_SECONDS per process."""
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + SQLITE_SWEEP_SECONDS
+        conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (now,))
+        conn.execute("DELETE FROM hashes WHERE name IN (SELECT name FROM hash_expires WHERE expires <= ?)", (now,))
+        conn.execute("DELETE FROM hash_expires WHERE expires <= ?", (now,))
+
+    def hincr(self, name, field, amount=1, ttl=None):
+        conn = self._conn()
+        self._expire_hash(conn, name)
+        conn.execute(
+            "INSERT INTO hashes (name, field, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (name, field) DO UPDATE SET value = value + excluded.value",
+            (name, field, amount),
+        )
+        if ttl:
+            conn.execute("INSERT OR REPLACE INTO hash_expires (name, expires) VALUES (?, ?)", (name, time.time() + ttl))
+            self._sweep(conn)
+        return conn.execute("SELECT value FROM hashes WHERE name = ? AND field = ?", (name, field)).fetchone()[0]
+
+    def hgetall(self, name):
+        conn = self._conn()
+        self._expire_hash(conn, name)
+        return dict(conn.execute("SELECT field, value FROM hashes WHERE name = ?", (name,)).fetchall())
+
+    @staticmethod
+    def _expire_hash(conn, name) -> None:
+        row = conn.execute("SELECT expires FROM hash_expires WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] <= time.time():
+            conn.execute("DELETE FROM hashes WHERE name = ?", (name,))
+            conn.execute("DELETE FROM hash_expires WHERE name = ? AND expires <= ?", (name, time.time()))
+
+    def append(self, name, value):
+        self._conn().execute("INSERT INTO lists (name, value) VALUES (?, ?)", (name, value))
+
+    def items(self, name, start=0, stop=-1):
+        limit = -1 if stop == -1 else stop - start + 1
+        rows = self._conn().execute(
+            "SELECT value FROM lists WHERE name = ? ORDER BY id LIMIT ? OFFSET ?", (name, limit, start)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def take(self, name, tokens, rate, capacity):
+        conn = self._conn()
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write is atomic across processes.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            available = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            granted = available >= tokens
+            if granted:
+                available -= tokens
+            conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)", (name, available, now))
+            conn.execute("COMMIT")
+            return granted
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisBackend(StateBackend):
+    """Multi-node shared state over the Redis protocol (RESP2), one connection per thread.
+
+    Only plain commands are used (no Lua, no transactions), so any Redis-compatible
+    server works, including redis_stub.py for local testing.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, password: str = None, timeout: float = 2.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        self._local.reader = sock.makefile("rb")
+        if self.password:
+            self._roundtrip("AUTH", self.password)
+        if self.db:
+            self._roundtrip("SELECT", self.db)
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise StateBackendError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            if size < 0:
+                return None
+            data = self._local.reader.read(size + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            size = int(payload)
+            return None if size < 0 else [self._read_reply() for _ in range(size)]
+        raise StateBackendError(f"unexpected reply {line!r}")
+
+    def _roundtrip(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._local.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def execute(self, *args):
+        # One reconnect per command covers server restarts and idle connections being dropped.
+        for attempt in (1, 2):
+            try:
+                if getattr(self._local, "sock", None) is None:
+                    self._connect()
+                return self._roundtrip(*args)
+            except (OSError, ConnectionError) as e:
+                self.close()
+                if attempt == 2:
+                    raise StateBackendError(f"redis {self.host}:{self.port} unavailable: {e}") from e
+
+    def get(self, key):
+        return self.execute("GET", key)
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.execute("SET", key, value, "EX", max(1, int(ttl)))
+        else:
+            self.execute("SET", key, value)
+
+    def hincr(self, name, field, amount=1, ttl=None):
+        value = float(self.execute("HINCRBYFLOAT", name, field, amount))
+        if ttl:
+            self.execute("EXPIRE", name, max(1, int(ttl)))
+        return value
+
+    def hgetall(self, name):
+        flat = self.execute("HGETALL", name) or []
+        return {flat[i]: float(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+    def append(self, name, value):
+        self.execute("RPUSH", name, value)
+
+    def items(self, name, start=0, stop=-1):
+        return self.execute("LRANGE", name, start, stop) or []
+
+    def take(self, name, tokens, rate, capacity):
+        # Fixed window sized to the burst: `capacity` tokens per capacity/rate seconds gives the
+        # same average rate and burst as a token bucket using only atomic INCRBY + EXPIRE.
+        window = max(1, int(capacity / rate)) if rate > 0 else 1
+        key = f"{name}:{int(time.time()) // window}"
+        used = self.execute("INCRBY", key, int(tokens))
+        if used == int(tokens):
+            self.execute("EXPIRE", key, window * 2)
+        return used <= capacity
+
+    def close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+
+def open_backend(url: str = DEFAULT_STATE_URL) -> StateBackend:
+    """Build a backend from a STATE_BACKEND url (see the module comment)."""
+    url = (url or DEFAULT_STATE_URL).strip()
+    if url == "memory":
+        return MemoryBackend()
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        path = parsed.path if parsed.netloc == "" else f"{parsed.netloc}{parsed.path}"
+        # sqlite:///state.db is relative to this directory, sqlite:////var/lib/state.db absolute
+        if path.startswith("//"):
+            path = path[1:]
+        elif path.startswith("/"):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path[1:])
+        return SQLiteBackend(path)
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RedisBackend(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password)
+    raise ValueError(f"Unsupported STATE_BACKEND {url!r}")
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def configure_shared_state(url: str) -> StateBackend:
+    """Replace the process-wide backend (the app calls this once at start-up from its secrets)."""
+    global _state
+    backend = open_backend(url)
+    with _state_lock:
+        previous, _state = _state, backend
+    if previous is not None:
+        previous.close()
+    return backend
+
+
+def shared_state() -> StateBackend:
+    """The process-wide backend, opened on first use from the STATE_BACKEND environment variable."""
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                _state = open_backend(os.environ.get("STATE_BACKEND", DEFAULT_STATE_URL))
+    return _state
+
+
+class SharedTokenBucket:
+    """A TokenBucket whose tokens live in the shared backend, so all replicas share one budget.
+
+    If the backend is unreachable it degrades to a per-process bucket instead of failing requests.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._local = TokenBucket(rate, capacity)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        backend = shared_state()
+        if not backend.shared:
+            return self._local.try_acquire(tokens)
+        try:
+            return backend.take(f"bucket:{self.name}", tokens, self.rate, self.capacity)
+        except (StateBackendError, sqlite3.Error) as e:
+            logging.warning(f"Shared rate limit {self.name} unavailable ({e}); limiting per process")
+            return self._local.try_acquire(tokens)
+
+    def acquire(self, tokens: float = 1, timeout: float = None, cancelled=None) -> bool:
+        """Same contract as TokenBucket.acquire; polls the shared bucket at a fraction of its refill time."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poll = min(0.25, max(0.01, tokens / self.rate if self.rate > 0 else 0.1))
+        while not self.try_acquire(tokens):
+            if cancelled is not None and cancelled():
+                return False
+            wait = poll
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+        return True
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import profiling
+import rewriter
+from openrouter_stub import StubConfig, start_stub
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+@pytest.fixture
+def app(monkeypatch, tmp_path):
+    server = start_stub(config=StubConfig(base_ms=0, prefill_ms=0, decode_ms=0))
+    monkeypatch.setattr(rewriter, "OPENROUTER_URL", server.url)
+    at = AppTest.from_file(APP, default_timeout=60)
+    at.secrets["OPENROUTER_API_KEY"] = "sk-test-0000"
+    at.secrets["FEEDBACK_CSV_PATH"] = str(tmp_path / "feedback.csv")
+    at.run()
+    yield at
+    server.shutdown()
+
+
+def test_one_form_submit_is_one_rerun(app):
+    app.text_area(key="user_input").set_value("You never answer emails on time. It's unprofessional.")
+    app.button(key="transform_btn").click().run()
+    assert not app.exception
+    assert app.session_state.rewritten_text
+    # The page load, then the submit
+    assert app.session_state.last_transform["reruns"] == 2
+
+    # Typing, picking a tone and ticking Email Mode are sent with the click, not run one by one
+    app.text_area(key="user_input").set_value("Your slides are confusing and far too long.")
+    app.selectbox(key="tone_selector").set_value("friendly")
+    app.checkbox(key="email_checkbox").set_value(True)
+    app.button(key="transform_btn").click().run()
+    assert not app.exception
+    assert app.session_state.last_transform["reruns"] == 1
+    assert app.session_state.rewrites[0]["tone"] == "friendly"
+    assert app.session_state.rewrites[0]["email"] is True
+
+
+def test_empty_submit_warns_without_a_transform(app):
+    app.button(key="transform_btn").click().run()
+    assert any("Drop in the feedback" in warning.value for warning in app.warning)
+    assert not app.session_state.rewritten_text
+
+
+def test_compare_all_tones_uses_what_is_on_screen(app):
+    app.text_area(key="user_input").set_value("You keep missing our deadlines and nobody knows why.")
+    app.selectbox(key="language_selector").set_value("Spanish")
+    app.button(key="compare_tones_btn").click().run()
+    assert not app.exception
+    assert app.session_state.tone_variants
+    assert {entry["language"] for entry in app.session_state.rewrites} == {"Spanish"}
+    assert {entry["original"] for entry in app.session_state.rewrites} == {"You keep missing our deadlines and nobody knows why."}
+
+
+def test_feedback_submit_saves_and_closes_in_one_run(app, tmp_path):
+    app.button(key="feedback_toggle_btn").click().run()
+    app.text_area(key="ff_text").set_value("Great tool, mail me at me@home.org")
+    runs = app.session_state[profiling.TALLY_KEY]["runs"]
+    next(button for button in app.button if "Submit" in button.label).click().run()
+    assert not app.exception
+    assert app.session_state[profiling.TALLY_KEY]["runs"] == runs + 1
+    assert not app.session_state.show_feedback_form
+    assert any("Thank you" in message.value for message in app.success)
+    assert not [area for area in app.text_area if area.key == "ff_text"]
+    saved = (tmp_path / "feedback.csv").read_text(encoding="utf-8")
+    assert "Great tool, mail me at [EMAIL_1]" in saved
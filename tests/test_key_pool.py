@@ -0,0 +1,94 @@
+import time
+from collections import Counter
+
+import pytest
+
+import key_pool
+import rewriter
+from key_pool import KeyPool
+from openrouter_stub import StubConfig, start_stub
+
+
+def test_rotation_spreads_calls_by_weight():
+    pool = KeyPool(["sk-aaaa-1111*2", "sk-bbbb-2222", "sk-cccc-3333"])
+    counts = Counter()
+    for _ in range(400):
+        key = pool.acquire()
+        counts[key.secret] += 1
+        pool.release(key, 200)
+    assert counts == {"sk-aaaa-1111": 200, "sk-bbbb-2222": 100, "sk-cccc-3333": 100}
+
+
+def test_least_loaded_key_goes_first():
+    pool = KeyPool(["sk-aaaa-1111", "sk-bbbb-2222"])
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+
+
+def test_rate_limited_key_rests_for_retry_after_and_comes_back():
+    pool = KeyPool(["sk-aaaa-1111", "sk-bbbb-2222"])
+    limited = pool.acquire()
+    pool.release(limited, 429, retry_after=0.2)
+    assert {pool.acquire().secret for _ in range(3)} == {"sk-bbbb-2222"}
+    time.sleep(0.25)
+    assert limited.usable(time.monotonic(), False)
+
+
+def test_acquire_waits_for_a_resting_key_within_the_timeout():
+    pool = KeyPool(["sk-aaaa-1111"])
+    key = pool.acquire()
+    pool.release(key, 429, retry_after=0.2)
+    assert pool.acquire(timeout=0.05) is None
+    assert pool.acquire(timeout=1) is key
+
+
+def test_out_of_credits_key_still_serves_free_models(monkeypatch):
+    monkeypatch.setattr(key_pool, "NO_CREDITS_COOLDOWN_SECONDS", 60)
+    pool = KeyPool(["sk-aaaa-1111"])
+    pool.release(pool.acquire(), 402)
+    assert pool.try_acquire(free_model=False) is None
+    assert pool.try_acquire(free_model=True) is not None
+
+
+def test_revoked_key_is_drained_and_repeat_failures_back_off(monkeypatch):
+    monkeypatch.setattr(key_pool, "REVOKED_COOLDOWN_SECONDS", 10)
+    pool = KeyPool(["sk-aaaa-1111"])
+    key = pool.acquire()
+    pool.release(key, 401)
+    first = key.disabled_until - time.monotonic()
+    key.disabled_until = 0
+    pool.release(pool.acquire(), 401)
+    assert not pool.has_usable()
+    assert key.disabled_until - time.monotonic() > first * 1.5
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = start_stub(config=StubConfig(base_ms=0, prefill_ms=0, decode_ms=0, key_rps=2, revoked_keys={"sk-revoked-0000"}))
+    monkeypatch.setattr(rewriter, "OPENROUTER_URL", server.url)
+    yield server
+    server.shutdown()
+
+
+def test_fallback_chain_moves_past_revoked_and_rate_limited_keys(stub):
+    pool = KeyPool(["sk-revoked-0000", "sk-good-1111", "sk-good-2222"])
+    for _ in range(4):
+        assert rewriter.call_model_fallbacks("Rewrite politely.", "You never answer emails.", pool, models=["stub/model:free"])
+    stats = stub.key_stats
+    assert stats["sk-revoked-0000"]["refused"] == {401: 1}
+    assert stats["sk-revoked-0000"]["ok"] == 0
+    assert stats["sk-good-1111"]["ok"] + stats["sk-good-2222"]["ok"] == 4
+    assert [entry["drained"] for entry in pool.snapshot()][0] == "revoked"
+
+
+def test_rate_limited_key_rests_then_serves_again(stub):
+    stub.config.key_rps = 1
+    pool = KeyPool(["sk-good-1111", "sk-good-2222"])
+    for _ in range(3):
+        rewriter.call_model_fallbacks("Rewrite politely.", "You never answer emails.", pool, models=["stub/model:free"])
+    refused = sum(stub.key_stats[key]["refused"].get(429, 0) for key in ("sk-good-1111", "sk-good-2222"))
+    assert refused >= 1
+    assert "rate limited" in [entry["drained"] for entry in pool.snapshot()]
+    time.sleep(1.1)
+    assert rewriter.call_model_fallbacks("Rewrite politely.", "You never answer emails.", pool, models=["stub/model:free"])
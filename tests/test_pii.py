@@ -0,0 +1,50 @@
+import pytest
+
+from pii import scrub, scrub_row
+
+
+def scrubbed(text):
+    return scrub(text, enabled=True).text
+
+
+@pytest.mark.parametrize("text", [
+    "Order 1234567 shipped",
+    "budget is 1500000 dollars",
+    "Invoice 20240105 is overdue",
+    "Version 1.2.3.4 is out",
+    "Running build 10.2.0.1 since Monday",
+    "Meeting on 2024-01-05 12:30",
+    "ref 4111111111111112 is not a card",
+    "Hi Team, thanks for the update.",
+    "Hello All, quick reminder.",
+    "Hey everyone,",
+])
+def test_leaves_non_personal_details_alone(text):
+    assert scrubbed(text) == text
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Call me at +1 (555) 010-2233 today", "Call me at [PHONE_1] today"),
+    ("call 555-010-2233 or 020 7946 0958", "call [PHONE_1] or [PHONE_2]"),
+    ("mail sam.lee@example.com", "mail [EMAIL_1]"),
+    ("server 10.0.0.12 is down", "server [IP_1] is down"),
+    ("card 4111 1111 1111 1111", "card [CARD_1]"),
+    ("Hi Sam, thanks", "Hi [NAME_1], thanks"),
+    ("ask Dr. Patel", "ask [NAME_1]"),
+])
+def test_replaces_personal_details(text, expected):
+    assert scrubbed(text) == expected
+
+
+def test_restore_puts_values_back_including_model_variations():
+    result = scrub("Reach sam.lee@example.com or sam.lee@example.com, not bo@example.com", enabled=True)
+    assert result.text == "Reach [EMAIL_1] or [EMAIL_1], not [EMAIL_2]"
+    assert result.restore("Write to [email_1] and [EMAIL 2].") == "Write to sam.lee@example.com and bo@example.com."
+
+
+def test_disabled_scrub_is_a_no_op():
+    assert scrub("mail sam.lee@example.com", enabled=False).text == "mail sam.lee@example.com"
+
+
+def test_scrub_row_keeps_non_text_cells():
+    assert scrub_row(["mail sam.lee@example.com", 5]) == ["mail [EMAIL_1]", 5]
@@ -0,0 +1,31 @@
+import pytest
+
+from quality_gate import QualityRejected, check_response
+
+EMAIL = (
+    "Subject: Following up on our project timeline\n\n"
+    "Hi Sam,\n\n"
+    "Thank you for your work on the launch plan. I noticed a few replies arrived later than the team "
+    "expected, which made it harder to keep the schedule. Could we agree on a response window that works for both of us?\n\n"
+    "Best regards,\n[Your Name]"
+)
+
+
+def test_email_signed_your_name_passes():
+    check_response(EMAIL, "English", "You never answer emails on time.")
+
+
+@pytest.mark.parametrize("leftover", [
+    "<reframe: open with a positive or neutral observation>",
+    "<1–2 sentences on delivering it>",
+    "<insert the project name>",
+])
+def test_prompt_instructions_left_in_are_rejected(leftover):
+    text = f"The Reframe:\n{leftover}\n\nBonus Tip:\nTalk to them privately, early in the week."
+    with pytest.raises(QualityRejected):
+        check_response(text, "English", "You never answer emails on time.")
+
+
+def test_refusal_is_rejected():
+    with pytest.raises(QualityRejected):
+        check_response("As an AI language model, I can't help with rewriting this message for you today.", "English")
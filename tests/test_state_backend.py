@@ -0,0 +1,97 @@
+import time
+
+import pytest
+
+from redis_stub import start_stub
+from state_backend import MemoryBackend, RedisBackend, SQLiteBackend, open_backend
+
+
+@pytest.fixture(scope="module")
+def redis_server():
+    server = start_stub(port=0)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        backend = MemoryBackend()
+    elif request.param == "sqlite":
+        backend = SQLiteBackend(str(tmp_path / "state.db"))
+    else:
+        server = request.getfixturevalue("redis_server")
+        backend = RedisBackend("127.0.0.1", server.server_address[1])
+        # The stub's data is process-wide; keep each test's keys apart.
+        backend.execute("DEL", "greeting", "short", "h", "session", "log", "bucket:test")
+    yield backend
+    backend.close()
+
+
+def test_get_and_set(backend):
+    assert backend.get("greeting") is None
+    backend.set("greeting", "héllo")
+    assert backend.get("greeting") == "héllo"
+    backend.set("greeting", "again")
+    assert backend.get("greeting") == "again"
+
+
+def test_set_with_ttl_expires(backend):
+    backend.set("short", "v", ttl=1)
+    assert backend.get("short") == "v"
+    time.sleep(1.1)
+    assert backend.get("short") is None
+
+
+def test_hash_counters(backend):
+    assert backend.hincr("h", "ok") == 1
+    assert backend.hincr("h", "ok", 2.5) == 3.5
+    backend.hincr("h", "fail")
+    assert backend.hgetall("h") == {"ok": 3.5, "fail": 1.0}
+    assert backend.hgetall("missing") == {}
+
+
+def test_hash_with_ttl_expires(backend):
+    backend.hincr("session", "cost", 0.5, ttl=1)
+    assert backend.hgetall("session") == {"cost": 0.5}
+    time.sleep(1.1)
+    assert backend.hgetall("session") == {}
+
+
+def test_lists_keep_order_and_slice_like_lrange(backend):
+    for value in ("a", "b", "c", "d"):
+        backend.append("log", value)
+    assert backend.items("log") == ["a", "b", "c", "d"]
+    assert backend.items("log", 1, 2) == ["b", "c"]
+    assert backend.items("log", 2) == ["c", "d"]
+    assert backend.items("missing") == []
+
+
+def test_take_grants_up_to_capacity(backend):
+    granted = [backend.take("bucket:test", 1, rate=0.01, capacity=3) for _ in range(5)]
+    assert granted == [True, True, True, False, False]
+
+
+def test_open_backend_urls(tmp_path):
+    assert isinstance(open_backend("memory"), MemoryBackend)
+    assert isinstance(open_backend(f"sqlite:///{tmp_path}/state.db"), SQLiteBackend)
+    redis = open_backend("redis://localhost:6399/2")
+    assert (redis.host, redis.port, redis.db) == ("localhost", 6399, 2)
+    with pytest.raises(ValueError):
+        open_backend("postgres://db")
+
+
+def test_sqlite_deletes_expired_keys(tmp_path, monkeypatch):
+    import state_backend
+
+    monkeypatch.setattr(state_backend, "SQLITE_SWEEP_SECONDS", 0)
+    backend = SQLiteBackend(str(tmp_path / "state.db"))
+    for i in range(10):
+        backend.set(f"cache:{i}", "v", ttl=1)
+    backend.hincr("usage:session:x", "cost", 1, ttl=1)
+    time.sleep(1.1)
+    backend.set("kept", "v")
+    conn = backend._conn()
+    assert conn.execute("SELECT key FROM kv").fetchall() == [("kept",)]
+    assert conn.execute("SELECT COUNT(*) FROM hashes").fetchone() == (0,)
+    backend.close()
@@ -0,0 +1,331 @@
+import argparse
+import base64
+import csv
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+
+from state_backend import shared_state
+
+try:
+    import zstandard
+except ImportError:  # optional: zlib with the same dictionary works everywhere
+    zstandard = None
+
+# ---------------------- Compressed text storage ----------------------
+# Rewrites and originals are short and repetitive ("The Reframe:", "Bonus Tip:", email
+# greetings, the same softened phrases), too short for a compressor to find much on its
+# own, so they are compressed against a preset dictionary of phrases trained on our own
+# texts: the rule-based rewrites of every sample/tone/language and the precomputed
+# catalog (or a dictionary trained offline, TEXT_DICT_PATH). zstd is used when the
+# zstandard package is installed, raw deflate (zlib's zdict) otherwise.
+#   binary  codec byte + 4-byte dictionary id + payload; kept by in-memory caches and
+#           spill files
+#   text    TEXT_MARKER + base85 of the binary form, for string stores (state backend)
+# Reading is always transparent: values without the header or marker are plain text, so
+# COMPRESS_TEXT can be switched on (or off) over existing data. A dictionary is saved
+# under its id (TEXT_DICT_DIR, and the shared state backend) the first time it is used,
+# so data written with an older dictionary stays readable after the corpus changes.
+# `python text_codec.py` reports the ratios and the encode/decode cost on held-out texts.
+
+COMPRESS_TEXT = os.environ.get("COMPRESS_TEXT", "").lower() in ("1", "true", "yes")
+TEXT_DICT_PATH = os.environ.get("TEXT_DICT_PATH", "")
+TEXT_DICT_DIR = os.environ.get("TEXT_DICT_DIR", "") or os.path.join(tempfile.gettempdir(), "reframe-text-dicts")
+# Deflate can reach back 32 KiB; leave room for the text itself.
+DICT_SIZE = 31 * 1024
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+TEXT_MARKER = "~z1~"
+SHARED_DICT_PREFIX = "text_dict:"
+
+_ZLIB = 1
+_ZSTD = 2
+_HEADER_SIZE = 5
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+")
+
+
+def train_dictionary(samples, size: int = DICT_SIZE) -> bytes:
+    """A preset dictionary of the lines, sentences and word runs that recur across `samples`.
+
+    Pieces are scored by the bytes they would save (repeats x length); the best ones go
+    last, where deflate and zstd reach them with the shortest distances.
+    """
+    counts = Counter()
+    for text in samples:
+        pieces = set()
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            pieces.add(line)
+            pieces.update(sentence.strip() for sentence in _SENTENCE_END.split(line))
+            words = line.split()
+            for n in (2, 3, 4, 6):
+                pieces.update(" ".join(words[i:i + n]) for i in range(len(words) - n + 1))
+        counts.update(piece for piece in pieces if len(piece) >= 4)
+    ranked = sorted(((count - 1) * len(piece.encode("utf-8")), piece) for piece, count in counts.items() if count > 1)
+    chosen = []
+    blob = ""
+    total = 0
+    for _, piece in reversed(ranked):
+        if total >= size:
+            break
+        if piece in blob:
+            continue
+        chosen.append(piece)
+        blob += "\n" + piece
+        total += len(piece.encode("utf-8")) + 1
+    return "\n".join(reversed(chosen)).encode("utf-8")[-size:]
+
+
+class TextCodec:
+    """Compresses short texts against one preset dictionary; thread-safe."""
+
+    def __init__(self, dictionary: bytes, use_zstd: bool = None):
+        self.dictionary = dictionary
+        self.dict_id = hashlib.sha1(dictionary).digest()[:4]
+        self.kind = _ZSTD if (zstandard is not None if use_zstd is None else use_zstd) else _ZLIB
+        self._local = threading.local()
+        self._zstd_dict = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT) if zstandard is not None else None
+
+    @property
+    def name(self) -> str:
+        return f"{'zstd' if self.kind == _ZSTD else 'zlib'}+dict {self.dict_id.hex()}"
+
+    def compress(self, text: str) -> bytes:
+        data = text.encode("utf-8")
+        if self.kind == _ZSTD:
+            # zstd (de)compressor objects are not thread-safe: one per thread.
+            compressor = getattr(self._local, "compressor", None)
+            if compressor is None:
+                compressor = self._local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self._zstd_dict, write_checksum=False, write_dict_id=False)
+            body = compressor.compress(data)
+        else:
+            compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+            body = compressor.compress(data) + compressor.flush()
+        return bytes((self.kind,)) + self.dict_id + body
+
+    def decompress(self, blob: bytes) -> str:
+        kind, body = blob[0], blob[_HEADER_SIZE:]
+        if kind == _ZSTD:
+            if self._zstd_dict is None:
+                raise ValueError("zstd-compressed text but the zstandard package is not installed")
+            decompressor = getattr(self._local, "decompressor", None)
+            if decompressor is None:
+                decompressor = self._local.decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dict)
+            return decompressor.decompress(body).decode("utf-8")
+        if kind != _ZLIB:
+            raise ValueError(f"Unknown text codec {kind}")
+        decompressor = zlib.decompressobj(-15, self.dictionary)
+        return (decompressor.decompress(body) + decompressor.flush()).decode("utf-8")
+
+
+# ---------------------- Dictionaries ----------------------
+_codecs = {}
+_default = None
+_lock = threading.Lock()
+
+
+def seed_corpus() -> list:
+    """Texts the built-in dictionary is trained on: the catalog's rewrites and the rule-based ones."""
+    # Imported here: catalog imports rewriter, which imports the cache that uses this module.
+    from catalog import catalog_combinations, load_catalog
+    from rule_rewriter import rule_rewrite_formatted
+
+    texts = [rule_rewrite_formatted(sample, tone, language, email) for sample, tone, language, email in catalog_combinations()]
+    catalog = load_catalog()
+    if catalog is not None:
+        texts.extend(catalog.entries().values())
+    return texts
+
+
+def _save(codec: TextCodec) -> None:
+    """Keep the dictionary under its id, locally and in the shared store, for later decoding."""
+    name = codec.dict_id.hex()
+    path = os.path.join(TEXT_DICT_DIR, f"{name}.dict")
+    try:
+        if not os.path.isfile(path):
+            os.makedirs(TEXT_DICT_DIR, exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(codec.dictionary)
+            os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.warning(f"Could not save text dictionary {path}: {e}")
+    backend = shared_state()
+    if backend.shared:
+        try:
+            if backend.get(SHARED_DICT_PREFIX + name) is None:
+                backend.set(SHARED_DICT_PREFIX + name, base64.b85encode(codec.dictionary).decode("ascii"))
+        except Exception as e:
+            logging.warning(f"Could not share text dictionary {name}: {e}")
+
+
+def default_codec() -> TextCodec:
+    """The codec new data is written with (built on first use)."""
+    global _default
+    with _lock:
+        if _default is None:
+            dictionary = None
+            if TEXT_DICT_PATH:
+                try:
+                    with open(TEXT_DICT_PATH, "rb") as f:
+                        dictionary = f.read()
+                except OSError as e:
+                    logging.error(f"Could not read TEXT_DICT_PATH {TEXT_DICT_PATH}: {e}")
+            if dictionary is None:
+                dictionary = train_dictionary(seed_corpus())
+            _default = TextCodec(dictionary)
+            _codecs[_default.dict_id] = _default
+            _save(_default)
+        return _default
+
+
+def _codec_for(dict_id: bytes) -> TextCodec:
+    codec = _codecs.get(dict_id)
+    if codec is not None:
+        return codec
+    if _default is None:
+        default_codec()
+        if dict_id in _codecs:
+            return _codecs[dict_id]
+    dictionary = None
+    try:
+        with open(os.path.join(TEXT_DICT_DIR, f"{dict_id.hex()}.dict"), "rb") as f:
+            dictionary = f.read()
+    except OSError:
+        backend = shared_state()
+        stored = backend.get(SHARED_DICT_PREFIX + dict_id.hex()) if backend.shared else None
+        if stored:
+            dictionary = base64.b85decode(stored)
+    if dictionary is None:
+        raise ValueError(f"Unknown text dictionary {dict_id.hex()}")
+    codec = _codecs.setdefault(dict_id, TextCodec(dictionary))
+    return codec
+
+
+# ---------------------- Transparent encode / decode ----------------------
+def pack(text: str, enabled: bool = None):
+    """`text` compressed (bytes) when compression is on, else `text` itself."""
+    if not (COMPRESS_TEXT if enabled is None else enabled):
+        return text
+    return default_codec().compress(text)
+
+
+def unpack(value) -> str:
+    """Inverse of pack() and encode_text(); plain strings (and plain UTF-8 bytes) pass through."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+        if value[:1] in (bytes((_ZLIB,)), bytes((_ZSTD,))):
+            return _codec_for(value[1:_HEADER_SIZE]).decompress(value)
+        return value.decode("utf-8")
+    return decode_text(value)
+
+
+def encode_text(text: str, enabled: bool = None) -> str:
+    """`text` as a compressed, marked string for string-only stores (when compression is on)."""
+    if not (COMPRESS_TEXT if enabled is None else enabled):
+        return text
+    return TEXT_MARKER + base64.b85encode(default_codec().compress(text)).decode("ascii")
+
+
+def decode_text(value: str) -> str:
+    """Inverse of encode_text(); raises ValueError if the dictionary it names is not available."""
+    if not value or not value.startswith(TEXT_MARKER):
+        return value
+    return unpack(base64.b85decode(value[len(TEXT_MARKER):]))
+
+
+# ---------------------- Report ----------------------
+def load_texts(path: str) -> list:
+    """Texts from a feedback CSV (its text columns), a JSON-lines file of strings, or plain lines."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            reader = csv.reader(f)
+            next(reader, None)
+            return [cell for row in reader for cell in row if len(cell) > 40]
+        texts = []
+        for line in f:
+            line = line.rstrip("\n")
+            if path.endswith(".jsonl"):
+                try:
+                    line = json.loads(line)
+                except ValueError:
+                    continue
+            if isinstance(line, str) and line.strip():
+                texts.append(line)
+        return texts
+
+
+def measure(codec: TextCodec, texts, rounds: int = 3) -> dict:
+    raw = sum(len(text.encode("utf-8")) for text in texts)
+    blobs = [codec.compress(text) for text in texts]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            codec.compress(text)
+    encode = (time.perf_counter() - started) / (rounds * len(texts))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for blob in blobs:
+            codec.decompress(blob)
+    decode = (time.perf_counter() - started) / (rounds * len(texts))
+    stored = sum(map(len, blobs))
+    # The marked base85 form string stores keep costs a quarter more than the binary one.
+    as_text = sum(len(TEXT_MARKER) + (len(blob) + 3) // 4 * 5 for blob in blobs)
+    return {
+        "codec": codec.name,
+        "texts": len(texts),
+        "raw_bytes": raw,
+        "stored_bytes": stored,
+        "ratio": raw / stored,
+        "text_ratio": raw / as_text,
+        "encode_us": encode * 1e6,
+        "decode_us": decode * 1e6,
+    }
+
+
+def report(texts, holdout: float = 0.2, seed: int = 7) -> list:
+    """Train on part of `texts`, measure on the rest: no dictionary vs. the trained one, per codec."""
+    texts = list(texts)
+    random.Random(seed).shuffle(texts)
+    cut = max(1, int(len(texts) * holdout))
+    test, train = texts[:cut], texts[cut:]
+    dictionary = train_dictionary(train)
+    codecs = [TextCodec(b"", use_zstd=False), TextCodec(dictionary, use_zstd=False)]
+    if zstandard is not None:
+        codecs += [TextCodec(b"", use_zstd=True), TextCodec(dictionary, use_zstd=True)]
+    rows = [measure(codec, test) for codec in codecs]
+    for row, codec in zip(rows, codecs):
+        if not codec.dictionary:
+            row["codec"] = row["codec"].split("+")[0] + " (no dict)"
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a text dictionary, or report compression ratios and cost.")
+    parser.add_argument("texts", nargs="*", help="feedback CSV, JSON-lines or text files (default: the built-in seed corpus)")
+    parser.add_argument("--train", metavar="OUT", help="write a dictionary trained on the texts to OUT (use it with TEXT_DICT_PATH)")
+    args = parser.parse_args()
+
+    corpus = [text for path in args.texts for text in load_texts(path)] if args.texts else seed_corpus()
+    if not corpus:
+        raise SystemExit("No texts to work with")
+    if args.train:
+        dictionary = train_dictionary(corpus)
+        with open(args.train, "wb") as f:
+            f.write(dictionary)
+        print(f"wrote {len(dictionary)} byte dictionary {hashlib.sha1(dictionary).digest()[:4].hex()} trained on {len(corpus)} texts to {args.train}")
+    else:
+        print(f"{len(corpus)} texts, {sum(len(t.encode('utf-8')) for t in corpus) / len(corpus):.0f} bytes on average; 20% held out for measuring")
+        print(f"{'codec':<26} {'ratio':>6} {'as text':>8} {'encode µs':>10} {'decode µs':>10} {'texts/GB':>12}")
+        for row in report(corpus):
+            print(f"{row['codec']:<26} {row['ratio']:>6.2f} {row['text_ratio']:>8.2f} {row['encode_us']:>10.1f} {row['decode_us']:>10.1f} {2**30 * row['texts'] / row['stored_bytes']:>12,.0f}")
+        print("(texts/GB counts payload bytes only; raw text is 1.00)")
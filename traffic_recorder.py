@@ -0,0 +1,143 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from accounting import current_session, estimate_tokens
+
+# ---------------------- Anonymized traffic recorder ----------------------
+# With TRAFFIC_LOG set to a file path, every rewrite_message call appends one JSON line
+# describing the *shape* of the request, never its text:
+#   {"ts": 1729331000.123, "session": "9f2c1a0b", "input_chars": 412, "input_tokens": 103,
+#    "tone": "friendly", "language": "English", "email": false, "seconds": 2.41,
+#    "source": "model", "model": "mistral/mistral-7b-instruct", "status": "ok",
+#    "attempts": [["mistral/mistral-7b-instruct", "ok", 2.39]]}
+# Sessions are replaced by a salted hash (TRAFFIC_LOG_SALT) so their requests can be
+# grouped without being traced back. loadtest.py replays these files against the stub.
+#   source  catalog | cache | similar | model | fallback | none   (who produced the answer)
+#   status  ok | failed | cancelled | timeout | error
+# Attempt outcomes: ok, http_<code>, malformed, rejected, empty, network, cancelled,
+# no_key (every pooled API key was drained or resting).
+
+TRAFFIC_LOG = os.environ.get("TRAFFIC_LOG", "")
+TRAFFIC_LOG_SALT = os.environ.get("TRAFFIC_LOG_SALT", "")
+
+_current = contextvars.ContextVar("traffic_record", default=None)
+
+
+def anonymize_session(session_id: str, salt: str = None) -> str:
+    if not session_id:
+        return ""
+    salt = TRAFFIC_LOG_SALT if salt is None else salt
+    return hashlib.sha256(f"{salt}\x00{session_id}".encode("utf-8")).hexdigest()[:12]
+
+
+class TrafficRecorder:
+    """Appends one anonymized JSON line per rewrite request to `path` (thread-safe)."""
+
+    def __init__(self, path: str, salt: str = None):
+        self.path = path
+        self.salt = salt
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        try:
+            with self._lock:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                self.written += 1
+        except OSError as e:
+            logging.warning(f"Could not write traffic record to {self.path}: {e}")
+
+    @contextmanager
+    def request(self, user_input: str, tone: str, language: str, format_as_email: bool):
+        """Record the rewrite running inside the block; yields the record so the caller can set source/status."""
+        record = {
+            "ts": round(time.time(), 3),
+            "session": anonymize_session(current_session(), self.salt),
+            "input_chars": len(user_input),
+            "input_tokens": estimate_tokens(user_input),
+            "tone": tone,
+            "language": language,
+            "email": bool(format_as_email),
+            "seconds": 0.0,
+            "source": "none",
+            "model": "",
+            "status": "failed",
+            "attempts": [],
+        }
+        reset = _current.set(record)
+        started = time.monotonic()
+        try:
+            yield record
+        except Exception:
+            record["status"] = "error"
+            raise
+        finally:
+            _current.reset(reset)
+            record["seconds"] = round(time.monotonic() - started, 4)
+            self.write(record)
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def configure_recorder(path: str):
+    """Start recording to `path` ("" turns recording off); returns the recorder or None."""
+    global _recorder
+    with _recorder_lock:
+        _recorder = TrafficRecorder(path) if path else None
+        return _recorder
+
+
+def recorder():
+    """The process-wide recorder (from TRAFFIC_LOG on first use), or None when recording is off."""
+    global _recorder
+    if _recorder is None and TRAFFIC_LOG:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = TrafficRecorder(TRAFFIC_LOG)
+    return _recorder
+
+
+@contextmanager
+def recording(user_input: str, tone: str, language: str, format_as_email: bool):
+    """`recorder().request(...)` when recording is on, otherwise a throwaway record."""
+    active = recorder()
+    if active is None:
+        yield {}
+        return
+    with active.request(user_input, tone, language, format_as_email) as record:
+        yield record
+
+
+def note_attempt(model: str, outcome: str, seconds: float) -> None:
+    """Called by the fallback loop for every upstream attempt of the request being recorded."""
+    record = _current.get()
+    if record is not None:
+        record["attempts"].append([model, outcome, round(seconds, 4)])
+        if outcome == "ok":
+            record["model"] = model
+
+
+def load_records(path: str) -> list:
+    """Read a traffic log back, skipping lines that do not parse, sorted by timestamp."""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records